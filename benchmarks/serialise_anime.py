@@ -0,0 +1,109 @@
+"""Time how long serialising an anime with 1000 resolved episodes takes.
+
+Run from the repository root: python -m benchmarks.serialise_anime
+"""
+import timeit
+from typing import List
+
+from grobber.languages import Language
+from grobber.models import Anime, Episode, EpisodeMap, Stream
+from grobber.request import Request
+
+EPISODES = 1000
+STREAMS = 3
+NUMBER = 20
+
+
+class BenchStream(Stream):
+    ATTRS = ("player_data",)
+
+    @property
+    async def external(self) -> bool:
+        return True
+
+    @property
+    async def links(self) -> List[str]:
+        return []
+
+
+class BenchEpisode(Episode):
+    @property
+    async def raw_streams(self) -> List[str]:
+        return []
+
+
+class BenchAnime(Anime):
+    EPISODE_CLS = BenchEpisode
+
+    @property
+    async def is_dub(self) -> bool:
+        return False
+
+    @property
+    async def language(self) -> Language:
+        return Language.ENGLISH
+
+    @property
+    async def title(self) -> str:
+        return "Benchmark"
+
+    async def get_episodes(self) -> List[Episode]:
+        return []
+
+    async def get_episode(self, index: int) -> Episode:
+        raise IndexError(index)
+
+    @classmethod
+    async def search(cls, query, *, dubbed=False, language=Language.ENGLISH):
+        yield
+
+
+def create_stream(ep: int, index: int) -> Stream:
+    stream = BenchStream(Request(f"https://stream.example/{ep}/{index}"))
+    stream._external = True
+    stream._links = [f"https://cdn.example/{ep}/{index}.mp4"]
+    stream._poster = f"https://cdn.example/{ep}/{index}.jpg"
+    stream._player_data = {"id": ep, "index": index}
+    return stream
+
+
+def create_episode(ep: int) -> Episode:
+    episode = BenchEpisode(Request(f"https://anime.example/episode/{ep}"))
+    episode._raw_streams = [f"https://stream.example/{ep}/{index}" for index in range(STREAMS)]
+    episode._streams = [create_stream(ep, index) for index in range(STREAMS)]
+    episode._stream = episode._streams[0]
+    episode._poster = episode._stream._poster
+    return episode
+
+
+def create_anime() -> Anime:
+    anime = BenchAnime(Request("https://anime.example/"))
+    anime._title = "Benchmark"
+    anime._is_dub = False
+    anime._language = Language.ENGLISH
+    anime._episode_count = EPISODES
+    anime._episodes = EpisodeMap(BenchEpisode)
+    anime._episodes.update((i, create_episode(i)) for i in range(EPISODES))
+    return anime
+
+
+def main() -> None:
+    anime = create_anime()
+    stored = create_anime()
+    # as if it had just been saved, the changes have to be looked for in every episode
+    stored.dirty = False
+    stored._episodes[500]._stream.mark_dirty("links")
+
+    benchmarks = {
+        "state": lambda: anime.state,
+        "dirty": lambda: stored.dirty,
+        "get_changes": lambda: stored.get_changes(),
+    }
+
+    for name, func in benchmarks.items():
+        best = min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER
+        print(f"{name:12} {best * 1000:8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
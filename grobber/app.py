@@ -4,10 +4,11 @@ import os
 import sentry_sdk
 from quart import Quart, Response
 
-from . import __info__, sources
+from . import __info__, migrations, sources
 from .blueprints import *
 from .exceptions import GrobberException
 from .models import UIDConverter
+from .request import BROWSER, CONNECTION_POOLS, PROXY_POOL, PROXY_ROUTES
 from .utils import *
 
 log = logging.getLogger(__name__)
@@ -37,6 +38,27 @@ def teardown_app_context(*_):
     do_later(sources.save_dirty())
 
 
+@app.before_serving
+async def before_serving():
+    await migrations.migrate()
+    await sources.start()
+    PROXY_ROUTES.start()
+    PROXY_POOL.start()
+
+    warm_pages = int(os.getenv("BROWSER_WARM_PAGES", 0))
+    if warm_pages:
+        do_later(BROWSER.warm(warm_pages))
+
+
+@app.after_serving
+async def after_serving():
+    await sources.close()
+    PROXY_ROUTES.stop()
+    PROXY_POOL.stop()
+    await BROWSER.close()
+    await CONNECTION_POOLS.close()
+
+
 @app.after_request
 async def after_request(response: Response) -> Response:
     response.headers["Grobber-Version"] = __info__.__version__
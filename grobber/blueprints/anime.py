@@ -1,25 +1,75 @@
 import asyncio
+import json
 import logging
+from typing import AsyncIterator, Callable, Dict, Tuple
 
 import quart
 from quart import Blueprint, Response, redirect, request
 
 from .. import query, sources
 from ..exceptions import InvalidRequest
-from ..models import Anime, UID
+from ..models import Anime, SearchResult, UID
+from ..rate_limit import Priority, request_priority
+from ..sources import SearchReport
 from ..utils import *
 
 log = logging.getLogger(__name__)
 
 anime_blueprint = Blueprint("anime", __name__, url_prefix="/anime")
 
+MAX_EPISODE_COUNT_ANIME = 100
+# amount of anime which may update their episode count at the same time
+EPISODE_COUNT_CONCURRENCY = 10
+
+
+def _format_ndjson(event: str, data: dict) -> str:
+    data = dict(data, event=event)
+    return json.dumps(data) + "\n"
+
+
+def _format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+SEARCH_STREAM_FORMATS: Dict[str, Tuple[str, Callable[[str, dict], str]]] = {
+    "ndjson": ("application/x-ndjson", _format_ndjson),
+    "sse": ("text/event-stream", _format_sse)
+}
+
+
+async def stream_search(stream_format: str) -> Response:
+    try:
+        mimetype, format_event = SEARCH_STREAM_FORMATS[stream_format]
+    except KeyError:
+        raise InvalidRequest(f"Unknown stream format \"{stream_format}\" (available: {', '.join(SEARCH_STREAM_FORMATS)})")
+
+    report = SearchReport()
+    results: AsyncIterator[SearchResult] = await query.stream_search(report)
+
+    async def generate() -> AsyncIterator[str]:
+        try:
+            async for result in results:
+                yield format_event("result", await result.to_dict())
+        except Exception:
+            log.exception("search stream failed")
+            yield format_event("done", dict(report.as_dict(), success=False))
+        else:
+            yield format_event("done", dict(report.as_dict(), success=True))
+
+    return Response(generate(), mimetype=mimetype)
+
 
 @anime_blueprint.route("/search/")
 async def search() -> Response:
-    anime = await query.search_anime()
+    stream_format = request.args.get("stream")
+    if stream_format:
+        return await stream_search(stream_format)
+
+    report = SearchReport()
+    anime = await query.search_anime(report)
     results = [await a.to_dict() for a in anime]
 
-    return create_response(anime=results)
+    return create_response(anime=results, timed_out=report.timed_out)
 
 
 @anime_blueprint.route("/episode-count/", methods=("POST",))
@@ -28,35 +78,37 @@ async def get_anime_episode_count() -> Response:
     if not isinstance(anime_uids, list):
         raise InvalidRequest("Body needs to contain a list of uids!")
 
-    if len(anime_uids) > 30:
-        raise InvalidRequest(f"Too many anime requested, max is 30! ({len(anime_uids)})")
+    if len(anime_uids) > MAX_EPISODE_COUNT_ANIME:
+        raise InvalidRequest(f"Too many anime requested, max is {MAX_EPISODE_COUNT_ANIME}! ({len(anime_uids)})")
 
-    anime = filter(None, await asyncio.gather(*(sources.get_anime(uid) for uid in anime_uids)))
+    anime = await sources.get_many(anime_uids, ("episode_count", "last_update", "fetched"))
 
-    async def get_pair(a: Anime) -> (str, int):
-        return await a.uid, await a.episode_count
+    async def get_pair(uid: str, a: Anime) -> (str, int):
+        return uid, await a.episode_count
 
-    anime_counts = await asyncio.gather(*(get_pair(a) for a in anime))
+    anime_counts = await bounded_gather(*(get_pair(uid, a) for uid, a in anime.items()), limit=EPISODE_COUNT_CONCURRENCY)
     return create_response(anime=dict(anime_counts))
 
 
 @anime_blueprint.route("/")
 async def get_anime_info() -> Response:
-    anime = await query.get_anime()
+    anime = await query.get_anime(Anime.DICT_ATTRS)
     return create_response(anime=await anime.to_dict())
 
 
 @anime_blueprint.route("/preload/")
 async def preload_anime() -> Response:
     anime = await query.get_anime()
-    await anime.preload_attrs(recursive=False)
+    with request_priority(Priority.BACKGROUND):
+        await anime.preload_attrs(recursive=False)
     return create_response()
 
 
 @anime_blueprint.route("/state/")
 async def get_anime_state() -> Response:
     anime = await query.get_anime()
-    return create_response(data=anime.state)
+    await anime.load_attrs()
+    return create_response(data=anime.state, freshness=anime.freshness)
 
 
 @anime_blueprint.route("/episode/")
@@ -80,7 +132,7 @@ async def preload_episode() -> Response:
 @anime_blueprint.route("/episode/state/")
 async def get_episode_state() -> Response:
     episode = await query.get_episode()
-    return create_response(data=episode.state)
+    return create_response(data=episode.state, freshness=episode.freshness)
 
 
 @anime_blueprint.route("/stream/")
@@ -1,11 +1,10 @@
-from datetime import datetime, timedelta
-
 from quart import Blueprint, Response, request
 
 from .. import sources, streams
 from ..exceptions import *
-from ..models import UID
-from ..request import Request
+from ..models import STREAM_RESOLVER, UID
+from ..rate_limit import HOST_SCHEDULERS
+from ..request import BROWSER, CONNECTION_POOLS, PROXY_POOL, PROXY_ROUTES, Request
 from ..utils import create_response
 
 debug_blueprint = Blueprint("debug", __name__, url_prefix="/debug")
@@ -31,6 +30,32 @@ async def expire_anime(uid: UID) -> Response:
     if not anime:
         raise UIDUnknown(uid)
 
-    anime._last_update = datetime.now() - timedelta(seconds=anime.EXPIRE_TIME)
-    anime.dirty = True
+    anime.mark_expired()
     return create_response()
+
+
+@debug_blueprint.route("/cache")
+async def cache_info() -> Response:
+    return create_response(anime={"size": len(sources.ANIME_CACHE),
+                                  "max_size": sources.ANIME_CACHE.max_size,
+                                  **sources.ANIME_CACHE.stats.as_dict()},
+                           persister=sources.PERSISTER.as_dict(),
+                           refresher=sources.REFRESHER.as_dict())
+
+
+@debug_blueprint.route("/connections")
+async def connection_info() -> Response:
+    return create_response(pools=CONNECTION_POOLS.as_dict(),
+                           hosts=HOST_SCHEDULERS.as_dict(),
+                           proxy_routes=PROXY_ROUTES.as_dict(),
+                           proxies=PROXY_POOL.as_dict())
+
+
+@debug_blueprint.route("/browser")
+async def browser_info() -> Response:
+    return create_response(browser=BROWSER.as_dict())
+
+
+@debug_blueprint.route("/streams")
+async def stream_info() -> Response:
+    return create_response(resolver=STREAM_RESOLVER.as_dict())
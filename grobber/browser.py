@@ -0,0 +1,408 @@
+import asyncio
+import contextlib
+import logging
+import re
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, FrozenSet, List, NamedTuple, Optional, Pattern, Tuple
+
+from pyppeteer.browser import Browser
+from pyppeteer.errors import PageError
+from pyppeteer.network_manager import Request as InterceptedRequest, Response as InterceptedResponse
+from pyppeteer.page import Page
+
+from .utils import do_later
+
+log = logging.getLogger(__name__)
+
+
+class BrowserBusy(PageError):
+    """Raised when no page becomes available in time."""
+
+
+AD_URL_PATTERNS = (r"doubleclick\.net", r"googlesyndication\.com", r"google-analytics\.com", r"googletagmanager\.com",
+                   r"adservice\.google\.", r"popads\.net", r"popcash\.net", r"propellerads\.com", r"onclkds\.com",
+                   r"adsco\.re", r"exoclick\.com", r"juicyads\.com")
+
+# resource types which don't matter when we're only interested in the markup
+HEAVY_RESOURCE_TYPES = frozenset({"image", "media", "font", "stylesheet"})
+
+
+class BrowserProfile(NamedTuple):
+    """How a page is loaded.
+
+    Requests for block_resources (pyppeteer resource types such as "image" or "font")
+    and urls matching one of the block_urls patterns are aborted.
+    Navigation waits for the wait_until event or, if wait_for is set, only until an element matches that selector.
+    """
+    block_resources: FrozenSet[str] = frozenset()
+    block_urls: Tuple[str, ...] = ()
+    wait_until: str = "load"
+    wait_for: Optional[str] = None
+    timeout: float = 30
+
+    @property
+    def intercepts(self) -> bool:
+        return bool(self.block_resources or self.block_urls)
+
+    @property
+    def block_pattern(self) -> Optional[Pattern]:
+        # re caches compiled patterns
+        return re.compile("|".join(self.block_urls)) if self.block_urls else None
+
+
+DEFAULT_PROFILE = BrowserProfile()
+# only load what's needed to run the scripts of the page
+LIGHT_PROFILE = BrowserProfile(block_resources=HEAVY_RESOURCE_TYPES, block_urls=AD_URL_PATTERNS)
+
+
+MEDIA_MIME_TYPES = ("video/",)
+
+
+class CapturedRequest(NamedTuple):
+    url: str
+    headers: Dict[str, str]
+    mime_type: Optional[str] = None
+
+
+class RequestCapture:
+    """Watches the network traffic of a page for the first request we're interested in.
+
+    Requests are captured as soon as they're sent if their resource type is one of resource_types
+    or their url matches one of url_patterns. Otherwise they're captured once the response
+    arrives if its content type starts with one of mime_types.
+    """
+    url_patterns: Optional[Pattern]
+    resource_types: FrozenSet[str]
+    mime_types: Tuple[str, ...]
+    child_frames_only: bool
+
+    _page: Optional[Page]
+    _ignore: Optional[Pattern]
+    _future: Optional[asyncio.Future]
+
+    def __init__(self, *, url_patterns: Tuple[str, ...] = (), resource_types: FrozenSet[str] = frozenset({"media"}),
+                 mime_types: Tuple[str, ...] = MEDIA_MIME_TYPES, child_frames_only: bool = False) -> None:
+        self.url_patterns = re.compile("|".join(url_patterns)) if url_patterns else None
+        self.resource_types = resource_types
+        self.mime_types = mime_types
+        self.child_frames_only = child_frames_only
+
+        self._page = None
+        self._ignore = None
+        self._future = None
+
+    def _is_candidate(self, request: InterceptedRequest) -> bool:
+        if self._ignore and self._ignore.search(request.url):
+            return False
+
+        if self.child_frames_only and request.frame is self._page.mainFrame:
+            return False
+
+        return True
+
+    def _capture(self, request: InterceptedRequest, mime_type: str = None) -> None:
+        if not self._future.done():
+            log.debug(f"captured {request.url}")
+            self._future.set_result(CapturedRequest(request.url, request.headers, mime_type))
+
+    def _on_request(self, request: InterceptedRequest) -> None:
+        if not self._is_candidate(request):
+            return
+
+        if request.resourceType in self.resource_types or (self.url_patterns and self.url_patterns.search(request.url)):
+            self._capture(request)
+
+    def _on_response(self, response: InterceptedResponse) -> None:
+        if not self.mime_types or not self._is_candidate(response.request):
+            return
+
+        mime_type = response.headers.get("content-type", "")
+        if mime_type.startswith(self.mime_types):
+            self._capture(response.request, mime_type.split(";", 1)[0])
+
+    def attach(self, page: Page, *, ignore: Pattern = None) -> None:
+        """Start watching the page.
+
+        :param ignore: requests whose url matches this pattern aren't captured
+        """
+        self._page = page
+        self._ignore = ignore
+        self._future = asyncio.get_event_loop().create_future()
+
+        page.on("request", self._on_request)
+        page.on("response", self._on_response)
+
+    def detach(self) -> None:
+        self._page.remove_listener("request", self._on_request)
+        self._page.remove_listener("response", self._on_response)
+        self._page = None
+
+    async def wait(self, timeout: float = None, *, loading: asyncio.Future = None) -> Optional[CapturedRequest]:
+        """Wait for a request to be captured.
+
+        :param loading: task loading the page, stop waiting if it fails
+        :return: the captured request or None if there wasn't one in time
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+
+        waiting = {self._future, loading} if loading else {self._future}
+        while not self._future.done():
+            remaining = None if deadline is None else max(deadline - loop.time(), 0)
+            done, waiting = await asyncio.wait(waiting, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+
+            if loading in done and not self._future.done() and loading.exception():
+                log.debug(f"loading the page failed: {loading.exception()!r}")
+                break
+
+        return self._future.result() if self._future.done() else None
+
+
+class PooledPage:
+    page: Page
+    uses: int
+    interceptor: Optional[Callable[[InterceptedRequest], None]]
+
+    def __init__(self, page: Page) -> None:
+        self.page = page
+        self.uses = 0
+        self.interceptor = None
+
+
+class BrowserManager:
+    """Keeps one browser connection per worker and a pool of pages to use.
+
+    At most max_pages pages are in use at once, others wait up to queue_timeout seconds for a page.
+    Pages are reused until they have been used max_uses times (or something went wrong while using them).
+    """
+    max_pages: int
+    max_uses: int
+    queue_timeout: float
+    external: bool
+
+    in_use: int
+    pages_created: int
+    pages_recycled: int
+    uses: int
+    timeouts: int
+
+    _connect: Callable[[], Awaitable[Browser]]
+    _browser: Optional[Browser]
+    _lock: Optional[asyncio.Lock]
+    _slots: Optional[asyncio.Semaphore]
+    _idle: List[PooledPage]
+
+    def __init__(self, connect: Callable[[], Awaitable[Browser]], *, max_pages: int, max_uses: int, queue_timeout: float,
+                 external: bool) -> None:
+        self.max_pages = max_pages
+        self.max_uses = max_uses
+        self.queue_timeout = queue_timeout
+        self.external = external
+
+        self.in_use = self.pages_created = self.pages_recycled = self.uses = self.timeouts = 0
+
+        self._connect = connect
+        self._browser = None
+        self._lock = None
+        self._slots = None
+        self._idle = []
+
+    def __repr__(self) -> str:
+        return f"<BrowserManager {len(self._idle)} idle page(s)>"
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pages)
+        return self._slots
+
+    async def get_browser(self) -> Browser:
+        async with self.lock:
+            if self._browser is None:
+                log.info("connecting to the browser")
+                browser = await self._connect()
+                browser.on("disconnected", lambda: self._on_disconnected(browser))
+                self._browser = browser
+
+            return self._browser
+
+    def _on_disconnected(self, browser: Browser) -> None:
+        if self._browser is browser:
+            log.warning("lost connection to the browser")
+            self._browser = None
+            self._idle.clear()
+
+    async def _new_page(self) -> PooledPage:
+        browser = await self.get_browser()
+        page = await browser.newPage()
+        self.pages_created += 1
+        return PooledPage(page)
+
+    async def _close_page(self, pooled: PooledPage) -> None:
+        self.pages_recycled += 1
+        try:
+            await pooled.page.close()
+        except Exception as e:
+            log.debug(f"couldn't close page: {e!r}")
+
+    async def acquire(self) -> PooledPage:
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise BrowserBusy(f"No browser page available after {self.queue_timeout} seconds")
+
+        try:
+            pooled = None
+            while self._idle and pooled is None:
+                pooled = self._idle.pop()
+                if pooled.page.isClosed():
+                    pooled = None
+
+            if pooled is None:
+                pooled = await self._new_page()
+        except BaseException:
+            self.slots.release()
+            raise
+
+        self.in_use += 1
+        return pooled
+
+    async def release(self, pooled: PooledPage, *, broken: bool = False) -> None:
+        pooled.uses += 1
+        self.uses += 1
+
+        try:
+            if broken or pooled.uses >= self.max_uses or pooled.page.isClosed() or self._browser is None:
+                await self._close_page(pooled)
+            else:
+                if pooled.interceptor:
+                    await self._stop_intercepting(pooled)
+
+                # don't leave the old page running in the background
+                await pooled.page.goto("about:blank")
+                self._idle.append(pooled)
+        except Exception as e:
+            log.debug(f"couldn't reset page: {e!r}")
+            await self._close_page(pooled)
+        finally:
+            self.in_use -= 1
+            self.slots.release()
+
+    @staticmethod
+    async def _start_intercepting(pooled: PooledPage, profile: BrowserProfile) -> None:
+        block_resources = profile.block_resources
+        block_pattern = profile.block_pattern
+
+        def intercept(request: InterceptedRequest) -> None:
+            if request.resourceType in block_resources or (block_pattern and block_pattern.search(request.url)):
+                asyncio.ensure_future(request.abort())
+            else:
+                asyncio.ensure_future(request.continue_())
+
+        await pooled.page.setRequestInterception(True)
+        pooled.page.on("request", intercept)
+        pooled.interceptor = intercept
+
+    @staticmethod
+    async def _stop_intercepting(pooled: PooledPage) -> None:
+        pooled.page.remove_listener("request", pooled.interceptor)
+        pooled.interceptor = None
+        await pooled.page.setRequestInterception(False)
+
+    @staticmethod
+    async def navigate(page: Page, url: str, profile: BrowserProfile) -> None:
+        timeout = profile.timeout * 1000
+        if profile.wait_for:
+            # the element might show up long before the load event
+            await page.goto(url, waitUntil="domcontentloaded", timeout=timeout)
+            await page.waitForSelector(profile.wait_for, timeout=timeout)
+        else:
+            await page.goto(url, waitUntil=profile.wait_until, timeout=timeout)
+
+    @contextlib.asynccontextmanager
+    async def page(self, url: str = None, profile: BrowserProfile = DEFAULT_PROFILE) -> AsyncIterator[Page]:
+        """Borrow a page (which has already navigated to the url using the profile if given)."""
+        pooled = await self.acquire()
+        broken = True
+
+        try:
+            if profile.intercepts:
+                await self._start_intercepting(pooled, profile)
+
+            if url:
+                await self.navigate(pooled.page, url, profile)
+
+            yield pooled.page
+            broken = False
+        finally:
+            # resetting the page shouldn't hold up the caller
+            do_later(self.release(pooled, broken=broken))
+
+    async def capture(self, url: str, capture: RequestCapture, profile: BrowserProfile = DEFAULT_PROFILE, *,
+                      trigger: Callable[[Page], Awaitable[Any]] = None, timeout: float = None) -> Optional[CapturedRequest]:
+        """Load the url and return the first request captured.
+
+        This doesn't wait for the page to finish loading, as soon as the request is seen the page is released.
+
+        :param trigger: called with the page after navigating, e.g. to click on a play button
+        :param timeout: time to wait for the request, defaults to the timeout of the profile
+        :return: the captured request or None if there wasn't one in time
+        """
+        async with self.page(profile=profile) as page:
+            capture.attach(page, ignore=profile.block_pattern)
+
+            async def load() -> None:
+                await self.navigate(page, url, profile)
+                if trigger:
+                    await trigger(page)
+
+            loading = asyncio.ensure_future(load())
+            try:
+                return await capture.wait(profile.timeout if timeout is None else timeout, loading=loading)
+            finally:
+                capture.detach()
+                if not loading.done():
+                    loading.cancel()
+                elif not loading.cancelled():
+                    # retrieve the exception so it isn't reported as never retrieved
+                    loading.exception()
+
+    async def warm(self, num_pages: int) -> None:
+        """Open pages in advance so the first requests don't have to wait for them."""
+        num_pages = min(num_pages, self.max_pages) - len(self._idle)
+        if num_pages <= 0:
+            return
+
+        pages = await asyncio.gather(*(self._new_page() for _ in range(num_pages)))
+        self._idle.extend(pages)
+        log.info(f"{self} warmed up")
+
+    async def close(self) -> None:
+        idle = self._idle
+        self._idle = []
+        await asyncio.gather(*(self._close_page(pooled) for pooled in idle))
+
+        browser = self._browser
+        self._browser = None
+        if browser:
+            if self.external:
+                await browser.disconnect()
+            else:
+                await browser.close()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(connected=self._browser is not None,
+                    idle=len(self._idle),
+                    in_use=self.in_use,
+                    pages_created=self.pages_created,
+                    pages_recycled=self.pages_recycled,
+                    uses=self.uses,
+                    timeouts=self.timeouts)
@@ -0,0 +1,328 @@
+import abc
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Generic, Hashable, Iterator, Optional, Tuple, TypeVar
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+log = logging.getLogger(__name__)
+
+KT = TypeVar("KT", bound=Hashable)
+VT = TypeVar("VT")
+
+_DEFAULT = object()
+
+
+class CacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+    def __init__(self) -> None:
+        self.reset()
+
+    def __repr__(self) -> str:
+        return f"<CacheStats hits={self.hits} misses={self.misses} evictions={self.evictions} expirations={self.expirations}>"
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def reset(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": round(self.hit_ratio, 4)}
+
+
+class LRUCache(Generic[KT, VT]):
+    """Bounded mapping which evicts the least recently used entry once full.
+
+    Every entry carries its own deadline (based on the monotonic clock) after which
+    it's treated as missing.
+    """
+    max_size: int
+    ttl: Optional[float]
+    stats: CacheStats
+
+    _data: "OrderedDict[KT, Tuple[VT, Optional[float]]]"
+
+    def __init__(self, max_size: int, *, ttl: float = None) -> None:
+        if max_size <= 0:
+            raise ValueError(f"max_size needs to be positive, not {max_size}")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = CacheStats()
+
+        self._data = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"<LRUCache {len(self._data)}/{self.max_size}>"
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: KT) -> bool:
+        return self.peek(key, _DEFAULT) is not _DEFAULT
+
+    def __iter__(self) -> Iterator[KT]:
+        return iter(list(self._data))
+
+    def _get_entry(self, key: KT) -> Any:
+        try:
+            value, deadline = self._data[key]
+        except KeyError:
+            return _DEFAULT
+
+        if deadline is not None and deadline <= time.monotonic():
+            del self._data[key]
+            self.stats.expirations += 1
+            return _DEFAULT
+
+        return value
+
+    def peek(self, key: KT, default: Any = None) -> Optional[VT]:
+        """Get the value without affecting the LRU order or the stats."""
+        value = self._get_entry(key)
+        return default if value is _DEFAULT else value
+
+    def get(self, key: KT, default: Any = None) -> Optional[VT]:
+        value = self._get_entry(key)
+        if value is _DEFAULT:
+            self.stats.misses += 1
+            return default
+
+        self.stats.hits += 1
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: KT, value: VT, *, ttl: float = _DEFAULT) -> None:
+        if ttl is _DEFAULT:
+            ttl = self.ttl
+
+        deadline = time.monotonic() + ttl if ttl is not None else None
+
+        self._data[key] = (value, deadline)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.stats.evictions += 1
+
+    def pop(self, key: KT, default: Any = None) -> Optional[VT]:
+        value = self._get_entry(key)
+        if value is _DEFAULT:
+            return default
+
+        del self._data[key]
+        return value
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+Document = Dict[str, Any]
+
+
+class Store(abc.ABC):
+    """Asynchronous key-value store for bson-serialisable documents."""
+
+    @abc.abstractmethod
+    async def get(self, key: str) -> Optional[Document]:
+        ...
+
+    @abc.abstractmethod
+    async def set(self, key: str, doc: Document, ttl: float) -> None:
+        ...
+
+    @abc.abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+
+class MemoryStore(Store):
+    """Store which only lives as long as the worker."""
+
+    def __init__(self, max_size: int) -> None:
+        self.cache = LRUCache(max_size)
+
+    def __repr__(self) -> str:
+        return f"<MemoryStore {self.cache}>"
+
+    async def get(self, key: str) -> Optional[Document]:
+        return self.cache.get(key)
+
+    async def set(self, key: str, doc: Document, ttl: float) -> None:
+        self.cache.set(key, doc, ttl=ttl)
+
+    async def delete(self, key: str) -> None:
+        self.cache.pop(key)
+
+
+class DiskStore(Store):
+    """Store keeping every document in a bson file which makes it available to all workers on the machine.
+
+    The modification time of a file is set to when it expires. Every sweep_every writes the expired files
+    are removed, as well as the ones expiring first if there are more than max_size.
+    """
+    directory: str
+    max_size: int
+    sweep_every: int
+
+    _writes: int
+
+    def __init__(self, directory: str, *, max_size: int, sweep_every: int = 100) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.sweep_every = sweep_every
+        os.makedirs(directory, exist_ok=True)
+
+        self._writes = 0
+
+    def __repr__(self) -> str:
+        return f"<DiskStore {self.directory}>"
+
+    def get_path(self, key: str) -> str:
+        name = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _read(self, key: str) -> Optional[Document]:
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                data = bson.BSON(f.read()).decode()
+        except FileNotFoundError:
+            return None
+        except (OSError, bson.InvalidBSON):
+            log.exception(f"{self} couldn't read {path}")
+            return None
+
+        if data["expires"] <= time.time():
+            self._delete(key)
+            return None
+
+        return data["doc"]
+
+    def _write(self, key: str, doc: Document, ttl: float) -> None:
+        path = self.get_path(key)
+        # write to a temporary file first so other workers never see a partial document
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        expires = time.time() + ttl
+        with open(tmp_path, "wb") as f:
+            f.write(bson.BSON.encode({"key": key, "doc": doc, "expires": expires}))
+
+        os.utime(tmp_path, (expires, expires))
+        os.replace(tmp_path, path)
+
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            self._sweep()
+
+    def _sweep(self) -> None:
+        now = time.time()
+        files = []
+
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    # leave the temporary files of other workers alone
+                    if entry.name.endswith(".tmp"):
+                        continue
+
+                    try:
+                        files.append((entry.stat().st_mtime, entry.path))
+                    except FileNotFoundError:
+                        continue
+        except OSError:
+            log.exception(f"{self} couldn't list its files")
+            return
+
+        files.sort()
+        expired = sum(1 for expires, _ in files if expires <= now)
+        remove = max(expired, len(files) - self.max_size)
+
+        for _, path in files[:remove]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        if remove:
+            log.debug(f"{self} removed {remove} file(s)")
+
+    def _delete(self, key: str) -> None:
+        try:
+            os.remove(self.get_path(key))
+        except FileNotFoundError:
+            pass
+
+    async def get(self, key: str) -> Optional[Document]:
+        return await asyncio.get_event_loop().run_in_executor(None, self._read, key)
+
+    async def set(self, key: str, doc: Document, ttl: float) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._write, key, doc, ttl)
+
+    async def delete(self, key: str) -> None:
+        await asyncio.get_event_loop().run_in_executor(None, self._delete, key)
+
+
+class MongoStore(Store):
+    """Store backed by a mongo collection, shared by all workers using the database."""
+    collection: AsyncIOMotorCollection
+
+    def __init__(self, collection: AsyncIOMotorCollection) -> None:
+        self.collection = collection
+
+    def __repr__(self) -> str:
+        return f"<MongoStore {self.collection.name}>"
+
+    @staticmethod
+    def get_id(key: str) -> str:
+        # keys may be longer than what mongo allows to be indexed
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    async def get(self, key: str) -> Optional[Document]:
+        data = await self.collection.find_one(self.get_id(key))
+        if not data:
+            return None
+
+        if data["expires"] <= datetime.utcnow():
+            return None
+
+        return data["doc"]
+
+    async def set(self, key: str, doc: Document, ttl: float) -> None:
+        expires = datetime.utcnow() + timedelta(seconds=ttl)
+        await self.collection.update_one({"_id": self.get_id(key)}, {"$set": {"key": key, "doc": doc, "expires": expires}}, upsert=True)
+
+    async def delete(self, key: str) -> None:
+        await self.collection.delete_one({"_id": self.get_id(key)})
+
+
+def create_store(kind: str, *, max_size: int, directory: str, collection: AsyncIOMotorCollection) -> Store:
+    """Create a store by name (memory, disk or mongo)."""
+    kind = kind.lower()
+    if kind == "memory":
+        return MemoryStore(max_size)
+    elif kind == "disk":
+        return DiskStore(directory, max_size=max_size)
+    elif kind == "mongo":
+        return MongoStore(collection)
+
+    raise ValueError(f"Unknown store \"{kind}\" (use memory, disk or mongo)")
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from aiohttp import ClientSession, TCPConnector, TraceConfig
+from aiohttp.tracing import TraceConnectionQueuedEndParams, TraceConnectionQueuedStartParams, TraceRequestEndParams, \
+    TraceRequestExceptionParams, TraceRequestStartParams
+
+log = logging.getLogger(__name__)
+
+
+class PoolConfig(NamedTuple):
+    """Settings of a connection pool.
+
+    limit is the total amount of connections the pool may open (0 for no limit)
+    and limit_per_host the amount of connections to a single host.
+    Idle connections are kept alive for keepalive seconds and resolved hosts cached for dns_ttl seconds.
+    """
+    limit: int = 100
+    limit_per_host: int = 10
+    keepalive: float = 30
+    dns_ttl: float = 5 * 60
+
+
+class PoolStats:
+    requests: int
+    failed: int
+    in_flight: int
+    queued: int
+    waited: int
+    total_wait: float
+    max_wait: float
+
+    def __init__(self) -> None:
+        self.requests = self.failed = self.in_flight = self.queued = self.waited = 0
+        self.total_wait = self.max_wait = 0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(requests=self.requests,
+                    failed=self.failed,
+                    in_flight=self.in_flight,
+                    queued=self.queued,
+                    waited=self.waited,
+                    average_wait=round(self.total_wait / self.waited, 4) if self.waited else 0,
+                    max_wait=round(self.max_wait, 4))
+
+
+class ConnectionPool:
+    """ClientSession with its own connector.
+
+    The session is created on first use (it has to be created inside the event loop)
+    and keeps track of how many requests had to wait for a free connection and for how long.
+    """
+    name: str
+    proxied: bool
+    config: PoolConfig
+    stats: PoolStats
+
+    _headers: Optional[Dict[str, str]]
+    _session: Optional[ClientSession]
+
+    def __init__(self, name: str, config: PoolConfig, *, proxied: bool = False, headers: Dict[str, str] = None) -> None:
+        self.name = name
+        self.proxied = proxied
+        self.config = config
+        self.stats = PoolStats()
+
+        self._headers = headers
+        self._session = None
+
+    def __repr__(self) -> str:
+        return f"<ConnectionPool {self.name}{' (proxied)' if self.proxied else ''}>"
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = self._create_session()
+
+        return self._session
+
+    def _create_session(self) -> ClientSession:
+        log.debug(f"creating {self}")
+        config = self.config
+        connector = TCPConnector(limit=config.limit, limit_per_host=config.limit_per_host, keepalive_timeout=config.keepalive,
+                                 use_dns_cache=True, ttl_dns_cache=config.dns_ttl)
+        return ClientSession(connector=connector, headers=self._headers, trace_configs=[self._create_trace_config()])
+
+    def _create_trace_config(self) -> TraceConfig:
+        stats = self.stats
+        trace_config = TraceConfig()
+
+        async def on_request_start(_, ctx: SimpleNamespace, params: TraceRequestStartParams) -> None:
+            stats.requests += 1
+            stats.in_flight += 1
+
+        async def on_request_end(_, ctx: SimpleNamespace, params: TraceRequestEndParams) -> None:
+            stats.in_flight -= 1
+
+        async def on_request_exception(_, ctx: SimpleNamespace, params: TraceRequestExceptionParams) -> None:
+            stats.in_flight -= 1
+            stats.failed += 1
+
+        async def on_connection_queued_start(_, ctx: SimpleNamespace, params: TraceConnectionQueuedStartParams) -> None:
+            stats.queued += 1
+            ctx.queued_at = asyncio.get_event_loop().time()
+
+        async def on_connection_queued_end(_, ctx: SimpleNamespace, params: TraceConnectionQueuedEndParams) -> None:
+            wait = asyncio.get_event_loop().time() - ctx.queued_at
+            stats.queued -= 1
+            stats.waited += 1
+            stats.total_wait += wait
+            stats.max_wait = max(stats.max_wait, wait)
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_queued_start.append(on_connection_queued_start)
+        trace_config.on_connection_queued_end.append(on_connection_queued_end)
+
+        return trace_config
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(name=self.name,
+                    proxied=self.proxied,
+                    open=self._session is not None and not self._session.closed,
+                    config=self.config._asdict(),
+                    **self.stats.as_dict())
+
+
+class ConnectionPools:
+    """Connection pools by name.
+
+    Proxied and direct traffic never share a pool and requests to hosts without a pool of their own
+    go to the default pool. HEAD requests (used to check whether links work) have their own pool
+    so they can't use up the connections needed to fetch pages.
+    """
+    DEFAULT = "default"
+    PROBE = "probe"
+
+    configs: Dict[str, PoolConfig]
+    headers: Optional[Dict[str, str]]
+
+    _pools: Dict[Tuple[str, bool], ConnectionPool]
+
+    def __init__(self, configs: Dict[str, PoolConfig] = None, *, headers: Dict[str, str] = None) -> None:
+        self.configs = {self.DEFAULT: PoolConfig(), **(configs or {})}
+        self.headers = headers
+
+        self._pools = {}
+
+    def __repr__(self) -> str:
+        return f"<ConnectionPools {len(self._pools)} open>"
+
+    def configure(self, name: str, config: PoolConfig) -> None:
+        self.configs[name] = config
+
+    def get(self, name: str = DEFAULT, *, proxied: bool = False) -> ConnectionPool:
+        if name not in self.configs:
+            name = self.DEFAULT
+
+        key = (name, proxied)
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = self._pools[key] = ConnectionPool(name, self.configs[name], proxied=proxied, headers=self.headers)
+
+        return pool
+
+    async def close(self) -> None:
+        pools = list(self._pools.values())
+        self._pools.clear()
+
+        await asyncio.gather(*(pool.close() for pool in pools))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {f"{pool.name}{'+proxy' if pool.proxied else ''}": pool.as_dict() for pool in self._pools.values()}
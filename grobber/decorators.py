@@ -21,17 +21,23 @@ def cached_property(func: Callable[..., Awaitable]) -> property:
         async with lock:
             val = getattr(self, cache_name, _DEFAULT)
 
+            if val is _DEFAULT and func.__name__ in getattr(self, "_unloaded", ()):
+                # the value might just not have been loaded from the database yet
+                await self.load_attrs(func.__name__)
+                val = getattr(self, cache_name, _DEFAULT)
+
             if val is _DEFAULT:
                 val = await func(self, *args, **kwargs)
 
                 setattr(self, cache_name, val)
 
-                try:
-                    func.__name__ in self.ATTRS
-                except AttributeError:
-                    pass
-                else:
-                    self._dirty = True
+                mark_dirty = getattr(self, "mark_dirty", None)
+                if mark_dirty and func.__name__ in self.ATTRS:
+                    mark_dirty(func.__name__)
+
+                mark_fetched = getattr(self, "mark_fetched", None)
+                if mark_fetched:
+                    mark_fetched(func.__name__)
 
         return val
 
@@ -41,7 +47,8 @@ def cached_property(func: Callable[..., Awaitable]) -> property:
 class _RefCounter(_AsyncGeneratorContextManager):
     def __init__(self, func, *args, **kwargs):
         super().__init__(func, args, kwargs)
-        self.ref_count = 1
+        self.ref_count = 0
+        self.closed = False
 
     async def __aenter__(self):
         self.ref_count += 1
@@ -51,6 +58,7 @@ class _RefCounter(_AsyncGeneratorContextManager):
         self.ref_count -= 1
 
         if self.ref_count <= 0:
+            self.closed = True
             await super().__aexit__(exc_type, exc_val, exc_tb)
 
     @cached_property
@@ -63,9 +71,9 @@ def cached_contextmanager(func: Callable[..., AsyncGenerator]) -> property:
 
     @wraps(func)
     def wrapper(self):
-        try:
-            ref = getattr(self, ref_name)
-        except AttributeError:
+        ref = getattr(self, ref_name, None)
+        if ref is None or ref.closed:
+            # the previous context has been exited by all of its users
             ref = _RefCounter(func, self)
             setattr(self, ref_name, ref)
 
@@ -0,0 +1,196 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Generic, NamedTuple, Optional, Sequence, Tuple, TypeVar
+
+log = logging.getLogger(__name__)
+
+C = TypeVar("C")
+T = TypeVar("T")
+
+Tier = Tuple[int, Sequence[C]]
+
+
+class TierTiming(NamedTuple):
+    """What happened to a tier during a resolution.
+
+    started is the amount of seconds after the start of the resolution at which the tier was started (None if it wasn't).
+    outcome is one of "working", "failed", "cancelled" or "skipped".
+    """
+    priority: int
+    candidates: int
+    started: Optional[float]
+    duration: Optional[float]
+    outcome: str
+
+
+class TierStats:
+    resolutions: int
+    working: int
+    failed: int
+    cancelled: int
+    skipped: int
+    total_time: float
+    max_time: float
+
+    def __init__(self) -> None:
+        self.resolutions = self.working = self.failed = self.cancelled = self.skipped = 0
+        self.total_time = self.max_time = 0
+
+    def record(self, timing: TierTiming) -> None:
+        self.resolutions += 1
+        setattr(self, timing.outcome, getattr(self, timing.outcome) + 1)
+
+        if timing.outcome in ("working", "failed"):
+            self.total_time += timing.duration
+            self.max_time = max(self.max_time, timing.duration)
+
+    def as_dict(self) -> Dict[str, Any]:
+        finished = self.working + self.failed
+        return dict(resolutions=self.resolutions,
+                    working=self.working,
+                    failed=self.failed,
+                    cancelled=self.cancelled,
+                    skipped=self.skipped,
+                    average_time=round(self.total_time / finished, 3) if finished else 0,
+                    max_time=round(self.max_time, 3))
+
+
+class HedgedResolver(Generic[C, T]):
+    """Find the first candidate of the best tier for which the probe returns something.
+
+    The tiers are ordered from best to worst and started one after another, every delay seconds
+    (or as soon as all started tiers failed). Once a tier found something, the better tiers
+    which are still running get window seconds to find something as well and no further tiers are started.
+    Everything which is still running once the result has been chosen is cancelled.
+    """
+    delay: float
+    window: float
+    stats: Dict[int, TierStats]
+
+    def __init__(self, *, delay: float, window: float) -> None:
+        self.delay = delay
+        self.window = window
+        self.stats = {}
+
+    def __repr__(self) -> str:
+        return f"<HedgedResolver delay={self.delay} window={self.window}>"
+
+    @staticmethod
+    async def _run_tier(candidates: Sequence[C], probe: Callable[[C], Awaitable[Optional[T]]]) -> Optional[T]:
+        tasks = [asyncio.ensure_future(probe(candidate)) for candidate in candidates]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                try:
+                    result = await fut
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    log.exception("Couldn't probe a candidate")
+                    continue
+
+                if result is not None:
+                    return result
+
+            return None
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def resolve(self, tiers: Sequence[Tier], probe: Callable[[C], Awaitable[Optional[T]]]) -> Optional[T]:
+        """Resolve the tiers.
+
+        :param tiers: priority and candidates of every tier, from best to worst
+        :param probe: function returning the result for a candidate, None if the candidate doesn't work
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+
+        running: Dict[int, asyncio.Future] = {}
+        results: Dict[int, T] = {}
+        started: Dict[int, float] = {}
+        finished: Dict[int, float] = {}
+        accept_at: Optional[float] = None
+
+        def start_tier() -> None:
+            index = len(started)
+            started[index] = loop.time()
+            running[index] = asyncio.ensure_future(self._run_tier(tiers[index][1], probe))
+
+        try:
+            while True:
+                best = min(results) if results else None
+
+                if best is not None:
+                    # nothing better can come anymore
+                    if all(index in finished for index in range(best)) or loop.time() >= accept_at:
+                        break
+                elif not running:
+                    if len(started) == len(tiers):
+                        break
+
+                    # the tiers which have been started failed already, no need to wait for the delay
+                    start_tier()
+                    continue
+
+                timeout = None
+                if best is not None:
+                    timeout = accept_at - loop.time()
+                elif len(started) < len(tiers):
+                    timeout = started[len(started) - 1] + self.delay - loop.time()
+
+                if timeout is None or timeout > 0:
+                    await asyncio.wait(list(running.values()), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                for index, task in list(running.items()):
+                    if not task.done():
+                        continue
+
+                    del running[index]
+                    finished[index] = loop.time()
+                    result = task.result()
+                    if result is not None:
+                        results[index] = result
+                        if accept_at is None:
+                            accept_at = loop.time() + self.window
+
+                if not results and running and len(started) < len(tiers) \
+                        and loop.time() >= started[len(started) - 1] + self.delay:
+                    start_tier()
+        finally:
+            for task in running.values():
+                task.cancel()
+
+            self._record(tiers, start, started, finished, results)
+
+        return results[min(results)] if results else None
+
+    def _record(self, tiers: Sequence[Tier], start: float, started: Dict[int, float], finished: Dict[int, float],
+                results: Dict[int, Any]) -> None:
+        now = asyncio.get_event_loop().time()
+        timings = []
+
+        for index, (priority, candidates) in enumerate(tiers):
+            if index not in started:
+                timing = TierTiming(priority, len(candidates), None, None, "skipped")
+            else:
+                end = finished.get(index, now)
+                if index in results:
+                    outcome = "working"
+                elif index in finished:
+                    outcome = "failed"
+                else:
+                    outcome = "cancelled"
+
+                timing = TierTiming(priority, len(candidates), started[index] - start, end - started[index], outcome)
+
+            timings.append(timing)
+            self.stats.setdefault(priority, TierStats()).record(timing)
+
+        log.debug("resolved tiers: " + ", ".join(f"{t.priority}: {t.outcome}"
+                                                 + (f" after {t.duration:.2f}s" if t.duration is not None else "")
+                                                 for t in timings))
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(delay=self.delay,
+                    window=self.window,
+                    tiers={str(priority): stats.as_dict() for priority, stats in sorted(self.stats.items(), reverse=True)})
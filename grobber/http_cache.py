@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import tempfile
+import time
+from typing import Any, Dict, NamedTuple, Optional
+
+import yarl
+from aiohttp import ClientResponse, ClientResponseError
+from multidict import CIMultiDict, CIMultiDictProxy
+
+from . import locals
+from .cache import Document, Store, create_store
+
+log = logging.getLogger(__name__)
+
+_HTTP_CACHE = os.getenv("HTTP_CACHE")
+_HTTP_CACHE_SIZE = int(os.getenv("HTTP_CACHE_SIZE", 1024))
+_HTTP_CACHE_DIR = os.getenv("HTTP_CACHE_DIR", os.path.join(tempfile.gettempdir(), "grobber-http-cache"))
+
+CACHEABLE_STATUS = {200, 203, 300, 301, 410}
+
+
+class CachePolicy(NamedTuple):
+    """Freshness policy for cached responses.
+
+    Responses younger than max_age are served without contacting the server.
+    After that they're revalidated using the ETag / Last-Modified headers until keep runs out.
+    """
+    max_age: float
+    keep: float = 24 * 60 * 60
+
+
+class CacheStatus:
+    HIT = "HIT"
+    REVALIDATED = "REVALIDATED"
+    MISS = "MISS"
+
+
+class CachedResponse:
+    """Stand-in for ClientResponse built from a cache entry."""
+    status: int
+    reason: str
+    url: yarl.URL
+    headers: CIMultiDictProxy
+
+    _body: bytes
+
+    def __init__(self, doc: Document) -> None:
+        self.status = doc["status"]
+        self.reason = doc.get("reason") or ""
+        self.url = yarl.URL(doc["url"])
+        self.headers = CIMultiDictProxy(CIMultiDict(doc["headers"]))
+        self._body = doc["body"]
+
+    def __repr__(self) -> str:
+        return f"<CachedResponse({self.url}) [{self.status} {self.reason}]>"
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get("Content-Type", "application/octet-stream").split(";", 1)[0].strip()
+
+    @property
+    def charset(self) -> Optional[str]:
+        for param in self.headers.get("Content-Type", "").split(";")[1:]:
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "charset":
+                return value.strip().strip("\"")
+        return None
+
+    def raise_for_status(self) -> None:
+        if self.status >= 400:
+            raise ClientResponseError(None, (), status=self.status, message=self.reason, headers=self.headers)
+
+    def release(self) -> None:
+        pass
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = None, errors: str = "strict") -> str:
+        return self._body.decode(encoding or self.charset or "utf-8", errors)
+
+    async def json(self, **_) -> Any:
+        return json.loads(await self.text())
+
+
+class ResponseCache:
+    store: Store
+
+    def __init__(self, store: Store) -> None:
+        self.store = store
+
+    def __repr__(self) -> str:
+        return f"<ResponseCache {self.store}>"
+
+    @staticmethod
+    def get_key(method: str, url: str) -> str:
+        return f"{method.upper()} {url}"
+
+    async def get(self, key: str) -> Optional[Document]:
+        try:
+            return await self.store.get(key)
+        except Exception:
+            log.exception(f"{self} couldn't get {key}")
+            return None
+
+    async def _set(self, key: str, doc: Document, policy: CachePolicy) -> None:
+        try:
+            await self.store.set(key, doc, policy.max_age + policy.keep)
+        except Exception:
+            log.exception(f"{self} couldn't store {key}")
+
+    @staticmethod
+    def is_fresh(doc: Document, policy: CachePolicy) -> bool:
+        return time.time() - doc["stored"] < policy.max_age
+
+    @staticmethod
+    def get_conditional_headers(doc: Document) -> Dict[str, str]:
+        headers = {}
+        if doc.get("etag"):
+            headers["If-None-Match"] = doc["etag"]
+        if doc.get("last_modified"):
+            headers["If-Modified-Since"] = doc["last_modified"]
+        return headers
+
+    async def store_response(self, key: str, resp: ClientResponse, policy: CachePolicy) -> None:
+        if resp.status not in CACHEABLE_STATUS:
+            return
+
+        if "no-store" in resp.headers.get("Cache-Control", ""):
+            log.debug(f"not caching {key} (no-store)")
+            return
+
+        doc = {"url": str(resp.url),
+               "status": resp.status,
+               "reason": resp.reason,
+               "headers": list(resp.headers.items()),
+               "body": await resp.read(),
+               "etag": resp.headers.get("ETag"),
+               "last_modified": resp.headers.get("Last-Modified"),
+               "stored": time.time()}
+
+        await self._set(key, doc, policy)
+
+    async def refresh(self, key: str, doc: Document, resp: ClientResponse, policy: CachePolicy) -> Document:
+        """Mark an entry as fresh again after the server answered with 304 not modified."""
+        doc = doc.copy()
+        doc["stored"] = time.time()
+        doc["etag"] = resp.headers.get("ETag", doc.get("etag"))
+        doc["last_modified"] = resp.headers.get("Last-Modified", doc.get("last_modified"))
+
+        await self._set(key, doc, policy)
+        return doc
+
+
+def _create_cache() -> Optional[ResponseCache]:
+    if not _HTTP_CACHE:
+        return None
+
+    store = create_store(_HTTP_CACHE, max_size=_HTTP_CACHE_SIZE, directory=_HTTP_CACHE_DIR, collection=locals.http_cache_collection)
+    return ResponseCache(store)
+
+
+HTTP_CACHE: Optional[ResponseCache] = _create_cache()
+
+if HTTP_CACHE:
+    log.info(f"Caching responses using {HTTP_CACHE}")
@@ -11,3 +11,11 @@ db: AsyncIOMotorDatabase = mongo_client[_MONGO_DB_NAME]
 anime_collection: AsyncIOMotorCollection = db["anime"]
 
 url_pool_collection: AsyncIOMotorCollection = db["url_pool"]
+
+http_cache_collection: AsyncIOMotorCollection = db["http_cache"]
+
+search_cache_collection: AsyncIOMotorCollection = db["search_cache"]
+
+proxy_routes_collection: AsyncIOMotorCollection = db["proxy_routes"]
+
+migrations_collection: AsyncIOMotorCollection = db["migrations"]
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, NamedTuple
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from . import locals
+
+log = logging.getLogger(__name__)
+
+SCHEMA_ID = "schema"
+LOCK_ID = "lock"
+LOCK_TTL = timedelta(minutes=5)
+# the lease is renewed this often while migrating so slow migrations don't lose it
+LOCK_RENEW_INTERVAL = LOCK_TTL / 3
+
+_OWNER = f"{os.getpid()}-{uuid.uuid4().hex}"
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    func: Callable[[], Awaitable[None]]
+
+
+MIGRATIONS: List[Migration] = []
+
+
+def migration(version: int):
+    def decorator(func: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError(f"There's already a migration with version {version}")
+
+        MIGRATIONS.append(Migration(version, func.__name__, func))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return func
+
+    return decorator
+
+
+@migration(1)
+async def create_anime_title_index() -> None:
+    await locals.anime_collection.create_index([("title", ASCENDING), ("language$state", ASCENDING), ("is_dub", ASCENDING)],
+                                               name="title_language_dub")
+
+
+@migration(2)
+async def create_anime_last_update_index() -> None:
+    await locals.anime_collection.create_index([("last_update", ASCENDING)], name="last_update")
+
+
+@migration(4)
+async def create_http_cache_expiry_index() -> None:
+    await locals.http_cache_collection.create_index([("expires", ASCENDING)], name="expires", expireAfterSeconds=0)
+
+
+@migration(5)
+async def create_search_cache_expiry_index() -> None:
+    await locals.search_cache_collection.create_index([("expires", ASCENDING)], name="expires", expireAfterSeconds=0)
+
+
+@migration(6)
+async def create_proxy_routes_expiry_index() -> None:
+    await locals.proxy_routes_collection.create_index([("expires", ASCENDING)], name="expires", expireAfterSeconds=0)
+
+
+@migration(7)
+async def create_anime_popularity_index() -> None:
+    await locals.anime_collection.create_index([("hits", DESCENDING), ("last_update", ASCENDING)], name="hits_last_update")
+
+
+@migration(8)
+async def drop_anime_title_text_index() -> None:
+    # created by a former migration 3, searches use the in-memory title index instead
+    try:
+        await locals.anime_collection.drop_index("title_text")
+    except OperationFailure as e:
+        # IndexNotFound
+        if e.code != 27:
+            raise
+
+
+async def acquire_lock() -> None:
+    while True:
+        now = datetime.utcnow()
+        try:
+            # only matches if the lease ran out, otherwise the upsert collides with the existing lease
+            await locals.migrations_collection.update_one({"_id": LOCK_ID, "expires": {"$lt": now}},
+                                                          {"$set": {"owner": _OWNER, "expires": now + LOCK_TTL}},
+                                                          upsert=True)
+        except DuplicateKeyError:
+            log.debug("waiting for another worker to finish migrating")
+            await asyncio.sleep(1)
+        else:
+            return
+
+
+async def renew_lock() -> None:
+    while True:
+        await asyncio.sleep(LOCK_RENEW_INTERVAL.total_seconds())
+
+        result = await locals.migrations_collection.update_one({"_id": LOCK_ID, "owner": _OWNER},
+                                                               {"$set": {"expires": datetime.utcnow() + LOCK_TTL}})
+        if not result.matched_count:
+            log.warning("lost the migration lock, another worker might be migrating as well")
+
+
+async def release_lock() -> None:
+    await locals.migrations_collection.delete_one({"_id": LOCK_ID, "owner": _OWNER})
+
+
+async def get_version() -> int:
+    doc = await locals.migrations_collection.find_one(SCHEMA_ID)
+    return doc["version"] if doc else 0
+
+
+async def migrate() -> None:
+    """Bring the database up to the latest version.
+
+    Every worker calls this on startup, a lease stored in the database makes sure
+    only one of them applies the migrations while the others wait.
+    The lease is renewed for as long as the migrations take.
+    """
+    latest = MIGRATIONS[-1].version if MIGRATIONS else 0
+    if await get_version() >= latest:
+        return
+
+    await acquire_lock()
+    renew_task = asyncio.ensure_future(renew_lock())
+    try:
+        version = await get_version()
+
+        for m in MIGRATIONS:
+            if m.version <= version:
+                continue
+
+            log.info(f"applying migration {m.version}: {m.name}")
+            await m.func()
+            await locals.migrations_collection.update_one({"_id": SCHEMA_ID}, {"$set": {"version": m.version, "updated": datetime.utcnow()}},
+                                                          upsert=True)
+            version = m.version
+    finally:
+        renew_task.cancel()
+        await release_lock()
+
+    log.info(f"database at version {latest}")
@@ -2,21 +2,26 @@ import abc
 import asyncio
 import inspect
 import logging
+import os
 import re
 import sys
-from difflib import SequenceMatcher
 from itertools import groupby
 from operator import attrgetter
-from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, MutableSequence, NamedTuple, NewType, Optional, TypeVar, Union
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, List, MutableMapping, MutableSequence, NamedTuple, \
+    NewType, Optional, Set, Type, TypeVar, Union
 
+from pyppeteer.page import Page
 from quart.routing import BaseConverter
 
+from .browser import BrowserProfile, CapturedRequest, DEFAULT_PROFILE, RequestCapture
 from .decorators import cached_property
 from .exceptions import EpisodeNotFound, StreamNotFound
+from .hedging import HedgedResolver
 from .languages import Language
 from .request import Request
-from .stateful import BsonType, Expiring
-from .utils import anext
+from .similarity import SIMILARITY
+from .stateful import BsonType, Expiring, TTL, join_path
+from .utils import SingleFlight, anext
 
 log = logging.getLogger(__name__)
 
@@ -37,24 +42,29 @@ T = TypeVar("T")
 
 
 async def get_first(coros: Iterable[Awaitable[T]], predicate: Callable[[T], Union[bool, Awaitable[bool]]] = bool) -> Optional[T]:
-    while coros:
-        done, coros = await asyncio.wait(coros, return_when=asyncio.FIRST_COMPLETED)
-        if done:
-            result = next(iter(done)).result()
-            res = predicate(result)
-            if inspect.isawaitable(res):
-                res = await res
-            if res:
-                for coro in coros:
-                    coro.cancel()
-
-                return result
+    tasks = {asyncio.ensure_future(coro) for coro in coros}
+    pending = tasks
+
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                res = predicate(result)
+                if inspect.isawaitable(res):
+                    res = await res
+                if res:
+                    return result
+    finally:
+        # also when the caller is cancelled
+        for task in tasks:
+            task.cancel()
 
     return None
 
 
 def get_certainty(a: str, b: str) -> float:
-    return round(SequenceMatcher(a=a, b=b).ratio(), 2)
+    return SIMILARITY.score(a, b)
 
 
 class SearchResult(NamedTuple):
@@ -74,11 +84,39 @@ class Source(NamedTuple):
     src: str
 
 
-class Stream(Expiring, abc.ABC):
+# Episodes are identified by the url of their page, so concurrent requests resolving the same episode
+# (even through different Episode instances) share the work.
+EPISODE_FLIGHT = SingleFlight("episodes")
+
+# A dead stream of a high priority shouldn't hold up the ones with a lower priority until it times out.
+STREAM_RESOLVER = HedgedResolver(delay=float(os.getenv("STREAM_HEDGE_DELAY", 2)),
+                                 window=float(os.getenv("STREAM_ACCEPT_WINDOW", 1)))
+
+
+class BrowserBacked:
+    """Models which might have to load their request in the browser.
+
+    BROWSER_PROFILE decides how the page is loaded.
+    """
+    BROWSER_PROFILE: BrowserProfile = DEFAULT_PROFILE
+
+    _req: Request
+
+    @property
+    def page(self) -> AsyncContextManager[Page]:
+        return self._req.use_profile(self.BROWSER_PROFILE).page
+
+    async def capture(self, capture: RequestCapture, *, trigger: Callable[[Page], Awaitable[Any]] = None,
+                      timeout: float = None) -> Optional[CapturedRequest]:
+        return await self._req.use_profile(self.BROWSER_PROFILE).capture(capture, trigger=trigger, timeout=timeout)
+
+
+class Stream(Expiring, BrowserBacked, abc.ABC):
     INCLUDE_CLS = True
     ATTRS = ("external", "links", "poster")
     CHANGING_ATTRS = ("links",)
     EXPIRE_TIME = Expiring.HOUR
+    HARD_EXPIRE_TIME = 3 * Expiring.HOUR
 
     PRIORITY = 100
 
@@ -134,7 +172,8 @@ class Stream(Expiring, abc.ABC):
         try:
             return len(await self.links) > 0
         except asyncio.CancelledError:
-            return False
+            # whoever cancelled it doesn't care, that doesn't mean it isn't working
+            raise
         except Exception:
             log.exception(f"{self} Couldn't fetch links")
             return False
@@ -187,10 +226,14 @@ class Stream(Expiring, abc.ABC):
                 "updated": self.last_update.isoformat()}
 
 
-class Episode(Expiring, abc.ABC):
+class Episode(Expiring, BrowserBacked, abc.ABC):
     ATTRS = ("stream", "host_url", "raw_streams", "streams", "poster", "host_url")
     CHANGING_ATTRS = ATTRS
     EXPIRE_TIME = 6 * Expiring.HOUR
+    HARD_EXPIRE_TIME = 3 * Expiring.DAY
+    # the embedded players hardly ever change, it's the links they provide which do
+    TTLS = {"raw_streams": TTL(2 * Expiring.DAY, 7 * Expiring.DAY),
+            "streams": TTL(2 * Expiring.DAY, 7 * Expiring.DAY)}
 
     def __init__(self, req: Request):
         super().__init__(req)
@@ -203,9 +246,10 @@ class Episode(Expiring, abc.ABC):
         if self._dirty:
             return True
         else:
-            if hasattr(self, "_streams"):
-                return any(stream.dirty for stream in self._streams)
-            return False
+            if hasattr(self, "_streams") and any(stream.dirty for stream in self._streams):
+                return True
+            stream = getattr(self, "_stream", None)
+            return bool(stream and stream.dirty)
 
     @dirty.setter
     def dirty(self, value: bool):
@@ -213,14 +257,37 @@ class Episode(Expiring, abc.ABC):
         if hasattr(self, "_streams"):
             for stream in self._streams:
                 stream.dirty = value
+        stream = getattr(self, "_stream", None)
+        if stream:
+            stream.dirty = value
+
+    def get_expiring(self, lead: float) -> List[Expiring]:
+        if not (hasattr(self, "_stream") or hasattr(self, "_streams")):
+            # nobody has asked for this episode so far
+            return []
+
+        if self.expires_in < lead:
+            return [self]
+
+        stream = getattr(self, "_stream", None)
+        return stream.get_expiring(lead) if stream else []
 
     @property
     @abc.abstractmethod
     async def raw_streams(self) -> List[str]:
         ...
 
+    @property
+    def flight_key(self) -> str:
+        return self._req._raw_url
+
     @cached_property
     async def streams(self) -> List[Stream]:
+        streams = await EPISODE_FLIGHT.do(("streams", self.flight_key), self._resolve_streams)
+        # everyone in the flight gets the same streams, each episode needs its own
+        return [stream.copy() for stream in streams]
+
+    async def _resolve_streams(self) -> List[Stream]:
         from .streams import get_stream
 
         links = await self.raw_streams
@@ -243,21 +310,24 @@ class Episode(Expiring, abc.ABC):
 
     @cached_property
     async def stream(self) -> Optional[Stream]:
+        stream = await EPISODE_FLIGHT.do(("stream", self.flight_key), self._resolve_stream)
+        return stream.copy() if stream else None
+
+    async def _resolve_stream(self) -> Optional[Stream]:
         log.debug(f"{self} Searching for working stream...")
 
-        all_streams = await self.streams
-        all_streams.sort(key=attrgetter("PRIORITY"), reverse=True)
+        all_streams = sorted(await self.streams, key=attrgetter("PRIORITY"), reverse=True)
 
-        for priority, streams in groupby(all_streams, attrgetter("PRIORITY")):
-            streams = list(streams)
-            log.info(f"Looking at {len(streams)} stream(s) with priority {priority}")
+        tiers = [(priority, list(streams)) for priority, streams in groupby(all_streams, attrgetter("PRIORITY"))]
+        log.info(f"Looking at {len(all_streams)} stream(s) in {len(tiers)} priority tier(s)")
 
-            working_stream = await get_first([stream.working_external_self for stream in streams])
-            if working_stream:
-                log.debug(f"Found working stream: {working_stream}")
-                return working_stream
+        working_stream = await STREAM_RESOLVER.resolve(tiers, attrgetter("working_external_self"))
+        if working_stream:
+            log.debug(f"Found working stream: {working_stream}")
+        else:
+            log.debug(f"No working stream for {self}")
 
-        log.debug(f"No working stream for {self}")
+        return working_stream
 
     async def get(self, index: int) -> Stream:
         streams = await self.streams
@@ -278,6 +348,19 @@ class Episode(Expiring, abc.ABC):
         elif key == "stream":
             return value.state
 
+    def get_nested_changes(self, path: Optional[str], to_set: Dict[str, BsonType], to_unset: Set[str]) -> None:
+        # the streams are stored as a (filtered) list so there's no stable path to a single stream
+        if "streams" not in self._dirty_attrs and hasattr(self, "_streams"):
+            if any(stream.dirty or not stream._persisted for stream in self._streams):
+                key, value = self.serialise_attr("streams")
+                to_set[join_path(path, key)] = value
+
+        stream = getattr(self, "_stream", None)
+        if "stream" not in self._dirty_attrs and stream and stream.dirty:
+            stream_set, stream_unset = stream.get_changes(join_path(path, "stream" + self._SPECIAL_MARKER))
+            to_set.update(stream_set)
+            to_unset.update(stream_unset)
+
     @classmethod
     def get_stream(cls, data: BsonType) -> Optional[Stream]:
         m, c = data["cls"].rsplit(".", 1)
@@ -305,15 +388,85 @@ class Episode(Expiring, abc.ABC):
                 "updated": self.last_update.isoformat()}
 
 
-class Anime(Expiring, abc.ABC):
+_RESOLVED_EPISODE_KEYS = {"stream", "stream$state", "streams", "streams$state"}
+
+
+class EpisodeMap(MutableMapping[int, Episode]):
+    """Mapping of episode index to Episode which only deserialises an episode once it's accessed.
+
+    Episodes which are never touched are serialised using the state they were loaded from.
+    """
+    _episode_cls: Type[Episode]
+    _raw: Dict[int, Dict[str, BsonType]]
+    _episodes: Dict[int, Episode]
+
+    def __init__(self, episode_cls: Type[Episode], raw: Dict[str, Dict[str, BsonType]] = None) -> None:
+        self._episode_cls = episode_cls
+        self._raw = {int(i): ep for i, ep in raw.items()} if raw else {}
+        self._episodes = {}
+
+    def __repr__(self) -> str:
+        return f"<EpisodeMap {len(self._episodes)}/{len(self)} loaded>"
+
+    def __getitem__(self, index: int) -> Episode:
+        try:
+            return self._episodes[index]
+        except KeyError:
+            pass
+
+        # from_state consumes the dict it's passed
+        ep = self._episode_cls.from_state(dict(self._raw[index]))
+        # only forget the raw state once the episode has been deserialised successfully
+        self._episodes[index] = ep
+        del self._raw[index]
+        return ep
+
+    def __setitem__(self, index: int, ep: Episode) -> None:
+        self._raw.pop(index, None)
+        self._episodes[index] = ep
+
+    def __delitem__(self, index: int) -> None:
+        if self._raw.pop(index, None) is None:
+            del self._episodes[index]
+
+    def __contains__(self, index: Any) -> bool:
+        return index in self._episodes or index in self._raw
+
+    def __len__(self) -> int:
+        return len(self._episodes) + len(self._raw)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(sorted(self._episodes.keys() | self._raw.keys()))
+
+    def loaded(self) -> Dict[int, Episode]:
+        """Get the episodes which have already been deserialised."""
+        return self._episodes
+
+    def iter_resolved(self) -> Iterator[Episode]:
+        """Iterate over the episodes whose streams have been looked for, only those are deserialised."""
+        for index in self:
+            if index in self._episodes or not _RESOLVED_EPISODE_KEYS.isdisjoint(self._raw[index]):
+                yield self[index]
+
+    def serialise(self) -> Dict[str, BsonType]:
+        data = {str(i): ep for i, ep in self._raw.items()}
+        data.update((str(i), ep.state) for i, ep in self._episodes.items())
+        return data
+
+
+class Anime(Expiring, BrowserBacked, abc.ABC):
     EPISODE_CLS = Episode
 
     INCLUDE_CLS = True
     ATTRS = ("id", "is_dub", "language", "title", "episode_count", "episodes", "last_update")
     CHANGING_ATTRS = ("episode_count",)
     EXPIRE_TIME = 30 * Expiring.MINUTE  # 30 mins should be fine, right?
+    HARD_EXPIRE_TIME = Expiring.DAY
 
-    _episodes: Dict[int, EPISODE_CLS]
+    # attributes required by to_dict
+    DICT_ATTRS = ("is_dub", "language", "title", "episode_count", "last_update", "fetched")
+
+    _episodes: EpisodeMap
 
     def __bool__(self) -> bool:
         return True
@@ -344,16 +497,25 @@ class Anime(Expiring, abc.ABC):
             return True
         else:
             if hasattr(self, "_episodes"):
-                return any(ep.dirty for ep in self._episodes.values())
+                return any(ep.dirty or not ep._persisted for ep in self._episodes.loaded().values())
             return False
 
     @dirty.setter
     def dirty(self, value: bool):
         self._dirty = value
         if hasattr(self, "_episodes"):
-            for ep in self._episodes.values():
+            for ep in self._episodes.loaded().values():
                 ep.dirty = value
 
+    def get_expiring(self, lead: float) -> List[Expiring]:
+        expiring = super().get_expiring(lead)
+
+        if hasattr(self, "_episodes"):
+            for ep in self._episodes.iter_resolved():
+                expiring.extend(ep.get_expiring(lead))
+
+        return expiring
+
     @cached_property
     async def uid(self) -> UID:
         name = RE_UID_CLEANER.sub("", type(self).__name__.lower())
@@ -392,7 +554,9 @@ class Anime(Expiring, abc.ABC):
         return len(await self.get_episodes())
 
     @property
-    async def episodes(self) -> Dict[int, EPISODE_CLS]:
+    async def episodes(self) -> EpisodeMap:
+        await self.load_attrs("episodes")
+
         if hasattr(self, "_episodes"):
             if len(self._episodes) != await self.episode_count:
                 log.info(f"{self} doesn't have all episodes. updating!")
@@ -402,11 +566,14 @@ class Anime(Expiring, abc.ABC):
                         self._episodes[i] = await self.get_episode(i)
         else:
             eps = await self.get_episodes()
-            self._episodes = dict(enumerate(eps))
+            self._episodes = EpisodeMap(self.EPISODE_CLS)
+            self._episodes.update(enumerate(eps))
 
         return self._episodes
 
     async def get(self, index: int) -> EPISODE_CLS:
+        await self.load_attrs("episodes")
+
         if hasattr(self, "_episodes"):
             ep = self._episodes.get(index)
             if ep is not None:
@@ -441,13 +608,24 @@ class Anime(Expiring, abc.ABC):
 
     def serialise_special(self, key: str, value: Any) -> BsonType:
         if key == "episodes":
-            return {str(i): ep.state for i, ep in value.items()}
+            return value.serialise()
         elif key == "language":
             return value.value
 
+    def get_nested_changes(self, path: Optional[str], to_set: Dict[str, BsonType], to_unset: Set[str]) -> None:
+        if "episodes" in self._dirty_attrs or not hasattr(self, "_episodes"):
+            return
+
+        episodes_path = join_path(path, "episodes" + self._SPECIAL_MARKER)
+        for i, ep in self._episodes.loaded().items():
+            if ep.dirty or not ep._persisted:
+                ep_set, ep_unset = ep.get_changes(join_path(episodes_path, str(i)))
+                to_set.update(ep_set)
+                to_unset.update(ep_unset)
+
     @classmethod
     def deserialise_special(cls, key: str, value: BsonType) -> Any:
         if key == "episodes":
-            return {int(i): cls.EPISODE_CLS.from_state(ep) for i, ep in value.items()}
+            return EpisodeMap(cls.EPISODE_CLS, value)
         elif key == "language":
             return Language(value)
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .stateful import Stateful
+
+log = logging.getLogger(__name__)
+
+
+class WriteBehindPersister:
+    """Collect dirty objects and write them to the database in batches.
+
+    A batch is written once batch_size objects are waiting or flush_interval seconds have passed.
+    When more than max_pending objects are waiting, enqueue blocks until they're written.
+    Objects which the database rejects are dropped, the ones of a batch which couldn't be written
+    at all are retried up to max_retries times.
+    """
+    collection: AsyncIOMotorCollection
+    batch_size: int
+    flush_interval: float
+    max_pending: int
+    max_retries: int
+
+    saved: int
+    batches: int
+    dropped: int
+
+    _pending: Dict[Any, Stateful]
+    _failures: Dict[Any, int]
+    _flush_lock: Optional[asyncio.Lock]
+    _flush_task: Optional[asyncio.Future]
+    _closed: bool
+
+    def __init__(self, collection: AsyncIOMotorCollection, *, batch_size: int = 100, flush_interval: float = 2, max_pending: int = 1000,
+                 max_retries: int = 3) -> None:
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+
+        self.saved = 0
+        self.batches = 0
+        self.dropped = 0
+
+        self._pending = {}
+        self._failures = {}
+        self._flush_lock = None
+        self._flush_task = None
+        self._closed = False
+
+    def __repr__(self) -> str:
+        return f"<WriteBehindPersister {self.collection.name}: {len(self._pending)} pending>"
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        # created lazily so it's bound to the loop which is actually running
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        return self._flush_lock
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"pending": len(self._pending),
+                "saved": self.saved,
+                "batches": self.batches,
+                "dropped": self.dropped}
+
+    def get_update(self, obj: Stateful) -> Dict[str, Any]:
+        to_set, to_unset = obj.get_changes()
+
+        update = {}
+        if to_set:
+            update["$set"] = to_set
+        if to_unset:
+            update["$unset"] = dict.fromkeys(to_unset, "")
+        return update
+
+    async def enqueue(self, key: Any, obj: Stateful) -> None:
+        self._pending[key] = obj
+
+        if not self._closed and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self._flush_periodically())
+
+        if len(self._pending) >= self.max_pending:
+            log.warning(f"{self} too many pending writes, waiting for flush")
+            while len(self._pending) >= self.max_pending:
+                if not await self.flush():
+                    break
+        elif len(self._pending) >= self.batch_size:
+            await self.flush()
+
+    def discard(self, key: Any) -> None:
+        """Forget the pending write of the object (for example because it has been deleted)."""
+        self._pending.pop(key, None)
+        self._failures.pop(key, None)
+
+    def _take_batch(self) -> List[Tuple[Any, Stateful]]:
+        batch = []
+        for key in list(self._pending)[:self.batch_size]:
+            batch.append((key, self._pending.pop(key)))
+        return batch
+
+    async def flush(self) -> int:
+        """Write one batch of pending objects.
+
+        :return: amount of objects written
+        """
+        async with self.lock:
+            batch = self._take_batch()
+            if not batch:
+                return 0
+
+            ops = []
+            op_keys = []
+            for key, obj in batch:
+                update = self.get_update(obj)
+                if update:
+                    ops.append(UpdateOne({"_id": key}, update, upsert=True))
+                    op_keys.append(key)
+                obj.dirty = False
+
+            if not ops:
+                return len(batch)
+
+            try:
+                await self.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError as e:
+                # the other operations went through, retrying the rejected ones would only fail again
+                rejected = {op_keys[error["index"]] for error in e.details.get("writeErrors", [])}
+                log.error(f"{self} dropping {len(rejected)} rejected write(s): {e.details.get('writeErrors')}")
+                self.dropped += len(rejected)
+                for key, obj in batch:
+                    if key in rejected:
+                        # whatever is written next has to be the complete document
+                        obj._persisted = False
+                        self._failures.pop(key, None)
+                batch = [(key, obj) for key, obj in batch if key not in rejected]
+            except asyncio.CancelledError:
+                # the write may or may not have happened, it's not the fault of the documents though
+                self._requeue(batch, failed=False)
+                raise
+            except Exception:
+                log.exception(f"{self} couldn't write batch of {len(batch)}, requeueing")
+                self._requeue(batch)
+                return 0
+
+            for key, _ in batch:
+                self._failures.pop(key, None)
+
+            self.saved += len(batch)
+            self.batches += 1
+            log.debug(f"{self} wrote batch of {len(batch)}")
+            return len(batch)
+
+    def _requeue(self, batch: List[Tuple[Any, Stateful]], *, failed: bool = True) -> None:
+        for key, obj in batch:
+            if failed:
+                failures = self._failures.get(key, 0) + 1
+                if failures > self.max_retries:
+                    log.error(f"{self} giving up on {key} after {failures} failed writes")
+                    self._failures.pop(key, None)
+                    self.dropped += 1
+                    continue
+
+                self._failures[key] = failures
+
+            # the changes are lost, so write the complete document next time
+            obj._persisted = False
+            obj.dirty = True
+            self._pending.setdefault(key, obj)
+
+    async def flush_all(self) -> None:
+        while self._pending:
+            if not await self.flush():
+                break
+
+    async def _flush_periodically(self) -> None:
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush_all()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception(f"{self} couldn't flush")
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._flush_task:
+            self._flush_task.cancel()
+            # a batch it was writing is put back when it's cancelled
+            await asyncio.wait([self._flush_task])
+
+        await self.flush_all()
+        log.info(f"{self} closed after writing {self.saved} in {self.batches} batch(es)")
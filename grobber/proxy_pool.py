@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Callable, Collection, Dict, Iterable, List, Optional
+
+from aiohttp import ClientSession
+
+log = logging.getLogger(__name__)
+
+# weight of a new measurement in the moving averages
+_ALPHA = .2
+
+
+class Proxy:
+    """A proxy and how well it has been working."""
+    url: str
+    static: bool
+
+    latency: float
+    success_rate: float
+    active: int
+    failures: int
+    ejected_until: float
+
+    def __init__(self, url: str, *, static: bool = False, latency: float = 1) -> None:
+        self.url = url
+        self.static = static
+
+        self.latency = latency
+        self.success_rate = 1
+        self.active = 0
+        self.failures = 0
+        self.ejected_until = 0
+
+    def __repr__(self) -> str:
+        return f"<Proxy {self.url} score={self.score:.2f}>"
+
+    @property
+    def score(self) -> float:
+        return self.success_rate ** 2 / max(self.latency, .05)
+
+    @property
+    def ejected(self) -> bool:
+        return self.ejected_until > time.time()
+
+    def record(self, success: bool, latency: float = None) -> None:
+        self.success_rate += _ALPHA * (success - self.success_rate)
+        if success and latency is not None:
+            self.latency += _ALPHA * (latency - self.latency)
+
+        self.failures = 0 if success else self.failures + 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(latency=round(self.latency, 3),
+                    success_rate=round(self.success_rate, 3),
+                    score=round(self.score, 3),
+                    active=self.active,
+                    ejected=self.ejected,
+                    static=self.static)
+
+
+class ProxyPool:
+    """Proxies to distribute the proxied requests between.
+
+    Proxies are picked at random weighted by their score (based on their success rate and latency)
+    and may only handle max_concurrency requests at once.
+    After eject_after consecutive failures a proxy isn't used for eject_for seconds.
+
+    Apart from the static proxies, proxies can be pulled from a Scylla instance.
+    """
+    max_concurrency: int
+    eject_after: int
+    eject_for: float
+
+    scylla_url: Optional[str]
+    scylla_interval: float
+
+    _proxies: Dict[str, Proxy]
+    _available: asyncio.Condition
+    _get_session: Callable[[], ClientSession]
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, urls: Iterable[str] = (), *, max_concurrency: int, eject_after: int, eject_for: float,
+                 scylla_url: str = None, scylla_interval: float = 5 * 60, get_session: Callable[[], ClientSession] = None) -> None:
+        self.max_concurrency = max_concurrency
+        self.eject_after = eject_after
+        self.eject_for = eject_for
+
+        self.scylla_url = scylla_url
+        self.scylla_interval = scylla_interval
+
+        self._proxies = {url: Proxy(url, static=True) for url in urls}
+        self._available = None
+        self._get_session = get_session
+        self._task = None
+
+    def __repr__(self) -> str:
+        return f"<ProxyPool {len(self._proxies)} proxies>"
+
+    def __len__(self) -> int:
+        return len(self._proxies)
+
+    def __bool__(self) -> bool:
+        return bool(self._proxies or self.scylla_url)
+
+    @property
+    def available(self) -> asyncio.Condition:
+        # created lazily so it belongs to the running loop
+        if self._available is None:
+            self._available = asyncio.Condition()
+        return self._available
+
+    def _choose(self, exclude: Collection[Proxy]) -> Optional[Proxy]:
+        candidates = [proxy for proxy in self._proxies.values() if proxy not in exclude and not proxy.ejected]
+        if not candidates:
+            # all of them are broken, better try one of them than none at all
+            candidates = [proxy for proxy in self._proxies.values() if proxy not in exclude]
+
+        candidates = [proxy for proxy in candidates if proxy.active < self.max_concurrency]
+        if not candidates:
+            return None
+
+        return random.choices(candidates, weights=[proxy.score for proxy in candidates])[0]
+
+    async def acquire(self, exclude: Collection[Proxy] = ()) -> Optional[Proxy]:
+        """Get a proxy to use, waiting for one of them to be free.
+
+        :return: None if there are no proxies (except those excluded)
+        """
+        async with self.available:
+            while True:
+                if not any(proxy not in exclude for proxy in self._proxies.values()):
+                    return None
+
+                proxy = self._choose(exclude)
+                if proxy:
+                    proxy.active += 1
+                    return proxy
+
+                await self.available.wait()
+
+    async def release(self, proxy: Proxy, success: Optional[bool], latency: float = None) -> None:
+        """Give the proxy back.
+
+        :param success: whether the request worked using the proxy, None if it didn't finish (it was cancelled)
+        """
+        proxy.active -= 1
+        if success is not None:
+            proxy.record(success, latency)
+
+        if proxy.failures >= self.eject_after and not proxy.ejected:
+            log.warning(f"{proxy} failed {proxy.failures} times in a row, ejecting it for {self.eject_for} seconds")
+            proxy.ejected_until = time.time() + self.eject_for
+            proxy.failures = 0
+
+        async with self.available:
+            self.available.notify()
+
+    def update(self, urls: Dict[str, float]) -> None:
+        """Replace the non-static proxies.
+
+        :param urls: url of the proxies and their initial latency
+        """
+        for url, proxy in list(self._proxies.items()):
+            if not proxy.static and url not in urls:
+                del self._proxies[url]
+
+        for url, latency in urls.items():
+            if url not in self._proxies:
+                self._proxies[url] = Proxy(url, latency=latency)
+
+    async def fetch_scylla(self) -> Dict[str, float]:
+        session = self._get_session()
+        async with session.get(f"{self.scylla_url.rstrip('/')}/api/v1/proxies", params=dict(https="true", limit=50)) as resp:
+            resp.raise_for_status()
+            data = await resp.json()
+
+        # scylla measures the latency in milliseconds
+        return {f"http://{proxy['ip']}:{proxy['port']}": proxy.get("latency", 1000) / 1000
+                for proxy in data["proxies"] if proxy.get("is_valid", True)}
+
+    def start(self) -> None:
+        if self.scylla_url and self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self.update(await self.fetch_scylla())
+            except Exception:
+                log.exception(f"{self} couldn't get proxies from scylla")
+            else:
+                log.debug(f"{self} updated from scylla")
+                async with self.available:
+                    self.available.notify_all()
+
+            await asyncio.sleep(self.scylla_interval)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {url: proxy.as_dict() for url, proxy in self._proxies.items()}
+
+
+def parse_proxy_urls(raw: Optional[str]) -> List[str]:
+    if not raw:
+        return []
+    return [url.strip() for url in raw.split(",") if url.strip()]
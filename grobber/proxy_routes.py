@@ -0,0 +1,116 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Any, Dict, NamedTuple, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from .utils import do_later
+
+log = logging.getLogger(__name__)
+
+
+class Route(NamedTuple):
+    expires: float
+    next_probe: float
+
+
+class ProxyRoutes:
+    """Hosts which block direct requests and have to be accessed through the proxy.
+
+    A host is added when it answers with 403 and forgotten after ttl seconds unless it keeps blocking us.
+    Every probe_interval seconds one request is sent directly to check whether the host still blocks us.
+    The routes are stored in the database so all workers share them.
+    """
+    collection: AsyncIOMotorCollection
+    ttl: float
+    probe_interval: float
+    sync_interval: float
+
+    _routes: Dict[str, Route]
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, collection: AsyncIOMotorCollection, *, ttl: float, probe_interval: float, sync_interval: float) -> None:
+        self.collection = collection
+        self.ttl = ttl
+        self.probe_interval = probe_interval
+        self.sync_interval = sync_interval
+
+        self._routes = {}
+        self._task = None
+
+    def __repr__(self) -> str:
+        return f"<ProxyRoutes {len(self._routes)} host(s)>"
+
+    def needs_proxy(self, host: str) -> bool:
+        route = self._routes.get(host)
+        if route is None:
+            return False
+
+        now = time.time()
+        if route.expires <= now:
+            del self._routes[host]
+            return False
+
+        if route.next_probe <= now:
+            log.debug(f"probing direct route to {host}")
+            self._routes[host] = route._replace(next_probe=now + self.probe_interval)
+            return False
+
+        return True
+
+    def mark_blocked(self, host: str) -> None:
+        now = time.time()
+        route = Route(now + self.ttl, now + self.probe_interval)
+
+        if host not in self._routes:
+            log.info(f"routing requests to {host} through the proxy")
+
+        self._routes[host] = route
+        do_later(self.collection.update_one({"_id": host},
+                                            {"$set": {"expires": datetime.utcfromtimestamp(route.expires)}},
+                                            upsert=True))
+
+    def mark_direct(self, host: str) -> None:
+        if self._routes.pop(host, None) is None:
+            return
+
+        log.info(f"{host} can be accessed directly again")
+        do_later(self.collection.delete_one({"_id": host}))
+
+    async def load(self) -> None:
+        docs = await self.collection.find({"expires": {"$gt": datetime.utcnow()}}).to_list(None)
+
+        now = time.time()
+        routes = {}
+        for doc in docs:
+            # the expiry dates are naive utc datetimes
+            expires = (doc["expires"] - datetime(1970, 1, 1)).total_seconds()
+            route = self._routes.get(doc["_id"])
+            routes[doc["_id"]] = Route(expires, route.next_probe if route else now + self.probe_interval)
+
+        self._routes = routes
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.load()
+            except Exception:
+                log.exception(f"{self} couldn't load routes")
+
+            await asyncio.sleep(self.sync_interval)
+
+    def as_dict(self) -> Dict[str, Any]:
+        now = time.time()
+        return {host: dict(expires_in=round(route.expires - now), probe_in=round(max(route.next_probe - now, 0)))
+                for host, route in self._routes.items()}
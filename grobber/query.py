@@ -1,17 +1,22 @@
 import abc
 import asyncio
 import logging
+import os
 import typing
 from operator import attrgetter
-from typing import Any, List, NamedTuple, Optional
+from typing import Any, AsyncIterator, Iterable, List, NamedTuple, Optional, Tuple, Type
 
 from quart import request
 
 from . import languages, sources
 from .exceptions import AnimeNotFound, InvalidRequest, SourceNotFound, UIDUnknown
 from .languages import Language
+from .cache import LRUCache
 from .models import Anime, Episode, SearchResult, Stream, UID
-from .utils import fuzzy_bool
+from .search_cache import CachedSearch, SEARCH_CACHE
+from .search_index import normalise_title
+from .sources import SearchReport
+from .utils import SingleFlight, anext, do_later, fuzzy_bool
 
 log = logging.getLogger(__name__)
 
@@ -60,7 +65,7 @@ class AnimeQuery(metaclass=abc.ABCMeta):
             ...
 
         @abc.abstractmethod
-        async def resolve(self) -> Anime:
+        async def resolve(self, attrs: Iterable[str] = None) -> Anime:
             ...
 
     class UID(_Generic):
@@ -69,11 +74,11 @@ class AnimeQuery(metaclass=abc.ABCMeta):
         async def search_params(self) -> SearchFilter:
             raise InvalidRequest("Can't search using a UID")
 
-        async def resolve(self) -> Anime:
+        async def resolve(self, attrs: Iterable[str] = None) -> Anime:
             if not self.uid:
                 raise InvalidRequest("")
 
-            anime = await sources.get_anime(self.uid)
+            anime = await sources.get_anime(self.uid, attrs)
             if anime:
                 return anime
             else:
@@ -91,8 +96,8 @@ class AnimeQuery(metaclass=abc.ABCMeta):
         async def search_params(self) -> SearchFilter:
             return SearchFilter(self.language or Language.ENGLISH, bool(self.dubbed))
 
-        async def resolve(self) -> Anime:
-            filters = dict()
+        async def resolve(self, attrs: Iterable[str] = None) -> Anime:
+            filters = dict(attrs=attrs)
 
             if self.dubbed is not None:
                 filters["dubbed"] = self.dubbed
@@ -117,9 +122,9 @@ class AnimeQuery(metaclass=abc.ABCMeta):
                              "or a title (anime), language and dubbed value")
 
 
-def _get_int_param(name: str, default: Any = _DEFAULT) -> int:
+def _get_param(name: str, typ: Type, default: Any = _DEFAULT) -> Any:
     try:
-        value = request.args.get(name, type=int)
+        value = request.args.get(name, type=typ)
     except TypeError:
         value = None
 
@@ -131,7 +136,192 @@ def _get_int_param(name: str, default: Any = _DEFAULT) -> int:
     return value
 
 
-async def search_anime() -> List[SearchResult]:
+def _get_int_param(name: str, default: Any = _DEFAULT) -> int:
+    return _get_param(name, int, default)
+
+
+def _get_float_param(name: str, default: Any = _DEFAULT) -> float:
+    return _get_param(name, float, default)
+
+
+# attributes shown for every search result
+SEARCH_RESULT_ATTRS = tuple(set(Anime.ATTRS) - {"episodes"})
+
+# time (in seconds) a search may take unless the request specifies a timeout, slower sources are cancelled
+SEARCH_TIMEOUT = float(os.getenv("SEARCH_TIMEOUT", 10))
+MAX_SEARCH_TIMEOUT = 30
+
+# a local search result with at least this certainty is good enough to skip the sources
+LOCAL_SEARCH_CERTAINTY = 0.8
+# don't search the sources in the background for the same query more often than this (in seconds)
+LOCAL_SEARCH_REFRESH_INTERVAL = 10 * 60
+
+_RECENT_LIVE_SEARCHES = LRUCache(1024, ttl=LOCAL_SEARCH_REFRESH_INTERVAL)
+
+
+async def preload_results(results: List[SearchResult], timeout: float = None) -> List[SearchResult]:
+    """Preload the attributes of the search results.
+
+    Results which can't be loaded within the timeout are dropped.
+    """
+    if not results:
+        return []
+
+    tasks = [asyncio.ensure_future(result.anime.preload_attrs(*SEARCH_RESULT_ATTRS)) for result in results]
+    done, pending = await asyncio.wait(tasks, timeout=timeout)
+
+    for task in pending:
+        task.cancel()
+
+    if pending:
+        log.info(f"dropping {len(pending)} search result(s) which took too long to load")
+
+    loaded = []
+    for result, task in zip(results, tasks):
+        if task in done:
+            task.result()
+            loaded.append(result)
+
+    return loaded
+
+
+def _get_deadline(timeout: Optional[float]) -> Optional[float]:
+    if timeout is None:
+        return None
+    return asyncio.get_event_loop().time() + timeout
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_event_loop().time(), 0)
+
+
+async def search_sources(query: str, filters: SearchFilter, num_results: int, *, timeout: float = None,
+                         report: SearchReport = None) -> List[SearchResult]:
+    consider_results = max(num_results, 3)
+    deadline = _get_deadline(timeout)
+
+    result_iter = sources.search_anime(query, language=filters.language, dubbed=filters.dubbed, deadline=deadline, report=report)
+
+    results_pool = []
+    try:
+        async for result in result_iter:
+            results_pool.append(result)
+
+            if len(results_pool) >= consider_results:
+                break
+    finally:
+        await result_iter.aclose()
+
+    results = sorted(results_pool, key=attrgetter("certainty"), reverse=True)[:num_results]
+    results = await preload_results(results, _remaining(deadline))
+    await asyncio.gather(*(sources.index_anime(result.anime) for result in results))
+
+    _RECENT_LIVE_SEARCHES.set((normalise_title(query), filters), True)
+    return results
+
+
+async def iter_search_results(query: str, filters: SearchFilter, num_results: int, *, timeout: float = None,
+                              report: SearchReport = None) -> AsyncIterator[SearchResult]:
+    """Search the sources and yield the results as soon as they're loaded.
+
+    Unlike search_sources the results aren't ranked, they're yielded in the order they're found.
+    """
+    deadline = _get_deadline(timeout)
+
+    result_iter = sources.search_anime(query, language=filters.language, dubbed=filters.dubbed, deadline=deadline, report=report)
+
+    async def load(result: SearchResult) -> SearchResult:
+        await result.anime.preload_attrs(*SEARCH_RESULT_ATTRS)
+        await sources.index_anime(result.anime)
+        return result
+
+    next_result = asyncio.ensure_future(anext(result_iter, None))
+    loading = set()
+    found = 0
+
+    try:
+        while next_result or loading:
+            waiting = (loading | {next_result}) if next_result else loading
+            done, _ = await asyncio.wait(waiting, timeout=_remaining(deadline), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                log.info(f"search for \"{query}\" ran out of time, dropping {len(loading)} result(s) which are still loading")
+                break
+
+            for task in done:
+                if task is next_result:
+                    result = task.result()
+                    if result is None:
+                        next_result = None
+                        continue
+
+                    found += 1
+                    loading.add(asyncio.ensure_future(load(result)))
+                    next_result = asyncio.ensure_future(anext(result_iter, None)) if found < num_results else None
+                else:
+                    loading.remove(task)
+                    yield task.result()
+    finally:
+        for task in loading:
+            task.cancel()
+
+        if next_result:
+            next_result.cancel()
+            # the generator can't be closed while it's still running
+            await asyncio.wait([next_result])
+
+        await result_iter.aclose()
+
+    _RECENT_LIVE_SEARCHES.set((normalise_title(query), filters), True)
+
+
+async def find_anime(query: str, filters: SearchFilter, num_results: int, *, timeout: float = None,
+                     report: SearchReport = None) -> List[SearchResult]:
+    results = await sources.search_local(query, language=filters.language, dubbed=filters.dubbed, limit=num_results)
+
+    if len(results) >= num_results and results[0].certainty >= LOCAL_SEARCH_CERTAINTY:
+        log.debug(f"answering search for \"{query}\" from the local index")
+
+        if (normalise_title(query), filters) not in _RECENT_LIVE_SEARCHES:
+            # pick up new anime from the sources
+            _RECENT_LIVE_SEARCHES.set((normalise_title(query), filters), True)
+            do_later(search_sources(query, filters, num_results, timeout=timeout))
+
+        return await preload_results(results, timeout)
+
+    return await search_sources(query, filters, num_results, timeout=timeout, report=report)
+
+
+SEARCH_FLIGHT = SingleFlight("search")
+
+
+async def refresh_search(key: str, query: str, filters: SearchFilter, num_results: int,
+                         timeout: float = None) -> Tuple[List[SearchResult], SearchReport]:
+    report = SearchReport()
+    results = await find_anime(query, filters, num_results, timeout=timeout, report=report)
+
+    if report.timed_out:
+        log.debug(f"not caching search for \"{query}\", {report.timed_out} timed out")
+    else:
+        uids = await asyncio.gather(*(result.anime.uid for result in results))
+        await SEARCH_CACHE.set(key, [(uid, result.certainty) for uid, result in zip(uids, results)])
+
+    return results, report
+
+
+async def load_cached_search(cached: CachedSearch) -> Optional[List[SearchResult]]:
+    anime = await sources.get_many((uid for uid, _ in cached.results), Anime.DICT_ATTRS)
+    if len(anime) != len(cached.results):
+        # the anime haven't been saved yet
+        return None
+
+    results = [SearchResult(anime[uid], certainty) for uid, certainty in cached.results]
+    await asyncio.gather(*(result.anime.preload_attrs(*SEARCH_RESULT_ATTRS) for result in results))
+    return results
+
+
+async def get_search_params() -> Tuple[str, SearchFilter, int, float]:
     query = AnimeQuery.build()
     filters = await query.search_params()
 
@@ -145,25 +335,54 @@ async def search_anime() -> List[SearchResult]:
     if not (0 < num_results <= 20):
         raise InvalidRequest(f"Can only request up to 20 results (not {num_results})")
 
-    consider_results = max(num_results, 3)
+    timeout = _get_float_param("timeout", SEARCH_TIMEOUT)
+    if not (0 < timeout <= MAX_SEARCH_TIMEOUT):
+        raise InvalidRequest(f"timeout has to be between 0 and {MAX_SEARCH_TIMEOUT} seconds (not {timeout})")
 
-    result_iter = sources.search_anime(query, language=filters.language, dubbed=filters.dubbed)
+    return query, filters, num_results, timeout
 
-    results_pool = []
-    async for result in result_iter:
-        if len(results_pool) >= consider_results:
-            break
 
-        results_pool.append(result)
+async def search_anime(report: SearchReport = None) -> List[SearchResult]:
+    """Search for the anime specified by the request.
 
-    results = sorted(results_pool, key=attrgetter("certainty"), reverse=True)[:num_results]
-    await asyncio.gather(*(result.anime.preload_attrs(*(set(Anime.ATTRS) - {"episodes"})) for result in results))
+    :param report: filled with the outcome of the sources if they had to be searched
+    """
+    query, filters, num_results, timeout = await get_search_params()
+
+    key = SEARCH_CACHE.get_key(query, filters.language, filters.dubbed, num_results)
+
+    cached = await SEARCH_CACHE.get(key)
+    if cached:
+        results = await load_cached_search(cached)
+        if results is not None:
+            if cached.stale:
+                log.debug(f"serving stale search for \"{query}\", refreshing in the background")
+                do_later(SEARCH_FLIGHT.do((key, timeout), lambda: refresh_search(key, query, filters, num_results, timeout)))
+
+            return results
+
+    # searches with a different budget return different results, they can't be shared
+    results, search_report = await SEARCH_FLIGHT.do((key, timeout), lambda: refresh_search(key, query, filters, num_results, timeout))
+    if report is not None:
+        report.update(search_report)
+
+    return results
+
+
+async def stream_search(report: SearchReport = None) -> AsyncIterator[SearchResult]:
+    """Search the sources for the anime specified by the request and get an iterator of the results as they're found.
 
-    return results[:num_results]
+    The request is parsed right away so invalid requests raise before the first result.
+    """
+    query, filters, num_results, timeout = await get_search_params()
+    return iter_search_results(query, filters, num_results, timeout=timeout, report=report)
 
 
-async def get_anime(**kwargs) -> Anime:
-    return await AnimeQuery.build(**kwargs).resolve()
+async def get_anime(attrs: Iterable[str] = None, **kwargs) -> Anime:
+    anime = await AnimeQuery.build(**kwargs).resolve(attrs)
+    # popular anime are refreshed in the background
+    sources.REFRESHER.record_hit(await anime.uid)
+    return anime
 
 
 def get_episode_index() -> int:
@@ -0,0 +1,217 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import os
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class Priority:
+    """Priorities of requests waiting for a host, lower goes first."""
+    USER = 0
+    BACKGROUND = 10
+
+
+REQUEST_PRIORITY: ContextVar[int] = ContextVar("request_priority", default=Priority.USER)
+
+
+@contextlib.contextmanager
+def request_priority(priority: int) -> Iterator[None]:
+    """Set the priority of all requests made within the block (including tasks started in it)."""
+    token = REQUEST_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        REQUEST_PRIORITY.reset(token)
+
+
+class HostLimit(NamedTuple):
+    """Limits for the requests to a host.
+
+    At most concurrency requests run at the same time (0 for no limit) and they're started
+    at a rate of at most rate requests per second (0 for no limit) with bursts of up to burst requests.
+    """
+    concurrency: int = 0
+    rate: float = 0
+    burst: int = 1
+
+
+class HostScheduler:
+    """Semaphore and token bucket for the requests to a host.
+
+    Requests which can't start right away are queued and started by priority (then by arrival).
+    """
+    name: str
+    limit: HostLimit
+
+    requests: int
+    waited: int
+    total_wait: float
+
+    _active: int
+    _tokens: float
+    _updated: Optional[float]
+    _waiters: List[Tuple[int, int, asyncio.Future]]
+    _timer: Optional[asyncio.Handle]
+
+    def __init__(self, name: str, limit: HostLimit) -> None:
+        self.name = name
+        self.limit = limit
+
+        self.requests = self.waited = 0
+        self.total_wait = 0
+
+        self._active = 0
+        self._tokens = max(limit.burst, 1)
+        self._updated = None
+        self._waiters = []
+        self._counter = itertools.count()
+        self._timer = None
+
+    def __repr__(self) -> str:
+        return f"<HostScheduler {self.name} {self._active} active, {len(self._waiters)} waiting>"
+
+    def _refill(self) -> None:
+        now = asyncio.get_event_loop().time()
+        if self._updated is not None:
+            self._tokens = min(max(self.limit.burst, 1), self._tokens + (now - self._updated) * self.limit.rate)
+        self._updated = now
+
+    def _has_slot(self) -> bool:
+        return not self.limit.concurrency or self._active < self.limit.concurrency
+
+    def _has_token(self) -> bool:
+        if not self.limit.rate:
+            return True
+
+        self._refill()
+        return self._tokens >= 1
+
+    def _take(self) -> None:
+        self._active += 1
+        if self.limit.rate:
+            self._tokens -= 1
+
+    def _wake(self) -> None:
+        while self._waiters:
+            fut = self._waiters[0][2]
+            if fut.done():
+                # the waiter was cancelled
+                heapq.heappop(self._waiters)
+                continue
+
+            if not (self._has_slot() and self._has_token()):
+                break
+
+            heapq.heappop(self._waiters)
+            self._take()
+            fut.set_result(None)
+
+        if self._waiters and self._timer is None and self.limit.rate and self._has_slot():
+            # only waiting for the next token
+            delay = (1 - self._tokens) / self.limit.rate
+            self._timer = asyncio.get_event_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._wake()
+
+    async def acquire(self, priority: int = None) -> None:
+        self.requests += 1
+
+        if not self._waiters and self._has_slot() and self._has_token():
+            self._take()
+            return
+
+        if priority is None:
+            priority = REQUEST_PRIORITY.get()
+
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), fut))
+
+        start = loop.time()
+        self._wake()
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # got the slot but can't use it anymore
+                self.release()
+            raise
+
+        self.waited += 1
+        self.total_wait += loop.time() - start
+
+    def release(self) -> None:
+        self._active -= 1
+        self._wake()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int = None) -> AsyncIterator[None]:
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(limit=self.limit._asdict(),
+                    active=self._active,
+                    waiting=len(self._waiters),
+                    requests=self.requests,
+                    waited=self.waited,
+                    average_wait=round(self.total_wait / self.waited, 4) if self.waited else 0)
+
+
+class HostSchedulers:
+    """Schedulers by domain or formatting field.
+
+    Hosts which weren't configured get a scheduler of their own with the default limit.
+    """
+    default: HostLimit
+    limits: Dict[str, HostLimit]
+
+    _schedulers: Dict[str, HostScheduler]
+
+    def __init__(self, default: HostLimit, limits: Dict[str, HostLimit] = None) -> None:
+        self.default = default
+        self.limits = limits or {}
+        self._schedulers = {}
+
+    def configure(self, key: str, limit: HostLimit) -> None:
+        self.limits[key] = limit
+        self._schedulers.pop(key, None)
+
+    def get(self, key: str) -> HostScheduler:
+        scheduler = self._schedulers.get(key)
+        if scheduler is None:
+            scheduler = self._schedulers[key] = HostScheduler(key, self.limits.get(key, self.default))
+
+        return scheduler
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {key: scheduler.as_dict() for key, scheduler in self._schedulers.items()}
+
+
+def _load_limits(raw: Optional[str]) -> Dict[str, HostLimit]:
+    if not raw:
+        return {}
+
+    try:
+        return {key: HostLimit(**value) for key, value in json.loads(raw).items()}
+    except (ValueError, TypeError, AttributeError):
+        log.exception(f"Couldn't parse HOST_LIMITS: {raw}")
+        return {}
+
+
+HOST_SCHEDULERS = HostSchedulers(HostLimit(concurrency=int(os.getenv("HOST_CONCURRENCY", 8)),
+                                           rate=float(os.getenv("HOST_RATE", 0)),
+                                           burst=int(os.getenv("HOST_BURST", 1))),
+                                 _load_limits(os.getenv("HOST_LIMITS")))
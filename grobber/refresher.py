@@ -0,0 +1,169 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+from pymongo import UpdateOne
+
+from .models import Anime, UID
+from .rate_limit import Priority, request_priority
+from .stateful import Expiring
+
+log = logging.getLogger(__name__)
+
+
+class BackgroundRefresher:
+    """Refresh the expiring data of popular anime before it expires.
+
+    Every interval seconds the anime which expire within the next lead seconds are looked up
+    (the most popular first) and re-resolved along with their episodes and streams.
+    At most concurrency objects are refreshed at the same time across all anime.
+
+    The popularity of an anime is the amount of times it has been requested (by any worker),
+    anime requested fewer than min_hits times aren't refreshed.
+    A lease stored in the anime document makes sure only one worker refreshes an anime.
+    """
+    collection: AsyncIOMotorCollection
+    interval: float
+    lead: float
+    concurrency: int
+    batch_size: int
+    min_hits: int
+    lease: float
+
+    refreshed: int
+    failed: int
+
+    _get_anime: Callable[[UID], Awaitable[Optional[Anime]]]
+    _save_anime: Callable[[UID, Anime], Awaitable[None]]
+    _hits: Counter
+    _semaphore: Optional[asyncio.Semaphore]
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, collection: AsyncIOMotorCollection, *, get_anime: Callable[[UID], Awaitable[Optional[Anime]]],
+                 save_anime: Callable[[UID, Anime], Awaitable[None]], interval: float, lead: float, concurrency: int,
+                 batch_size: int = 50, min_hits: int = 1, lease: float = 10 * 60) -> None:
+        self.collection = collection
+        self.interval = interval
+        self.lead = lead
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.min_hits = min_hits
+        self.lease = lease
+
+        self.refreshed = self.failed = 0
+
+        self._get_anime = get_anime
+        self._save_anime = save_anime
+        self._hits = Counter()
+        self._semaphore = None
+        self._task = None
+
+    def __repr__(self) -> str:
+        return f"<BackgroundRefresher {self.refreshed} refreshed, {self.failed} failed>"
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # created lazily so it belongs to the running loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def record_hit(self, uid: UID) -> None:
+        self._hits[uid] += 1
+
+    async def flush_hits(self) -> None:
+        if not self._hits:
+            return
+
+        hits, self._hits = self._hits, Counter()
+        await self.collection.bulk_write([UpdateOne({"_id": uid}, {"$inc": {"hits": count}}) for uid, count in hits.items()],
+                                         ordered=False)
+
+    async def find_expiring(self) -> List[UID]:
+        now = datetime.now()
+        cursor = self.collection.find({"hits": {"$gte": self.min_hits},
+                                       "last_update": {"$lt": now - timedelta(seconds=Anime.EXPIRE_TIME - self.lead)},
+                                       "refresh_lease": {"$not": {"$gt": now}}},
+                                      {"_id": 1})
+        docs = await cursor.sort("hits", -1).limit(self.batch_size).to_list(None)
+        return [doc["_id"] for doc in docs]
+
+    async def claim(self, uid: UID) -> bool:
+        now = datetime.now()
+        result = await self.collection.update_one({"_id": uid, "refresh_lease": {"$not": {"$gt": now}}},
+                                                  {"$set": {"refresh_lease": now + timedelta(seconds=self.lease)}})
+        return result.modified_count > 0
+
+    async def _refresh_one(self, obj: Expiring) -> bool:
+        async with self.semaphore:
+            try:
+                await obj.refresh(self.lead)
+            except Exception:
+                log.exception(f"{self} couldn't refresh {obj}")
+                self.failed += 1
+                return False
+
+        self.refreshed += 1
+        return True
+
+    async def refresh_anime(self, uid: UID) -> None:
+        if not await self.claim(uid):
+            return
+
+        try:
+            anime = await self._get_anime(uid)
+            if anime is None:
+                return
+
+            await anime.load_attrs()
+            # the anime itself has to be refreshed first, it might have new episodes
+            expiring = anime.get_expiring(self.lead)
+            if anime in expiring:
+                expiring.remove(anime)
+                await self._refresh_one(anime)
+
+            await asyncio.gather(*(self._refresh_one(obj) for obj in expiring))
+
+            if anime.dirty:
+                await self._save_anime(uid, anime)
+        finally:
+            await self.collection.update_one({"_id": uid}, {"$unset": {"refresh_lease": ""}})
+
+    async def run_once(self) -> None:
+        await self.flush_hits()
+
+        uids = await self.find_expiring()
+        if not uids:
+            return
+
+        log.debug(f"{self} refreshing {len(uids)} anime")
+        await asyncio.gather(*(self.refresh_anime(uid) for uid in uids))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        # refreshing mustn't get in the way of the requests of users
+        with request_priority(Priority.BACKGROUND):
+            while True:
+                try:
+                    await self.run_once()
+                except Exception:
+                    log.exception(f"{self} couldn't refresh anime")
+
+                await asyncio.sleep(self.interval)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(refreshed=self.refreshed,
+                    failed=self.failed,
+                    pending_hits=len(self._hits),
+                    running=self._task is not None)
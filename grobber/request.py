@@ -3,18 +3,26 @@ import inspect
 import json
 import logging
 import os
+import time
 from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
 
 import pyppeteer
 import yarl
-from aiohttp import ClientResponse, ClientSession
+from aiohttp import ClientResponse
 from aiohttp.client_exceptions import ClientError
 from bs4 import BeautifulSoup
 from pyppeteer.browser import Browser
 from pyppeteer.page import Page
 
+from .browser import BrowserManager, BrowserProfile, CapturedRequest, DEFAULT_PROFILE, RequestCapture
+from .connection_pool import ConnectionPool, ConnectionPools, PoolConfig
 from .decorators import cached_contextmanager, cached_property
-from .utils import AsyncFormatter
+from .http_cache import CachePolicy, CacheStatus, CachedResponse, HTTP_CACHE
+from .locals import proxy_routes_collection
+from .proxy_pool import Proxy, ProxyPool, parse_proxy_urls
+from .proxy_routes import ProxyRoutes
+from .rate_limit import HOST_SCHEDULERS, HostLimit, HostScheduler
+from .utils import AsyncFormatter, SingleFlight
 
 log = logging.getLogger(__name__)
 
@@ -26,10 +34,17 @@ DEFAULT_HEADERS = {
 class UrlFormatter(AsyncFormatter):
     _FIELDS: Dict[Any, Any]
     _PROXY_DOMAINS: Dict[str, bool]
+    _CACHE_POLICIES: Dict[str, CachePolicy]
+    _POOLS: Dict[str, str]
+    _HOST_LIMITS: Dict[str, str]
 
-    def __init__(self, fields: Dict[Any, Any] = None, proxy_domains: Dict[str, bool] = None) -> None:
+    def __init__(self, fields: Dict[Any, Any] = None, proxy_domains: Dict[str, bool] = None, cache_policies: Dict[str, CachePolicy] = None,
+                 pools: Dict[str, str] = None, host_limits: Dict[str, str] = None) -> None:
         self._FIELDS = fields or {}
         self._PROXY_DOMAINS = proxy_domains or {}
+        self._CACHE_POLICIES = cache_policies or {}
+        self._POOLS = pools or {}
+        self._HOST_LIMITS = host_limits or {}
 
     def add_field(self, key: Any, value: Any) -> None:
         self._FIELDS[key] = value
@@ -40,6 +55,28 @@ class UrlFormatter(AsyncFormatter):
 
         self._PROXY_DOMAINS[key] = use
 
+    def use_cache(self, key: str, policy: CachePolicy) -> None:
+        if key not in self._FIELDS:
+            raise KeyError("Please use the same key as for the formatting field.")
+
+        self._CACHE_POLICIES[key] = policy
+
+    def use_pool(self, key: str, config: PoolConfig) -> None:
+        """Give the requests to the field a connection pool of their own."""
+        if key not in self._FIELDS:
+            raise KeyError("Please use the same key as for the formatting field.")
+
+        self._POOLS[key] = key
+        CONNECTION_POOLS.configure(key, config)
+
+    def use_host_limit(self, key: str, limit: HostLimit) -> None:
+        """Limit the requests to the field (all of its values share the limit)."""
+        if key not in self._FIELDS:
+            raise KeyError("Please use the same key as for the formatting field.")
+
+        self._HOST_LIMITS[key] = key
+        HOST_SCHEDULERS.configure(key, limit)
+
     def add_fields(self, fields: Dict[Any, Any] = None, **kwargs) -> None:
         fields = fields or {}
         fields.update(kwargs)
@@ -65,13 +102,59 @@ class UrlFormatter(AsyncFormatter):
             if f"{{{field}}}" in url:
                 return use
 
+    def get_cache_policy(self, url: str) -> Optional[CachePolicy]:
+        for field, policy in self._CACHE_POLICIES.items():
+            if f"{{{field}}}" in url:
+                return policy
+
+    def get_pool(self, url: str) -> str:
+        for field, pool in self._POOLS.items():
+            if f"{{{field}}}" in url:
+                return pool
+
+        return ConnectionPools.DEFAULT
+
+    def get_host_limit_key(self, url: str) -> Optional[str]:
+        for field, key in self._HOST_LIMITS.items():
+            if f"{{{field}}}" in url:
+                return key
+
+
+CONNECTION_POOLS = ConnectionPools({
+    ConnectionPools.DEFAULT: PoolConfig(limit=int(os.getenv("HTTP_POOL_LIMIT", 100)),
+                                        limit_per_host=int(os.getenv("HTTP_POOL_LIMIT_PER_HOST", 10)),
+                                        keepalive=float(os.getenv("HTTP_POOL_KEEPALIVE", 30)),
+                                        dns_ttl=float(os.getenv("HTTP_DNS_TTL", 5 * 60))),
+    ConnectionPools.PROBE: PoolConfig(limit=int(os.getenv("HTTP_PROBE_LIMIT", 20)),
+                                      limit_per_host=int(os.getenv("HTTP_PROBE_LIMIT_PER_HOST", 4)),
+                                      keepalive=float(os.getenv("HTTP_POOL_KEEPALIVE", 30)),
+                                      dns_ttl=float(os.getenv("HTTP_DNS_TTL", 5 * 60)))
+}, headers=DEFAULT_HEADERS)
 
 DefaultUrlFormatter = UrlFormatter()
 
-AIOSESSION = ClientSession(headers=DEFAULT_HEADERS)
+# requests without a body are shared between everyone asking for the same url at the same time
+COALESCED_METHODS = {"get", "head"}
+REQUEST_FLIGHT = SingleFlight("requests")
 
 CHROME_WS = os.getenv("CHROME_WS")
-PROXY_URL = os.getenv("PROXY_URL")
+
+PROXY_POOL = ProxyPool(parse_proxy_urls(os.getenv("PROXY_URL")),
+                       max_concurrency=int(os.getenv("PROXY_CONCURRENCY", 20)),
+                       eject_after=3,
+                       eject_for=float(os.getenv("PROXY_EJECT_TIME", 60)),
+                       scylla_url=os.getenv("SCYLLA_URL"),
+                       get_session=lambda: CONNECTION_POOLS.get().session)
+# attempts (with different proxies) a request may use before giving up
+PROXY_ATTEMPTS = 3
+# status codes which mean the proxy didn't work (or was rate limited).
+# 403 isn't one of them, the upstream site sends it to every proxy alike.
+PROXY_FAILURE_STATUS = {407, 429, 502, 503, 504}
+
+PROXY_ROUTES = ProxyRoutes(proxy_routes_collection,
+                           ttl=float(os.getenv("PROXY_ROUTE_TTL", 6 * 60 * 60)),
+                           probe_interval=float(os.getenv("PROXY_ROUTE_PROBE_INTERVAL", 10 * 60)),
+                           sync_interval=60)
 
 
 async def get_browser(**options) -> Browser:
@@ -81,6 +164,13 @@ async def get_browser(**options) -> Browser:
         return await pyppeteer.launch(**options)
 
 
+BROWSER = BrowserManager(get_browser,
+                         max_pages=int(os.getenv("BROWSER_PAGES", 4)),
+                         max_uses=int(os.getenv("BROWSER_PAGE_USES", 20)),
+                         queue_timeout=float(os.getenv("BROWSER_QUEUE_TIMEOUT", 15)),
+                         external=bool(CHROME_WS))
+
+
 class Request:
     ATTRS = ()
 
@@ -91,7 +181,8 @@ class Request:
     _json: Dict[str, Any]
     _bs: BeautifulSoup
 
-    def __init__(self, url: str, params: Any = None, headers: Any = None, timeout: int = None, use_proxy: bool = False, **request_kwargs) -> None:
+    def __init__(self, url: str, params: Any = None, headers: Any = None, timeout: int = None, use_proxy: bool = False,
+                 cache_policy: CachePolicy = None, **request_kwargs) -> None:
         self._raw_url = url
         self._params = params
         self._headers = headers
@@ -100,8 +191,14 @@ class Request:
         self.request_kwargs = request_kwargs
 
         self._formatter = DefaultUrlFormatter
-        self._session = AIOSESSION
-        self._use_proxy = use_proxy or self._formatter.should_use_proxy(self._raw_url)
+        self._pool_name = self._formatter.get_pool(self._raw_url)
+        proxy_setting = self._formatter.should_use_proxy(self._raw_url)
+        self._use_proxy = use_proxy or bool(proxy_setting)
+        # hosts which weren't configured explicitly are routed by what we learnt about them
+        self._route_by_host = bool(PROXY_POOL) and not use_proxy and proxy_setting is None
+        self._cache_policy = cache_policy or self._formatter.get_cache_policy(self._raw_url)
+        self._cache_status = None
+        self._browser_profile = DEFAULT_PROFILE
 
     def __hash__(self) -> int:
         return hash(self._raw_url)
@@ -113,7 +210,8 @@ class Request:
         props: Tuple[str, ...] = (
             hasattr(self, "_response") and "REQ",
             hasattr(self, "_text") and "TXT",
-            hasattr(self, "_bs") and "BS"
+            hasattr(self, "_bs") and "BS",
+            self._cache_status
         )
         cached = ",".join(filter(None, props))
 
@@ -206,42 +304,169 @@ class Request:
         return self.create_soup(await self.text)
 
     @cached_contextmanager
-    async def browser(self, **options) -> Browser:
-        browser = await get_browser(**options)
-        try:
-            yield browser
-        finally:
-            await browser.close()
+    async def browser(self) -> Browser:
+        # the browser is shared by the whole worker, it's closed after serving
+        yield await BROWSER.get_browser()
+
+    def use_profile(self, profile: BrowserProfile) -> "Request":
+        """Set the profile the page is loaded with (has to be set before the page is used)."""
+        self._browser_profile = profile
+        return self
+
+    async def capture(self, capture: RequestCapture, *, trigger: Callable[[Page], Awaitable[Any]] = None,
+                      timeout: float = None) -> Optional[CapturedRequest]:
+        """Load the page in the browser and get the first request matching the capture."""
+        return await BROWSER.capture(await self.url, capture, self._browser_profile, trigger=trigger, timeout=timeout)
 
     @cached_contextmanager
     async def page(self) -> Page:
-        browser: Browser
-        async with self.browser as browser:
-            page = await browser.newPage()
-            await page.goto(await self.url)
+        async with BROWSER.page(await self.url, self._browser_profile) as page:
+            yield page
+
+    async def perform_request(self, method: str, **kwargs) -> ClientResponse:
+        method = method.lower()
+        if method not in COALESCED_METHODS or "data" in self.request_kwargs or "json" in self.request_kwargs:
+            return await self._perform_request(method, **kwargs)
+
+        key = self.get_flight_key(method, await self.url, kwargs)
+        resp, use_proxy, cache_status = await REQUEST_FLIGHT.do(key, lambda: self._perform_shared_request(method, **kwargs))
+
+        # the request which performed the call might have found out that the host needs a proxy
+        self._use_proxy = self._use_proxy or use_proxy
+        self._cache_status = cache_status
+        return resp
+
+    def get_flight_key(self, method: str, url: str, kwargs: Dict[str, Any]) -> Tuple[str, str, str]:
+        """Get the key of the request in the REQUEST_FLIGHT, only requests sending the same thing share a response."""
+        options = dict(self.request_kwargs, headers=self.headers, timeout=self._timeout)
+        options.update(kwargs)
+        return method, url, json.dumps(options, sort_keys=True, default=repr)
+
+    async def _perform_shared_request(self, method: str, **kwargs) -> Tuple[ClientResponse, bool, Optional[CacheStatus]]:
+        if method == "get" and self._cache_policy and HTTP_CACHE:
+            resp = await self._perform_cached_request(method, **kwargs)
+        else:
+            resp = await self._perform_request(method, **kwargs)
+            # read the body while we're still the only one with access to it
+            await resp.read()
+
+        return resp, self._use_proxy, self._cache_status
 
+    async def _perform_cached_request(self, method: str, **kwargs) -> Union[ClientResponse, CachedResponse]:
+        policy = self._cache_policy
+        key = HTTP_CACHE.get_key(method, await self.url)
+
+        doc = await HTTP_CACHE.get(key)
+        if doc:
+            if HTTP_CACHE.is_fresh(doc, policy):
+                self._cache_status = CacheStatus.HIT
+                return CachedResponse(doc)
+
+            headers = dict(kwargs.get("headers") or self.headers or {})
+            headers.update(HTTP_CACHE.get_conditional_headers(doc))
+            kwargs["headers"] = headers
+
+        resp = await self._perform_request(method, **kwargs)
+
+        if doc and resp.status == 304:
+            resp.release()
+            log.debug(f"{self} not modified, using cached response")
+            self._cache_status = CacheStatus.REVALIDATED
+            return CachedResponse(await HTTP_CACHE.refresh(key, doc, resp, policy))
+
+        await resp.read()
+        self._cache_status = CacheStatus.MISS
+        await HTTP_CACHE.store_response(key, resp, policy)
+        return resp
+
+    def get_pool(self, method: str) -> ConnectionPool:
+        # probing links mustn't take the connections needed to fetch pages
+        name = ConnectionPools.PROBE if method == "head" else self._pool_name
+        return CONNECTION_POOLS.get(name, proxied=self._use_proxy)
+
+    async def get_scheduler(self) -> HostScheduler:
+        key = self._formatter.get_host_limit_key(self._raw_url) or (await self.yarl).host
+        return HOST_SCHEDULERS.get(key)
+
+    async def _send(self, method: str, url: str, options: Dict[str, Any]) -> ClientResponse:
+        async with (await self.get_scheduler()).slot():
+            resp = await self.get_pool(method).session.request(method, url, **options)
+            # reading the body is part of the request, it mustn't escape the limit of the host
             try:
-                yield page
+                await resp.read()
+            except BaseException:
+                resp.release()
+                raise
+
+            return resp
+
+    async def _send_via_proxy(self, method: str, url: str, options: Dict[str, Any]) -> ClientResponse:
+        tried: List[Proxy] = []
+
+        while True:
+            proxy = await PROXY_POOL.acquire(exclude=tried)
+            if proxy is None:
+                if tried:
+                    raise ClientError(f"{self} failed with all proxies")
+
+                log.warning(f"{self} should use a proxy but there are none")
+                return await self._send(method, url, options)
+
+            tried.append(proxy)
+            last_attempt = len(tried) >= min(PROXY_ATTEMPTS, len(PROXY_POOL))
+
+            start = time.monotonic()
+            success = False
+            try:
+                resp = await self._send(method, url, dict(options, proxy=proxy.url))
+                success = resp.status not in PROXY_FAILURE_STATUS
+            except asyncio.CancelledError:
+                # the caller lost interest, that doesn't say anything about the proxy
+                success = None
+                raise
+            except (ClientError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+
+                log.info(f"{self} failed using {proxy}: {e!r}, trying another proxy")
+                continue
             finally:
-                await page.close()
+                await PROXY_POOL.release(proxy, success, time.monotonic() - start)
+
+            if success or last_attempt:
+                return resp
+
+            log.info(f"{self} got {resp.status} using {proxy}, trying another proxy")
+            resp.release()
+
+    async def _perform_request(self, method: str, **kwargs) -> ClientResponse:
+        url = await self.url
+        host = (await self.yarl).host
+
+        if self._route_by_host and not self._use_proxy and PROXY_ROUTES.needs_proxy(host):
+            self._use_proxy = True
 
-    async def perform_request(self, method: str, **kwargs) -> ClientResponse:
         options = self.request_kwargs.copy()
         options.update(headers=self.headers, timeout=self._timeout)
+        options.update(kwargs)
 
         if self._use_proxy:
             log.debug(f"{self} using proxy")
-            options["proxy"] = PROXY_URL
-
-        options.update(kwargs)
-
-        url = await self.url
-        resp = await self._session.request(method, url, **options)
+            resp = await self._send_via_proxy(method, url, options)
+        else:
+            resp = await self._send(method, url, options)
 
         if resp.status == 403 and not self._use_proxy:
             log.info(f"{self} request blocked (403 forbidden). Trying again with proxy")
+            if self._route_by_host:
+                PROXY_ROUTES.mark_blocked(host)
+
             self._use_proxy = True
-            resp = await self.perform_request(method, **kwargs)
+            resp.release()
+            resp = await self._perform_request(method, **kwargs)
+        elif self._route_by_host and not self._use_proxy and resp.status < 400:
+            # errors (like 429 or 5xx) don't prove that the host can be reached directly
+            PROXY_ROUTES.mark_direct(host)
 
         return resp
 
@@ -264,29 +489,38 @@ class Request:
     async def first(requests: Iterable["Request"], *, timeout: float = None,
                     predicate: Callable[["Request"], Awaitable[bool]] = None) -> Optional["Request"]:
 
-        coros = {Request.try_req(request, predicate=predicate) for request in requests}
-
-        while coros:
-            done, coros = await asyncio.wait(coros, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
-            if not done:
-                break
-
-            request = next(iter(done)).result()
+        tasks = {asyncio.ensure_future(Request.try_req(request, predicate=predicate)) for request in requests}
+        pending = tasks
 
-            if request:
-                for coro in coros:
-                    coro.cancel()
-
-                return request
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+
+                for task in done:
+                    request = task.result()
+                    if request:
+                        return request
+        finally:
+            # the requests mustn't outlive the caller
+            for task in tasks:
+                task.cancel()
 
         return None
 
     @staticmethod
     async def all(requests: Iterable["Request"], *, timeout: float = None, predicate: Callable[["Request"], Awaitable[bool]] = None) -> ["Request"]:
-        wrapped = {Request.try_req(request, predicate=predicate) for request in requests}
-        if not wrapped:
+        tasks = {asyncio.ensure_future(Request.try_req(request, predicate=predicate)) for request in requests}
+        if not tasks:
             return []
 
-        done, _ = await asyncio.wait(wrapped, timeout=timeout,
-                                     return_when=asyncio.ALL_COMPLETED)
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=timeout,
+                                         return_when=asyncio.ALL_COMPLETED)
+        finally:
+            # the requests mustn't outlive the caller
+            for task in tasks:
+                task.cancel()
+
         return list(filter(None, (task.result() for task in done)))
@@ -0,0 +1,97 @@
+import logging
+import os
+import tempfile
+import time
+from typing import List, NamedTuple, Optional, Tuple
+
+from . import locals
+from .cache import LRUCache, Store, create_store
+from .languages import Language
+from .models import UID
+from .search_index import normalise_title
+
+log = logging.getLogger(__name__)
+
+_SEARCH_CACHE = os.getenv("SEARCH_CACHE", "memory")
+_SEARCH_CACHE_DIR = os.getenv("SEARCH_CACHE_DIR", os.path.join(tempfile.gettempdir(), "grobber-search-cache"))
+_SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+
+
+class CachedSearch(NamedTuple):
+    results: List[Tuple[UID, float]]
+    stale: bool
+
+
+class SearchCache:
+    """Cache of ranked search results.
+
+    Results younger than fresh_for are fresh, after that they're still served (as stale)
+    until keep_for runs out so they can be refreshed in the background.
+    Searches without any results are only kept for empty_for, new anime might show up for them soon.
+    Lookups go through a small in-memory cache before hitting the (shared) store.
+    """
+    store: Store
+    fresh_for: float
+    keep_for: float
+    empty_for: float
+
+    _memory: LRUCache
+
+    def __init__(self, store: Store, *, fresh_for: float, keep_for: float, empty_for: float = 60,
+                 memory_size: int = 256) -> None:
+        self.store = store
+        self.fresh_for = fresh_for
+        self.keep_for = keep_for
+        self.empty_for = empty_for
+
+        self._memory = LRUCache(memory_size, ttl=fresh_for)
+
+    def __repr__(self) -> str:
+        return f"<SearchCache {self.store}>"
+
+    @staticmethod
+    def get_key(query: str, language: Language, dubbed: bool, num_results: int) -> str:
+        return f"{normalise_title(query)}|{language.value}|{int(dubbed)}|{num_results}"
+
+    async def get(self, key: str) -> Optional[CachedSearch]:
+        doc = self._memory.get(key)
+        if doc is None:
+            try:
+                doc = await self.store.get(key)
+            except Exception:
+                log.exception(f"{self} couldn't get {key}")
+                return None
+
+            if doc is None:
+                return None
+
+        fresh_for = self.fresh_for if doc["results"] else self.empty_for
+        age = time.time() - doc["stored"]
+        stale = age >= fresh_for
+        if not stale:
+            self._memory.set(key, doc, ttl=fresh_for - age)
+
+        return CachedSearch([(uid, certainty) for uid, certainty in doc["results"]], stale)
+
+    async def set(self, key: str, results: List[Tuple[UID, float]]) -> None:
+        doc = {"results": [[uid, certainty] for uid, certainty in results],
+               "stored": time.time()}
+
+        if results:
+            self._memory.set(key, doc)
+            keep_for = self.keep_for
+        else:
+            self._memory.set(key, doc, ttl=self.empty_for)
+            keep_for = self.empty_for
+
+        try:
+            await self.store.set(key, doc, keep_for)
+        except Exception:
+            log.exception(f"{self} couldn't store {key}")
+
+
+SEARCH_CACHE = SearchCache(create_store(_SEARCH_CACHE, max_size=_SEARCH_CACHE_SIZE, directory=_SEARCH_CACHE_DIR,
+                                        collection=locals.search_cache_collection),
+                           fresh_for=float(os.getenv("SEARCH_CACHE_FRESH", 10 * 60)),
+                           keep_for=float(os.getenv("SEARCH_CACHE_KEEP", 24 * 60 * 60)),
+                           empty_for=float(os.getenv("SEARCH_CACHE_EMPTY", 60)))
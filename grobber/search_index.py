@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import re
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from .languages import Language
+from .models import Anime, UID
+from .similarity import SIMILARITY
+
+log = logging.getLogger(__name__)
+
+RE_NON_WORD = re.compile(r"[\W_]+")
+
+Facet = Tuple[Language, bool]
+
+
+def normalise_title(title: str) -> str:
+    title = unicodedata.normalize("NFKD", title)
+    title = "".join(c for c in title if not unicodedata.combining(c))
+    return RE_NON_WORD.sub(" ", title.lower()).strip()
+
+
+def get_trigrams(text: str) -> Set[str]:
+    text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class IndexEntry(NamedTuple):
+    uid: UID
+    title: str
+    facet: Facet
+
+
+class TitleIndex:
+    """In-memory trigram index of the titles of all known anime.
+
+    Every (language, dubbed) combination has its own postings so filtering by them is free.
+    """
+    max_candidates: int
+    min_certainty: float
+
+    _entries: Dict[UID, IndexEntry]
+    _postings: Dict[Facet, Dict[str, Set[UID]]]
+
+    def __init__(self, *, max_candidates: int = 50, min_certainty: float = .3) -> None:
+        self.max_candidates = max_candidates
+        self.min_certainty = min_certainty
+
+        self._entries = {}
+        self._postings = defaultdict(lambda: defaultdict(set))
+
+    def __repr__(self) -> str:
+        return f"<TitleIndex {len(self._entries)} titles>"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, uid: UID) -> bool:
+        return uid in self._entries
+
+    def add(self, uid: UID, title: str, language: Language, dubbed: bool) -> None:
+        entry = IndexEntry(uid, title, (language, dubbed))
+        if self._entries.get(uid) == entry:
+            return
+
+        self.remove(uid)
+        self._entries[uid] = entry
+
+        postings = self._postings[entry.facet]
+        for gram in get_trigrams(normalise_title(title)):
+            postings[gram].add(uid)
+
+    def remove(self, uid: UID) -> None:
+        entry = self._entries.pop(uid, None)
+        if not entry:
+            return
+
+        postings = self._postings[entry.facet]
+        for gram in get_trigrams(normalise_title(entry.title)):
+            uids = postings.get(gram)
+            if uids:
+                uids.discard(uid)
+                if not uids:
+                    del postings[gram]
+
+    def get_candidates(self, query: str, language: Language, dubbed: bool) -> List[IndexEntry]:
+        postings = self._postings.get((language, dubbed))
+        if not postings:
+            return []
+
+        shared = Counter()
+        for gram in get_trigrams(normalise_title(query)):
+            shared.update(postings.get(gram, ()))
+
+        return [self._entries[uid] for uid, _ in shared.most_common(self.max_candidates)]
+
+    def search(self, query: str, *, language: Language = Language.ENGLISH, dubbed: bool = False, limit: int = None,
+               min_certainty: float = None) -> List[Tuple[UID, float]]:
+        """Find the titles most similar to the query.
+
+        :param min_certainty: leave out titles less similar than this, defaults to the index's min_certainty
+        :return: list of uid and certainty (as used by SearchResult) sorted by certainty
+        """
+        if min_certainty is None:
+            min_certainty = self.min_certainty
+
+        candidates = self.get_candidates(query, language, dubbed)
+        ranked = SIMILARITY.rank(query, [entry.title for entry in candidates], limit=limit, min_score=min_certainty)
+        return [(candidates[i].uid, certainty) for i, certainty in ranked]
+
+    def update(self, docs: Iterable[dict]) -> Set[UID]:
+        added = set()
+        for doc in docs:
+            try:
+                language = Language(doc[f"language{Anime._SPECIAL_MARKER}"])
+                self.add(doc["_id"], doc["title"], language, doc["is_dub"])
+            except (KeyError, ValueError):
+                continue
+            else:
+                added.add(doc["_id"])
+
+        return added
+
+    async def load(self, collection: AsyncIOMotorCollection, *, since: datetime = None) -> None:
+        """Load the titles from the database.
+
+        :param since: only load the anime updated after this, otherwise all of them are loaded
+                      and the ones which aren't in the database anymore are removed
+        """
+        query = {"title": {"$exists": True}}
+        if since:
+            query["last_update"] = {"$gt": since}
+
+        projection = {"title": 1, f"language{Anime._SPECIAL_MARKER}": 1, "is_dub": 1}
+        docs = await collection.find(query, projection).to_list(None)
+
+        added = self.update(docs)
+        if since:
+            log.debug(f"{self} loaded {len(added)} title(s) updated since {since}")
+            return
+
+        for uid in self._entries.keys() - added:
+            self.remove(uid)
+
+        log.info(f"{self} loaded {len(added)} title(s)")
+
+
+class IndexRefresher:
+    """Keep a TitleIndex in sync with the database (which contains the anime found by other workers).
+
+    Only the anime updated since the last sync are loaded. Every full_every syncs the whole index
+    is reloaded instead to get rid of deleted anime and pick up anything the updates missed.
+    """
+    index: TitleIndex
+    collection: AsyncIOMotorCollection
+    interval: float
+    full_every: int
+    overlap: float
+
+    _last_sync: Optional[datetime]
+    _syncs: int
+    _task: Optional[asyncio.Future]
+
+    def __init__(self, index: TitleIndex, collection: AsyncIOMotorCollection, *, interval: float, full_every: int = 12,
+                 overlap: float = 5 * 60) -> None:
+        self.index = index
+        self.collection = collection
+        self.interval = interval
+        self.full_every = full_every
+        # last_update is set by whichever worker updated the anime before writing it (with its own clock)
+        self.overlap = overlap
+
+        self._last_sync = None
+        self._syncs = 0
+        self._task = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def sync(self) -> None:
+        started = datetime.now()
+
+        if self._last_sync is None or self._syncs % self.full_every == 0:
+            await self.index.load(self.collection)
+        else:
+            await self.index.load(self.collection, since=self._last_sync - timedelta(seconds=self.overlap))
+
+        self._last_sync = started
+        self._syncs += 1
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sync()
+            except Exception:
+                log.exception(f"{self.index} couldn't load titles")
+
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,104 @@
+import abc
+import heapq
+import logging
+import os
+from difflib import SequenceMatcher
+from typing import Dict, List, Sequence, Tuple, Type
+
+log = logging.getLogger(__name__)
+
+
+class SimilarityEngine(abc.ABC):
+    """Scores how similar two strings are (between 0 and 1, rounded to 2 decimals)."""
+    NAME: str = None
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__}>"
+
+    @abc.abstractmethod
+    def score(self, a: str, b: str) -> float:
+        ...
+
+    def rank(self, query: str, candidates: Sequence[str], *, limit: int = None, min_score: float = 0) -> List[Tuple[int, float]]:
+        """Score all candidates against the query.
+
+        The score of a candidate is the same as score(query, candidate).
+
+        :param query: string to compare the candidates with
+        :param candidates: strings to score
+        :param limit: only return the best `limit` candidates
+        :param min_score: leave out candidates scoring less than this
+        :return: list of (index of the candidate, score) ordered from best to worst
+        """
+        results = []
+        for i, candidate in enumerate(candidates):
+            score = self.score(query, candidate)
+            if score >= min_score:
+                results.append((i, score))
+
+        results.sort(key=lambda r: r[1], reverse=True)
+        return results[:limit] if limit else results
+
+
+class DifflibEngine(SimilarityEngine):
+    """Engine using the ratio of difflib's SequenceMatcher.
+
+    The ratio isn't symmetric, the query is always the matcher's first sequence. When ranking, the matcher's
+    cheap upper bounds (length and character counts) are used to skip candidates which can't reach min_score
+    or make it into the best `limit` candidates.
+    """
+    NAME = "difflib"
+
+    def score(self, a: str, b: str) -> float:
+        return round(SequenceMatcher(a=a, b=b).ratio(), 2)
+
+    def rank(self, query: str, candidates: Sequence[str], *, limit: int = None, min_score: float = 0) -> List[Tuple[int, float]]:
+        matcher = SequenceMatcher()
+        matcher.set_seq1(query)
+        # min-heap of (score, -index) holding the best candidates so far
+        best = []
+
+        for i, candidate in enumerate(candidates):
+            # the scores are rounded, so anything which could round up to the cut-off has to be scored
+            if limit and len(best) >= limit:
+                threshold = max(min_score, best[0][0]) - .005
+            else:
+                threshold = min_score - .005
+
+            matcher.set_seq2(candidate)
+            if threshold > 0 and (matcher.real_quick_ratio() < threshold or matcher.quick_ratio() < threshold):
+                continue
+
+            score = round(matcher.ratio(), 2)
+            if score < min_score:
+                continue
+
+            item = (score, -i)
+            if not limit:
+                best.append(item)
+            elif len(best) < limit:
+                heapq.heappush(best, item)
+            elif item > best[0]:
+                heapq.heapreplace(best, item)
+
+        best.sort(reverse=True)
+        return [(-neg_i, score) for score, neg_i in best]
+
+
+ENGINES: Dict[str, Type[SimilarityEngine]] = {}
+
+
+def register_engine(engine: Type[SimilarityEngine]) -> None:
+    ENGINES[engine.NAME] = engine
+
+
+def get_engine(name: str) -> SimilarityEngine:
+    try:
+        return ENGINES[name]()
+    except KeyError:
+        raise ValueError(f"Unknown similarity engine \"{name}\" (available: {', '.join(ENGINES)})")
+
+
+register_engine(DifflibEngine)
+
+SIMILARITY: SimilarityEngine = get_engine(os.getenv("SIMILARITY_ENGINE", DifflibEngine.NAME))
@@ -1,13 +1,19 @@
 import asyncio
 import importlib
 import logging
-from typing import Any, AsyncIterator, Dict, List, Optional, Set, Type
+import os
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Set, Type
 
+from ..cache import LRUCache
 from ..exceptions import UIDUnknown
 from ..languages import Language
 from ..locals import anime_collection
 from ..models import Anime, SearchResult, UID
-from ..utils import anext
+from ..persister import WriteBehindPersister
+from ..refresher import BackgroundRefresher
+from ..search_index import IndexRefresher, TitleIndex
+from ..stateful import Expiring, add_refresh_listener
+from ..utils import SingleFlight, anext
 
 log = logging.getLogger(__name__)
 
@@ -29,30 +35,95 @@ log.info(f"Using Sources: {', '.join(source.__name__ for source in SOURCES.value
 
 CACHE: Set[Anime] = set()
 
+ANIME_CACHE_SIZE = int(os.getenv("ANIME_CACHE_SIZE", 512))
+# Identity map of the anime known to this worker.
+# Entries expire after the EXPIRE_TIME of their class so changes made by other workers are picked up eventually.
+ANIME_CACHE: LRUCache[UID, Anime] = LRUCache(ANIME_CACHE_SIZE)
+
+ANIME_FLIGHT = SingleFlight("anime")
+
+
+def remember_anime(uid: UID, anime: Anime) -> None:
+    ANIME_CACHE.set(uid, anime, ttl=anime.EXPIRE_TIME)
+
+
+PERSISTER = WriteBehindPersister(anime_collection,
+                                 batch_size=int(os.getenv("PERSIST_BATCH_SIZE", 100)),
+                                 flush_interval=float(os.getenv("PERSIST_INTERVAL", 2)),
+                                 max_pending=int(os.getenv("PERSIST_MAX_PENDING", 1000)))
+
 
 async def save_dirty() -> None:
     if not CACHE:
         return
 
-    num_saved = 0
-    coros = []
-    for anime in CACHE:
+    num_dirty = 0
+    num_cached = len(CACHE)
+    cached = list(CACHE)
+    CACHE.clear()
+
+    for anime in cached:
         if anime.dirty:
-            num_saved += 1
-            coro = anime_collection.update_one({"_id": await anime.uid}, {"$set": anime.state}, upsert=True)
-            coros.append(coro)
+            num_dirty += 1
+            uid = await anime.uid
+            await PERSISTER.enqueue(uid, anime)
+
+            if uid not in ANIME_CACHE:
+                remember_anime(uid, anime)
+
+    log.debug(f"Queued {num_dirty} dirty out of {num_cached} cached anime")
+
+
+TITLE_INDEX = TitleIndex(min_certainty=float(os.getenv("LOCAL_SEARCH_MIN_CERTAINTY", .3)))
+TITLE_INDEX_REFRESHER = IndexRefresher(TITLE_INDEX, anime_collection, interval=float(os.getenv("TITLE_INDEX_INTERVAL", 10 * 60)))
+
+
+REFRESHER = BackgroundRefresher(anime_collection,
+                                get_anime=lambda uid: get_anime(uid),
+                                save_anime=lambda uid, anime: PERSISTER.enqueue(uid, anime),
+                                interval=float(os.getenv("REFRESH_INTERVAL", 60)),
+                                lead=float(os.getenv("REFRESH_LEAD", 5 * 60)),
+                                concurrency=int(os.getenv("REFRESH_CONCURRENCY", 4)),
+                                batch_size=int(os.getenv("REFRESH_BATCH_SIZE", 50)),
+                                min_hits=int(os.getenv("REFRESH_MIN_HITS", 1)))
 
-    await asyncio.gather(*coros)
-    log.debug(f"Saved {num_saved} dirty out of {len(CACHE)} cached anime")
-    CACHE.clear()
+
+async def save_refreshed(obj: Expiring) -> None:
+    """Save the anime whose values have been revalidated in the background after the request was answered."""
+    if isinstance(obj, Anime):
+        await PERSISTER.enqueue(await obj.uid, obj)
+        return
+
+    # episodes and streams don't know which anime they belong to, but it's in the identity map and dirty now
+    for uid in list(ANIME_CACHE):
+        anime = ANIME_CACHE.peek(uid)
+        if anime is not None and anime.dirty:
+            await PERSISTER.enqueue(uid, anime)
+
+
+add_refresh_listener(save_refreshed)
+
+
+async def start() -> None:
+    TITLE_INDEX_REFRESHER.start()
+    if REFRESHER.concurrency > 0:
+        REFRESHER.start()
+
+
+async def close() -> None:
+    TITLE_INDEX_REFRESHER.stop()
+    REFRESHER.stop()
+    await PERSISTER.close()
 
 
 async def delete_anime(uid: str) -> None:
     log.info(f"deleting anime {uid}...")
+    ANIME_CACHE.pop(uid)
+    PERSISTER.discard(uid)
     await anime_collection.delete_one(dict(_id=uid))
 
 
-async def build_anime_from_doc(uid: str, doc: Dict[str, Any]) -> Anime:
+async def build_anime_from_doc(uid: str, doc: Dict[str, Any], attrs: Iterable[str] = None) -> Anime:
     try:
         cls = SOURCES[doc["cls"]]
     except KeyError:
@@ -60,28 +131,148 @@ async def build_anime_from_doc(uid: str, doc: Dict[str, Any]) -> Anime:
         await delete_anime(uid)
         raise UIDUnknown(uid)
 
-    anime = cls.from_state(doc)
+    anime = ANIME_CACHE.peek(uid)
+    if anime is None:
+        anime = cls.from_state(doc)
+        if attrs is not None:
+            anime.set_partial(attrs, lambda projection: anime_collection.find_one(uid, projection))
+        remember_anime(uid, anime)
+
     CACHE.add(anime)
     return anime
 
 
-async def get_anime(uid: UID) -> Optional[Anime]:
-    doc = await anime_collection.find_one(uid)
+def get_projection(attrs: Optional[Iterable[str]]) -> Optional[Dict[str, int]]:
+    if attrs is None:
+        return None
+    return Anime.get_projection(attrs)
+
+
+async def _load_anime(uid: UID, attrs: Iterable[str] = None) -> Optional[Anime]:
+    doc = await anime_collection.find_one(uid, get_projection(attrs))
     if doc:
-        return await build_anime_from_doc(uid, doc)
+        return await build_anime_from_doc(uid, doc, attrs)
     return None
 
 
-async def get_anime_by_title(title: str, *, language=Language.ENGLISH, dubbed=False) -> Optional[Anime]:
-    doc = await anime_collection.find_one({"title": title, f"language{Anime._SPECIAL_MARKER}": language.value, "is_dub": dubbed})
+async def get_anime(uid: UID, attrs: Iterable[str] = None) -> Optional[Anime]:
+    """Get the anime with the given uid.
+
+    :param uid: uid of the anime
+    :param attrs: attributes to load from the database, the rest is loaded on demand. None to load everything.
+    :return: the anime or None if there's no anime with the uid
+    """
+    anime = ANIME_CACHE.get(uid)
+    if anime is not None:
+        CACHE.add(anime)
+        return anime
+
+    # share the database round-trip with concurrent requests for the same anime
+    return await ANIME_FLIGHT.do(uid, lambda: _load_anime(uid, attrs))
+
+
+async def get_many(uids: Iterable[UID], attrs: Iterable[str] = None) -> Dict[UID, Anime]:
+    """Get multiple anime using at most one database query.
+
+    :param uids: uids of the anime
+    :param attrs: attributes to load from the database, None to load everything.
+    :return: dict of uid to anime in the order of the given uids, unknown uids are left out
+    """
+    uids = list(dict.fromkeys(uids))
+    if attrs is not None:
+        attrs = list(attrs)
+
+    found = {}
+    missing = []
+    for uid in uids:
+        anime = ANIME_CACHE.get(uid)
+        if anime is None:
+            missing.append(uid)
+        else:
+            CACHE.add(anime)
+            found[uid] = anime
+
+    if missing:
+        async for doc in anime_collection.find({"_id": {"$in": missing}}, get_projection(attrs)):
+            uid = doc["_id"]
+            try:
+                found[uid] = await build_anime_from_doc(uid, doc, attrs)
+            except UIDUnknown:
+                continue
+
+    return {uid: found[uid] for uid in uids if uid in found}
+
+
+async def get_anime_by_title(title: str, *, language=Language.ENGLISH, dubbed=False, attrs: Iterable[str] = None) -> Optional[Anime]:
+    doc = await anime_collection.find_one({"title": title, f"language{Anime._SPECIAL_MARKER}": language.value, "is_dub": dubbed},
+                                          get_projection(attrs))
     if doc:
-        return await build_anime_from_doc(doc["_id"], doc)
+        return await build_anime_from_doc(doc["_id"], doc, attrs)
 
     return None
 
 
-async def search_anime(query: str, *, language=Language.ENGLISH, dubbed=False) -> AsyncIterator[SearchResult]:
-    sources: List[AsyncIterator[SearchResult]] = [source.search(query, language=language, dubbed=dubbed) for source in SOURCES.values()]
+async def index_anime(anime: Anime) -> None:
+    uid, title, language, is_dub = await asyncio.gather(anime.uid, anime.title, anime.language, anime.is_dub)
+    TITLE_INDEX.add(uid, title, language, is_dub)
+
+
+async def search_local(query: str, *, language=Language.ENGLISH, dubbed=False, limit: int = None,
+                       min_certainty: float = None) -> List[SearchResult]:
+    """Search the anime which are already in the database."""
+    matches = TITLE_INDEX.search(query, language=language, dubbed=dubbed, limit=limit, min_certainty=min_certainty)
+    anime = await get_many((uid for uid, _ in matches), Anime.DICT_ATTRS)
+
+    return [SearchResult(anime[uid], certainty) for uid, certainty in matches if uid in anime]
+
+
+class SearchReport:
+    """Outcome of every source taking part in a search.
+
+    The status of a source is one of "searching", "exhausted", "failed", "timed_out"
+    or "cancelled" (when the search was stopped before the source was done).
+    """
+    sources: Dict[str, str]
+
+    def __init__(self) -> None:
+        self.sources = {}
+
+    def __repr__(self) -> str:
+        return f"<SearchReport {self.sources}>"
+
+    def set_status(self, source: str, status: str) -> None:
+        self.sources[source] = status
+
+    def update(self, other: "SearchReport") -> None:
+        self.sources.update(other.sources)
+
+    @property
+    def timed_out(self) -> List[str]:
+        return [source for source, status in self.sources.items() if status == "timed_out"]
+
+    @property
+    def failed(self) -> List[str]:
+        return [source for source, status in self.sources.items() if status == "failed"]
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dict(sources=self.sources, timed_out=self.timed_out, failed=self.failed)
+
+
+async def search_anime(query: str, *, language=Language.ENGLISH, dubbed=False, deadline: float = None,
+                       report: SearchReport = None) -> AsyncIterator[SearchResult]:
+    """Search all sources at once and yield the results as they come in.
+
+    :param deadline: event loop time by which the sources have to be done, sources which are still searching
+        by then are cancelled. None to wait for all of them.
+    :param report: report to record the outcome of each source in
+    """
+    report = report or SearchReport()
+    loop = asyncio.get_event_loop()
+
+    sources: Dict[AsyncIterator[SearchResult], str] = {}
+    for source in SOURCES.values():
+        sources[source.search(query, language=language, dubbed=dubbed)] = source.__name__
+        report.set_status(source.__name__, "searching")
 
     def waiter(src):
         async def wrapped():
@@ -93,19 +284,35 @@ async def search_anime(query: str, *, language=Language.ENGLISH, dubbed=False) -
 
         return asyncio.ensure_future(wrapped())
 
-    waiting_sources = {waiter(source) for source in sources}
-
-    while waiting_sources:
-        done: asyncio.Future
-        (done, *_), waiting_sources = await asyncio.wait(waiting_sources, return_when=asyncio.FIRST_COMPLETED)
+    waiting_sources = {waiter(source): source for source in sources}
 
-        result, source = done.result()
-
-        if isinstance(result, StopAsyncIteration):
-            log.debug(f"{source} exhausted")
-        elif isinstance(result, Exception):
-            log.exception(f"{source} failed to yield a search result!")
-        else:
-            waiting_sources.add(waiter(source))
-            CACHE.add(result.anime)
-            yield result
+    try:
+        while waiting_sources:
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait(waiting_sources.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                log.info(f"{', '.join(sources[source] for source in waiting_sources.values())} "
+                         f"didn't finish searching for \"{query}\" in time")
+                break
+
+            for waiting in done:
+                del waiting_sources[waiting]
+                result, source = waiting.result()
+
+                if isinstance(result, StopAsyncIteration):
+                    log.debug(f"{sources[source]} exhausted")
+                    report.set_status(sources[source], "exhausted")
+                elif isinstance(result, Exception):
+                    log.error(f"{sources[source]} failed to yield a search result!", exc_info=result)
+                    report.set_status(sources[source], "failed")
+                else:
+                    waiting_sources[waiter(source)] = source
+                    CACHE.add(result.anime)
+                    yield result
+    finally:
+        # the consumer may also stop early, don't leave the sources running in the background
+        timed_out = deadline is not None and loop.time() >= deadline
+        for waiting, source in waiting_sources.items():
+            report.set_status(sources[source], "timed_out" if timed_out else "cancelled")
+            waiting.cancel()
@@ -4,10 +4,14 @@ import re
 from typing import AsyncIterator, List, Optional
 
 from . import register_source
+from ..connection_pool import PoolConfig
 from ..decorators import cached_property
+from ..http_cache import CachePolicy
 from ..languages import Language
-from ..models import Anime, Episode, SearchResult, get_certainty
+from ..models import Anime, Episode, SearchResult
+from ..rate_limit import HostLimit
 from ..request import DefaultUrlFormatter, Request
+from ..similarity import SIMILARITY
 from ..url_pool import UrlPool
 from ..utils import add_http_scheme
 
@@ -104,16 +108,11 @@ class GogoAnime(Anime):
         if not container:
             return
 
-        search_results = container.find_all("li")
+        image_links = [result.find("a") for result in container.find_all("li")]
+        image_links = [image_link for image_link in image_links if dubbed == image_link["title"].endswith("(Dub)")]
 
-        for result in search_results:
-            image_link = result.find("a")
-            title = image_link["title"]
-            if dubbed != title.endswith("(Dub)"):
-                continue
-
-            link = BASE_URL + image_link["href"]
-            similarity = get_certainty(query, title)
+        for i, similarity in SIMILARITY.rank(query, [image_link["title"] for image_link in image_links]):
+            link = BASE_URL + image_links[i]["href"]
             yield SearchResult(cls(Request(link)), similarity)
 
     @cached_property
@@ -143,5 +142,8 @@ class GogoAnime(Anime):
 gogoanime_pool = UrlPool("GogoAnime", ["https://gogoanimes.co", "http://gogoanimes.co"])
 DefaultUrlFormatter.add_field("GOGOANIME_URL", lambda: gogoanime_pool.url)
 DefaultUrlFormatter.use_proxy("GOGOANIME_URL")
+DefaultUrlFormatter.use_cache("GOGOANIME_URL", CachePolicy(max_age=10 * 60))
+DefaultUrlFormatter.use_pool("GOGOANIME_URL", PoolConfig(limit=30, limit_per_host=30))
+DefaultUrlFormatter.use_host_limit("GOGOANIME_URL", HostLimit(concurrency=10, rate=10, burst=20))
 
 register_source(GogoAnime)
@@ -4,9 +4,12 @@ from typing import Any, AsyncIterator, Dict, List, Optional
 
 from . import register_source
 from .. import utils
+from ..connection_pool import PoolConfig
 from ..decorators import cached_property
+from ..http_cache import CachePolicy
 from ..languages import Language
 from ..models import Anime, Episode, SearchResult, get_certainty
+from ..rate_limit import HostLimit
 from ..request import DefaultUrlFormatter, Request
 from ..url_pool import UrlPool
 
@@ -128,5 +131,8 @@ class MasterAnime(Anime):
 
 masteranime_pool = UrlPool("MasterAnime", ["https://www.masterani.me"])
 DefaultUrlFormatter.add_field("MASTERANIME_URL", lambda: masteranime_pool.url)
+DefaultUrlFormatter.use_cache("MASTERANIME_URL", CachePolicy(max_age=10 * 60))
+DefaultUrlFormatter.use_pool("MASTERANIME_URL", PoolConfig(limit=30, limit_per_host=30))
+DefaultUrlFormatter.use_host_limit("MASTERANIME_URL", HostLimit(concurrency=10, rate=10, burst=20))
 
 register_source(MasterAnime)
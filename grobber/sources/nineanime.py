@@ -1,32 +1,44 @@
+import logging
 import re
 from typing import Iterator, List
 
 from pyppeteer.page import Page
 
 from . import register_source
+from ..browser import LIGHT_PROFILE, RequestCapture
 from ..decorators import cached_property
 from ..languages import Language
-from ..models import Anime, Episode, SearchResult, get_certainty
+from ..models import Anime, Episode, SearchResult
 from ..request import DefaultUrlFormatter, Request
+from ..similarity import SIMILARITY
 from ..url_pool import UrlPool
 
 BASE_URL = "{9ANIME_URL}"
 SEARCH_URL = BASE_URL + "/search"
 
+log = logging.getLogger(__name__)
+
 RE_DUB_STRIPPER = re.compile(r"\s\(Dub\)$")
 
 
 class NineEpisode(Episode):
+    BROWSER_PROFILE = LIGHT_PROFILE._replace(wait_for="div#player iframe")
+
     # TODO: automatically switch episode if no stream found! But also start with the most likely stream!
     @cached_property
     async def raw_streams(self) -> List[str]:
-        async with self._req.page as page:
-            page: Page
-            return [await page.evaluate("""document.querySelector("div#player iframe").src""", force_expr=True)]
+        # the player is the first document loaded in a frame (ads are blocked by the profile)
+        player = await self.capture(RequestCapture(resource_types=frozenset({"document"}), mime_types=(), child_frames_only=True))
+        if player:
+            return [player.url]
+
+        log.warning(f"{self} didn't load a player")
+        return []
 
 
 class NineAnime(Anime):
     EPISODE_CLS = NineEpisode
+    BROWSER_PROFILE = LIGHT_PROFILE._replace(wait_for="div.server ul.episodes")
 
     @cached_property
     async def raw_title(self) -> str:
@@ -52,13 +64,11 @@ class NineAnime(Anime):
         req = Request(SEARCH_URL, {"keyword": query})
         bs = await req.bs
         container = bs.select_one("div.film-list")
-        search_results = container.select("div.item")
-
-        for result in search_results:
-            title = result.select_one("a.name").text
-            if dubbed != title.endswith("(Dub)"):
-                continue
+        search_results = [result for result in container.select("div.item")
+                          if dubbed == result.select_one("a.name").text.endswith("(Dub)")]
 
+        for i, similarity in SIMILARITY.rank(query, [result.select_one("a.name").text for result in search_results]):
+            result = search_results[i]
             ep_text_container = result.select_one("div.ep")
             if ep_text_container:
                 ep_count = int(ep_text_container.text.split("/", 1)[0][4:])
@@ -66,15 +76,15 @@ class NineAnime(Anime):
                 ep_count = 1
 
             link = result.select_one("a.poster")["href"]
-            similarity = get_certainty(query, title)
 
             anime = cls(Request(link))
             anime._episode_count = ep_count
+            anime.mark_fetched("episode_count")
             yield SearchResult(anime, similarity)
 
     @cached_property
     async def raw_eps(self) -> List[NineEpisode]:
-        async with self._req.page as page:
+        async with self.page as page:
             page: Page
             episodes = await page.evaluate(
                 """Array.from(document.querySelectorAll("div.server:not(.hidden) ul.episodes a")).map(epLink => epLink.href);""", force_expr=True)
@@ -2,13 +2,16 @@ import abc
 import asyncio
 import inspect
 import logging
+import time
 from collections import deque
 from contextlib import suppress
-from datetime import datetime
-from typing import Any, Dict, Iterable, List, Mapping, Pattern, TypeVar
+from copy import deepcopy
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Mapping, NamedTuple, Optional, Pattern, Set, Tuple, TypeVar
 
 import bson
 
+from .rate_limit import Priority, REQUEST_PRIORITY
 from .request import Request
 
 log = logging.getLogger(__name__)
@@ -19,6 +22,14 @@ VALID_BSON_TYPES = (dict, list, tuple, bson.ObjectId, datetime, Pattern, str, in
 BsonType = TypeVar("BsonType", *VALID_BSON_TYPES)
 
 
+Changes = Tuple[Dict[str, BsonType], Set[str]]
+StateLoader = Callable[[Dict[str, int]], Awaitable[Optional[Dict[str, BsonType]]]]
+
+
+def join_path(path: Optional[str], key: str) -> str:
+    return f"{path}.{key}" if path else key
+
+
 def check_container_bson(data: Any) -> bool:
     if isinstance(data, dict):
         for key, value in data.items():
@@ -42,13 +53,39 @@ class Stateful(abc.ABC):
     ATTRS = ()
 
     _req: Request
-    _dirty: bool
+    _dirty_attrs: Set[str]
+    _unset_attrs: Set[str]
+    _persisted: bool
+
+    _unloaded: Set[str]
+    _loader: Optional[StateLoader]
+    _load_lock: Optional[asyncio.Lock]
 
     def __init__(self, req):
         self._req = req
 
         self.ATTRS = set(attr for base in type(self).__mro__ for attr in getattr(base, "ATTRS", []))
-        self._dirty = False
+        self._dirty_attrs = set()
+        self._unset_attrs = set()
+        self._persisted = False
+
+        self._unloaded = set()
+        self._loader = None
+        self._load_lock = None
+
+    @property
+    def _dirty(self) -> bool:
+        return bool(self._dirty_attrs or self._unset_attrs)
+
+    @_dirty.setter
+    def _dirty(self, value: bool):
+        if value:
+            self._dirty_attrs.update(attr for attr in self.ATTRS if hasattr(self, "_" + attr))
+        else:
+            # only ever set to False once the changes have been saved
+            self._dirty_attrs.clear()
+            self._unset_attrs.clear()
+            self._persisted = True
 
     @property
     def dirty(self) -> bool:
@@ -58,6 +95,14 @@ class Stateful(abc.ABC):
     def dirty(self, value: bool):
         self._dirty = value
 
+    def mark_dirty(self, *attrs: str) -> None:
+        self._dirty_attrs.update(attrs)
+        self._unset_attrs.difference_update(attrs)
+
+    def mark_unset(self, *attrs: str) -> None:
+        self._unset_attrs.update(attrs)
+        self._dirty_attrs.difference_update(attrs)
+
     @property
     def qualcls(self) -> str:
         return f"{type(self).__module__}.{type(self).__qualname__}"
@@ -98,6 +143,17 @@ class Stateful(abc.ABC):
 
         return await asyncio.gather(*(preload(attr) for attr in attrs))
 
+    def serialise_attr(self, attr: str) -> Optional[Tuple[str, BsonType]]:
+        val = getattr(self, "_" + attr, _DEFAULT)
+        if val is _DEFAULT:
+            return None
+
+        if not check_container_bson(val):
+            val = self.serialise_special(attr, val)
+            attr += self._SPECIAL_MARKER
+
+        return attr, val
+
     @property
     def state(self) -> Dict[str, BsonType]:
         data = {"req": self._req.state}
@@ -105,60 +161,426 @@ class Stateful(abc.ABC):
             data["cls"] = self.qualcls
 
         for attr in self.ATTRS:
-            val = getattr(self, "_" + attr, _DEFAULT)
-            if val is not _DEFAULT:
-                if not check_container_bson(val):
-                    val = self.serialise_special(attr, val)
-                    attr += self._SPECIAL_MARKER
-                data[attr] = val
+            item = self.serialise_attr(attr)
+            if item:
+                key, val = item
+                data[key] = val
 
         return data
 
+    def get_changes(self, path: str = None) -> Changes:
+        """Get the paths to $set and $unset in order to bring the stored document up to date.
+
+        :param path: dotted path of this object within the document, None for the document itself
+        :return: tuple of the values to set and the paths to unset
+        """
+        if not self._persisted:
+            if path is None:
+                return self.state, set()
+            return {path: self.state}, set()
+
+        to_set = {}
+        to_unset = set()
+
+        for attr in self._dirty_attrs:
+            item = self.serialise_attr(attr)
+            if item:
+                key, val = item
+                to_set[join_path(path, key)] = val
+            else:
+                to_unset.add(join_path(path, attr))
+                to_unset.add(join_path(path, attr + self._SPECIAL_MARKER))
+
+        for attr in self._unset_attrs:
+            to_unset.add(join_path(path, attr))
+            to_unset.add(join_path(path, attr + self._SPECIAL_MARKER))
+
+        self.get_nested_changes(path, to_set, to_unset)
+        return to_set, to_unset
+
+    def get_nested_changes(self, path: Optional[str], to_set: Dict[str, BsonType], to_unset: Set[str]) -> None:
+        """Add the changes of sub-documents which weren't completely rewritten."""
+        pass
+
+    @classmethod
+    def get_projection(cls, attrs: Iterable[str]) -> Dict[str, int]:
+        projection = {"req": 1}
+        if cls.INCLUDE_CLS:
+            projection["cls"] = 1
+
+        for attr in attrs:
+            projection[attr] = 1
+            projection[attr + cls._SPECIAL_MARKER] = 1
+
+        return projection
+
+    def apply_state(self, state: Dict[str, BsonType], *, overwrite: bool = True) -> None:
+        for key, value in state.items():
+            if key.endswith(self._SPECIAL_MARKER):
+                key = key[:-len(self._SPECIAL_MARKER)]
+                if not overwrite and hasattr(self, "_" + key):
+                    continue
+                value = self.deserialise_special(key, value)
+            elif not overwrite and hasattr(self, "_" + key):
+                continue
+
+            setattr(self, "_" + key, value)
+
     @classmethod
     def from_state(cls, state: Dict[str, BsonType]) -> "Stateful":
         inst = cls(Request.from_state(state.pop("req")))
-        for key, value in state.items():
-            if key.endswith(cls._SPECIAL_MARKER):
-                key = key[:-len(cls._SPECIAL_MARKER)]
-                value = cls.deserialise_special(key, value)
-            setattr(inst, "_" + key, value)
+        inst.apply_state(state)
+
+        inst._persisted = True
+        return inst
+
+    def copy(self) -> "Stateful":
+        """Create an independent copy of this object which has the same state and still knows what changed."""
+        inst = type(self).from_state(deepcopy(self.state))
+        inst._persisted = self._persisted
+        inst._dirty_attrs = set(self._dirty_attrs)
+        inst._unset_attrs = set(self._unset_attrs)
         return inst
 
+    def set_partial(self, loaded: Iterable[str], loader: StateLoader) -> None:
+        """Mark this object as only partially loaded.
+
+        :param loaded: attributes which have been loaded
+        :param loader: function which loads the given projection of the document
+        """
+        self._unloaded = self.ATTRS - set(loaded)
+        self._loader = loader
+
+    async def load_attrs(self, *attrs: str) -> None:
+        """Make sure the given attributes (or all if none given) have been loaded from the document."""
+        if not self._unloaded:
+            return
+        if attrs and self._unloaded.isdisjoint(attrs):
+            return
+
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+
+        async with self._load_lock:
+            if not self._unloaded:
+                return
+
+            # there's no point in doing multiple round-trips, load everything that's missing
+            projection = self.get_projection(self._unloaded)
+            projection.pop("req")
+            projection.pop("cls", None)
+
+            log.debug(f"{self} loading missing attributes {self._unloaded}")
+            state = await self._loader(projection)
+
+            if state:
+                state.pop("_id", None)
+                # don't overwrite values which have been set in the meantime
+                self.apply_state(state, overwrite=False)
+
+            self._unloaded = set()
+
+
+_NEVER = float("inf")
+
+RefreshListener = Callable[["Expiring"], Awaitable[None]]
+_REFRESH_LISTENERS: List[RefreshListener] = []
+
+
+def add_refresh_listener(listener: RefreshListener) -> None:
+    """Call the listener with every object whose stale values have been revalidated in the background.
+
+    Nobody is waiting for these refreshes, so this is where the new values get saved.
+    """
+    _REFRESH_LISTENERS.append(listener)
+
+
+class TTL(NamedTuple):
+    """How long the value of an attribute stays fresh.
+
+    If hard is set, the stale value is served (while it's being refreshed) until it's hard seconds old.
+    """
+    soft: float
+    hard: Optional[float] = None
+
+
+class _ChangingAttribute:
+    """Wrapper around an attribute of an Expiring class which checks whether it expired when it's read.
+
+    Only the CHANGING_ATTRS are wrapped, reading any other attribute doesn't cost anything extra.
+    """
+    __slots__ = ("name", "attr")
+
+    def __init__(self, name: str, attr: Any) -> None:
+        self.name = name
+        self.attr = attr
+
+    @property
+    def __isabstractmethod__(self) -> bool:
+        return getattr(self.attr, "__isabstractmethod__", False)
+
+    def __get__(self, obj: Optional["Expiring"], owner: type) -> Any:
+        if obj is None:
+            return self
+
+        if time.monotonic() >= obj._soft_deadlines.get(self.name, _NEVER):
+            obj._on_expired(self.name)
+
+        return self.attr.__get__(obj, owner)
+
+    def __set__(self, obj: "Expiring", value: Any) -> None:
+        self.attr.__set__(obj, value)
+
+    def __delete__(self, obj: "Expiring") -> None:
+        self.attr.__delete__(obj)
+
 
 class Expiring(Stateful):
+    """Stateful object whose CHANGING_ATTRS have to be fetched again once they expire.
+
+    Every changing attribute keeps track of when it was fetched and expires after its TTL
+    (TTLS, EXPIRE_TIME and HARD_EXPIRE_TIME for those which aren't listed there).
+    Within the hard TTL stale values keep being served, reading one starts a refresh of all stale attributes
+    in the background (one per object at a time). If the refresh fails the stale values are kept
+    and it's retried after REFRESH_RETRY seconds.
+    Without a hard TTL the value is dropped as soon as it expires and fetched again by whoever needs it.
+    """
     MINUTE = 60
     HOUR = MINUTE * 60
     DAY = HOUR * 24
 
     CHANGING_ATTRS = ()
+    TTLS: Dict[str, TTL] = {}
     EXPIRE_TIME = HOUR
+    HARD_EXPIRE_TIME: Optional[float] = None
+    REFRESH_RETRY = MINUTE
+
+    ATTRS = ("last_update", "fetched")
+    _ttls: Dict[str, TTL] = {}
 
-    ATTRS = ("last_update",)
     _last_update: datetime
+    _fetched: Dict[str, datetime]
+    # monotonic deadlines of the attributes which have a value, computed once when they're fetched or loaded
+    _soft_deadlines: Dict[str, float]
+    _hard_deadlines: Dict[str, float]
+
+    _refresh_task: Optional[asyncio.Future]
+    _retry_refresh_at: float
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+
+        cls._ttls = {attr: ttl for base in reversed(cls.__mro__) for attr, ttl in getattr(base, "TTLS", {}).items()}
+
+        changing = set(attr for base in cls.__mro__ for attr in getattr(base, "CHANGING_ATTRS", []))
+        for name in changing:
+            attr = inspect.getattr_static(cls, name, None)
+            # some of the attributes are only ever set and don't have a property
+            if attr is None or isinstance(attr, _ChangingAttribute):
+                continue
+            setattr(cls, name, _ChangingAttribute(name, attr))
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.CHANGING_ATTRS = set(attr for base in type(self).__mro__ for attr in getattr(base, "CHANGING_ATTRS", []))
         self._last_update = datetime.now()
 
-    def __getattribute__(self, name: str) -> Any:
-        if name in type(self).CHANGING_ATTRS:
-            if self._update:
-                log.debug(f"{self}: time for an update")
-                for attr in type(self).CHANGING_ATTRS:
-                    with suppress(AttributeError):
-                        delattr(self, f"_{attr}")
-        return super().__getattribute__(name)
+        self._fetched = {}
+        self._soft_deadlines = {}
+        self._hard_deadlines = {}
+
+        self._refresh_task = None
+        self._retry_refresh_at = 0
+
+    def apply_state(self, state: Dict[str, BsonType], *, overwrite: bool = True) -> None:
+        super().apply_state(state, overwrite=overwrite)
+        self._update_deadlines()
+
+    def get_ttl(self, attr: str) -> TTL:
+        ttl = self._ttls.get(attr)
+        if ttl is None:
+            return TTL(self.EXPIRE_TIME, self.HARD_EXPIRE_TIME)
+        return ttl
+
+    def _set_deadlines(self, attr: str, fetched: datetime) -> None:
+        ttl = self.get_ttl(attr)
+        fetched_at = time.monotonic() - (datetime.now() - fetched).total_seconds()
+
+        self._soft_deadlines[attr] = fetched_at + ttl.soft
+        self._hard_deadlines[attr] = fetched_at + (ttl.soft if ttl.hard is None else ttl.hard)
+
+    def _update_deadlines(self) -> None:
+        self._soft_deadlines.clear()
+        self._hard_deadlines.clear()
+
+        for attr in self.CHANGING_ATTRS:
+            if not hasattr(self, f"_{attr}"):
+                continue
+
+            # documents stored before the fetch times were kept track of only know when they were last updated
+            fetched = self._fetched.setdefault(attr, self._last_update)
+            self._set_deadlines(attr, fetched)
+
+    def mark_fetched(self, *attrs: str) -> None:
+        """Remember that the given changing attributes have just been fetched."""
+        now = datetime.now()
+        for attr in attrs:
+            if attr not in self.CHANGING_ATTRS:
+                continue
+
+            self._fetched[attr] = now
+            self._set_deadlines(attr, now)
+            self.mark_dirty("fetched")
+
+    def mark_expired(self, *attrs: str) -> None:
+        """Make the given changing attributes (or all of them if none given) expire right away."""
+        for attr in attrs or list(self._soft_deadlines):
+            if attr not in self._soft_deadlines:
+                continue
+
+            fetched = datetime.now() - timedelta(seconds=self.get_ttl(attr).soft)
+            self._fetched[attr] = fetched
+            self._set_deadlines(attr, fetched)
+            self.mark_dirty("fetched")
+
+    def _on_expired(self, attr: str) -> None:
+        if time.monotonic() < self._hard_deadlines[attr]:
+            self.revalidate()
+        else:
+            self._expire(attr)
+
+    def _expire(self, attr: str) -> None:
+        log.debug(f"{self}: time to update {attr}")
+        with suppress(AttributeError):
+            delattr(self, f"_{attr}")
+            self.mark_unset(attr)
+
+        self._fetched.pop(attr, None)
+        self._soft_deadlines.pop(attr, None)
+        self._hard_deadlines.pop(attr, None)
+        self.mark_dirty("fetched")
+
+    def get_stale_attrs(self, lead: float = 0) -> List[str]:
+        """Get the changing attributes which are stale or become stale within lead seconds."""
+        limit = time.monotonic() + lead
+        return [attr for attr, deadline in self._soft_deadlines.items() if deadline <= limit]
+
+    @property
+    def stale(self) -> bool:
+        """Whether any of the changing attributes has expired (but is still being served)."""
+        return bool(self.get_stale_attrs())
+
+    @property
+    def refreshing(self) -> bool:
+        return self._refresh_task is not None and not self._refresh_task.done()
 
     @property
     def last_update(self) -> datetime:
         return self._last_update
 
     @property
-    def _update(self) -> bool:
-        current_time = datetime.now()
-        last_time = self._last_update
-        if (current_time - last_time).total_seconds() > self.EXPIRE_TIME:
-            self._last_update = current_time
-            return True
-        return False
+    def fetched(self) -> Dict[str, datetime]:
+        """When the changing attributes were fetched."""
+        return self._fetched
+
+    @property
+    def expires_in(self) -> float:
+        """Seconds until the first of the changing attributes expires."""
+        return min(self._soft_deadlines.values(), default=_NEVER) - time.monotonic()
+
+    @property
+    def freshness(self) -> Dict[str, Dict[str, Any]]:
+        """When the changing attributes were fetched and when they expire."""
+        now = time.monotonic()
+        return {attr: dict(fetched=self._fetched[attr].isoformat(),
+                           ttl=self.get_ttl(attr)._asdict(),
+                           expires_in=round(deadline - now),
+                           stale=deadline <= now)
+                for attr, deadline in self._soft_deadlines.items()}
+
+    def get_expiring(self, lead: float) -> List["Expiring"]:
+        """Get the objects (this one or nested ones) which are worth refreshing and expire within lead seconds."""
+        if self.get_stale_attrs(lead):
+            return [self]
+        return []
+
+    def revalidate(self) -> None:
+        """Start refreshing the stale attributes in the background unless that's already happening."""
+        if self.refreshing or time.monotonic() < self._retry_refresh_at:
+            return
+
+        log.debug(f"{self}: serving stale values while refreshing")
+        self._start_refresh(notify=True)
+
+    async def refresh(self, lead: float = 0) -> None:
+        """Fetch the changing attributes which expire within lead seconds again without dropping the current values.
+
+        Joins the refresh which is already running, if there is one.
+        """
+        task = self._refresh_task
+        if task is None or task.done():
+            task = self._start_refresh(lead)
+
+        # the refresh is shared so it mustn't be cancelled along with one of the callers
+        await asyncio.shield(task)
+
+    def _start_refresh(self, lead: float = 0, *, notify: bool = False) -> asyncio.Future:
+        self._refresh_task = asyncio.ensure_future(self._refresh(lead, notify=notify))
+        self._refresh_task.add_done_callback(self._on_refreshed)
+        return self._refresh_task
+
+    def _on_refreshed(self, task: asyncio.Future) -> None:
+        if task.cancelled():
+            return
+
+        exc = task.exception()
+        if exc is not None:
+            log.warning(f"{self} couldn't be refreshed, keeping the current values: {exc!r}")
+            self._retry_refresh_at = time.monotonic() + self.REFRESH_RETRY
+
+    async def _refresh(self, lead: float, *, notify: bool = False) -> None:
+        """Resolve the expiring attributes on a copy of this object.
+
+        They only replace the current values once all of them have been fetched.
+        Until then (or if it fails) readers get the current values.
+
+        :param notify: pass the refreshed object to the refresh listeners
+        """
+        # users shouldn't have to wait for the requests of the refresh
+        REQUEST_PRIORITY.set(Priority.BACKGROUND)
+
+        await self.load_attrs()
+
+        attrs = self.get_stale_attrs(lead)
+        if not attrs:
+            return
+
+        # the request caches its response so the copy needs a fresh one
+        fresh = type(self)(Request.from_state(self._req.state))
+        for attr in self.ATTRS - set(attrs) - {"last_update", "fetched"}:
+            with suppress(AttributeError):
+                setattr(fresh, f"_{attr}", getattr(self, f"_{attr}"))
+
+        # some of the attributes are only ever set and don't have a property to fetch them
+        await fresh.preload_attrs(*(attr for attr in attrs if hasattr(type(self), attr)))
+
+        for attr in attrs:
+            # most likely the source is having problems rather than the value actually being gone
+            if getattr(self, f"_{attr}", None) and not getattr(fresh, f"_{attr}", None):
+                raise ValueError(f"{attr} came back empty")
+
+        for attr in attrs:
+            with suppress(AttributeError):
+                setattr(self, f"_{attr}", getattr(fresh, f"_{attr}"))
+                self.mark_dirty(attr)
+                self.mark_fetched(attr)
+
+        self._last_update = datetime.now()
+        self.mark_dirty("last_update")
+
+        if notify:
+            for listener in _REFRESH_LISTENERS:
+                try:
+                    await listener(self)
+                except Exception:
+                    log.exception(f"{self} refresh listener {listener} failed")
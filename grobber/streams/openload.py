@@ -6,6 +6,7 @@ from typing import Any, Dict, List, Optional
 from pyppeteer.page import Page, PageError
 
 from . import register_stream
+from ..browser import LIGHT_PROFILE, RequestCapture
 from ..decorators import cached_property
 from ..models import Stream
 from ..request import Request
@@ -33,19 +34,29 @@ class Openload(Stream):
 
     HOST = "openload.co"
 
+    BROWSER_PROFILE = LIGHT_PROFILE._replace(wait_for="div#videooverlay")
+
     @cached_property
     async def player_data(self) -> Dict[str, Any]:
-        try:
-            page: Page
-            async with self._req.page as page:
-                await page.click("div#videooverlay")
-                data = await page.querySelectorEval("video#olvideo_html5_api", EXTRACT_DATA_SCRIPT)
+        data = {}
+
+        async def start_video(page: Page) -> None:
+            data.update(await page.querySelectorEval("video#olvideo_html5_api", EXTRACT_DATA_SCRIPT))
+            await page.click("div#videooverlay")
 
-            return data
+        try:
+            # the video request is sent as soon as the player starts, there's no need to wait for the page to settle
+            media = await self.capture(RequestCapture(), trigger=start_video)
         except PageError as e:
             log.warning(f"couldn't access {self} because {e}")
+            return {}
+
+        if media:
+            data.update(source=media.url, captured=True)
+        else:
+            log.debug(f"{self} didn't request a video, falling back to the video element")
 
-        return {}
+        return data
 
     @cached_property
     async def poster(self) -> Optional[str]:
@@ -56,9 +67,11 @@ class Openload(Stream):
 
     @cached_property
     async def links(self) -> List[str]:
-        source = (await self.player_data).get("source")
+        player_data = await self.player_data
+        source = player_data.get("source")
 
-        if source and await Request(source).head_success:
+        # the browser already requested captured sources, no need to check them again
+        if source and (player_data.get("captured") or await Request(source).head_success):
             return [source]
 
     @cached_property
@@ -1,6 +1,6 @@
-__all__ = ["AsyncFormatter", "create_response", "error_response", "add_http_scheme", "parse_js_json", "external_url_for",
+__all__ = ["AsyncFormatter", "SingleFlight", "create_response", "error_response", "add_http_scheme", "parse_js_json", "external_url_for",
            "format_available",
-           "do_later", "anext", "fuzzy_bool"]
+           "do_later", "bounded_gather", "anext", "fuzzy_bool"]
 
 import asyncio
 import json
@@ -12,7 +12,9 @@ from typing import Any, AsyncIterator, Awaitable, Dict, List, Optional, TypeVar,
 from quart import Response, jsonify, url_for
 
 from .async_string_formatter import AsyncFormatter
+from .single_flight import SingleFlight
 from ..exceptions import GrobberException
+from ..rate_limit import Priority, REQUEST_PRIORITY
 
 log = logging.getLogger(__name__)
 
@@ -86,6 +88,8 @@ def format_available(text: str, *args, **kwargs) -> str:
 
 def do_later(target: Awaitable) -> None:
     async def safe_run(aw: Awaitable) -> None:
+        # requests made in the background have to wait for those of users
+        REQUEST_PRIORITY.set(Priority.BACKGROUND)
         try:
             await aw
         except Exception as e:
@@ -94,6 +98,17 @@ def do_later(target: Awaitable) -> None:
     asyncio.ensure_future(safe_run(target))
 
 
+async def bounded_gather(*aws: Awaitable[T], limit: int) -> List[T]:
+    """Like asyncio.gather but with at most limit awaitables running at the same time."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw: Awaitable[T]) -> T:
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*(run(aw) for aw in aws))
+
+
 async def anext(iterable: AsyncIterator[T], default: Any = _DEFAULT) -> T:
     try:
         return await iterable.__anext__()
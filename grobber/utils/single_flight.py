@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, Generic, Hashable, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class _Call:
+    task: asyncio.Future
+    waiters: int
+
+    def __init__(self, task: asyncio.Future) -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight(Generic[T]):
+    """Make concurrent callers with the same key share one execution.
+
+    The first caller starts the call, everyone arriving before it's done awaits the same result.
+    The shared call is only cancelled once all of its callers have been cancelled.
+    """
+    name: str
+    coalesced: int
+
+    _calls: Dict[Hashable, _Call]
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.coalesced = 0
+        self._calls = {}
+
+    def __repr__(self) -> str:
+        return f"<SingleFlight {self.name}: {len(self._calls)} in flight>"
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        call = self._calls.get(key)
+        if call is None:
+            call = _Call(asyncio.ensure_future(func()))
+            self._calls[key] = call
+
+            def forget(_) -> None:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+
+            call.task.add_done_callback(forget)
+        else:
+            self.coalesced += 1
+            log.debug(f"{self} joining call for {key}")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters <= 0 and not call.task.done():
+                call.task.cancel()
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import time
+
+from grobber.cache import DiskStore, LRUCache, MemoryStore
+from grobber.search_cache import SearchCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats.evictions == 1
+
+
+def test_ttl():
+    cache = LRUCache(2, ttl=0.01)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=None)
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.stats.expirations == 1
+    assert cache.stats.hits == 1
+    assert cache.stats.misses == 1
+
+
+def test_disk_store_sweep(tmp_path):
+    store = DiskStore(str(tmp_path), max_size=3, sweep_every=5)
+
+    async def run():
+        await store.set("expired", {"a": 1}, -1)
+        for i in range(4):
+            await store.set(str(i), {"a": i}, 60 + i)
+
+        assert len(os.listdir(tmp_path)) == 3
+        assert await store.get("expired") is None
+        assert await store.get("0") is None
+        assert await store.get("3") == {"a": 3}
+
+    asyncio.run(run())
+
+
+def test_search_cache_empty_results():
+    cache = SearchCache(MemoryStore(8), fresh_for=60, keep_for=120, empty_for=0.01)
+
+    async def run():
+        await cache.set("empty", [])
+        await cache.set("full", [("uid", 1.0)])
+        await asyncio.sleep(0.02)
+
+        assert await cache.get("empty") is None
+        assert (await cache.get("full")).results == [("uid", 1.0)]
+
+    asyncio.run(run())
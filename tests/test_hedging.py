@@ -0,0 +1,68 @@
+import asyncio
+import time
+from typing import Dict, Optional, Tuple
+
+from grobber.hedging import HedgedResolver
+
+# candidates are (name, seconds until they're done, whether they work)
+Candidate = Tuple[str, float, bool]
+
+
+def resolve(resolver: HedgedResolver, tiers, cancelled: Dict[str, bool] = None) -> Optional[str]:
+    cancelled = {} if cancelled is None else cancelled
+
+    async def probe(candidate: Candidate) -> Optional[str]:
+        name, duration, works = candidate
+        try:
+            await asyncio.sleep(duration)
+        except asyncio.CancelledError:
+            cancelled[name] = True
+            raise
+
+        return name if works else None
+
+    return asyncio.run(resolver.resolve(tiers, probe))
+
+
+def test_best_tier():
+    resolver = HedgedResolver(delay=.05, window=.05)
+    tiers = [(100, [("a", .01, False), ("b", .02, True)]),
+             (50, [("c", 0, True)])]
+
+    assert resolve(resolver, tiers) == "b"
+    assert resolver.stats[100].working == 1
+    assert resolver.stats[50].skipped == 1
+
+
+def test_dead_tier_is_hedged():
+    resolver = HedgedResolver(delay=.02, window=.02)
+    cancelled = {}
+    tiers = [(100, [("slow", 1, True)]),
+             (50, [("fast", .01, True), ("other", 1, True)])]
+
+    start = time.monotonic()
+    assert resolve(resolver, tiers, cancelled) == "fast"
+    assert time.monotonic() - start < .5
+
+    assert cancelled == {"slow": True, "other": True}
+    assert resolver.stats[100].cancelled == 1
+    assert resolver.stats[50].working == 1
+
+
+def test_better_tier_within_window():
+    resolver = HedgedResolver(delay=.01, window=.1)
+    tiers = [(100, [("late", .05, True)]),
+             (50, [("early", .02, True)])]
+
+    assert resolve(resolver, tiers) == "late"
+
+
+def test_failed_tiers_start_next():
+    resolver = HedgedResolver(delay=10, window=10)
+    tiers = [(100, [("a", 0, False)]),
+             (50, [("b", 0, False)]),
+             (10, [("c", 0, True)])]
+
+    assert resolve(resolver, tiers) == "c"
+    assert resolver.stats[100].failed == 1
+    assert resolve(resolver, []) is None
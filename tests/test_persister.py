@@ -0,0 +1,142 @@
+import asyncio
+
+from pymongo.errors import BulkWriteError
+
+from grobber.persister import WriteBehindPersister
+from grobber.request import Request
+from grobber.stateful import Stateful
+
+
+class Document(Stateful):
+    ATTRS = ("value",)
+
+    def __init__(self, req: Request, value: int = 0) -> None:
+        super().__init__(req)
+        self._value = value
+
+
+class FakeCollection:
+    name = "fake"
+
+    def __init__(self) -> None:
+        self.batches = []
+        self.errors = []
+        self.delays = []
+
+    async def bulk_write(self, ops, ordered: bool = True) -> None:
+        if self.delays:
+            await asyncio.sleep(self.delays.pop(0))
+        if self.errors:
+            raise self.errors.pop(0)
+
+        self.batches.append(ops)
+
+
+def create_persister(**kwargs) -> WriteBehindPersister:
+    kwargs.setdefault("flush_interval", 60)
+    return WriteBehindPersister(FakeCollection(), **kwargs)
+
+
+def create_document(value: int = 0) -> Document:
+    return Document(Request("http://example.com"), value)
+
+
+def test_batching():
+    persister = create_persister(batch_size=2)
+
+    async def run():
+        for i in range(3):
+            await persister.enqueue(i, create_document(i))
+
+        assert [len(ops) for ops in persister.collection.batches] == [2]
+        assert len(persister) == 1
+
+        await persister.close()
+        assert [len(ops) for ops in persister.collection.batches] == [2, 1]
+        assert persister.saved == 3
+
+    asyncio.run(run())
+
+
+def test_max_pending():
+    persister = create_persister(batch_size=10, max_pending=3)
+
+    async def run():
+        for i in range(3):
+            await persister.enqueue(i, create_document(i))
+
+        # the third write has to wait for the pending ones to be written
+        assert len(persister) == 0
+        assert [len(ops) for ops in persister.collection.batches] == [3]
+
+    asyncio.run(run())
+
+
+def test_requeue():
+    persister = create_persister(max_retries=1)
+    doc = create_document()
+
+    async def run():
+        persister.collection.errors.append(ConnectionError())
+        await persister.enqueue("a", doc)
+        assert await persister.flush() == 0
+        assert len(persister) == 1
+        assert not doc._persisted
+
+        assert await persister.flush() == 1
+        assert doc._persisted
+
+        persister.collection.errors.extend([ConnectionError(), ConnectionError()])
+        doc.mark_dirty("value")
+        await persister.enqueue("a", doc)
+        assert await persister.flush() == 0
+        assert await persister.flush() == 0
+        # it has been given up on
+        assert len(persister) == 0
+        assert persister.dropped == 1
+
+    asyncio.run(run())
+
+
+def test_rejected_writes():
+    persister = create_persister()
+
+    async def run():
+        persister.collection.errors.append(BulkWriteError({"writeErrors": [{"index": 0, "errmsg": "too large"}]}))
+        await persister.enqueue("a", create_document())
+        await persister.enqueue("b", create_document())
+
+        assert await persister.flush() == 1
+        assert len(persister) == 0
+        assert persister.dropped == 1
+
+    asyncio.run(run())
+
+
+def test_discard():
+    persister = create_persister()
+
+    async def run():
+        await persister.enqueue("a", create_document())
+        persister.discard("a")
+        assert await persister.flush() == 0
+        assert persister.collection.batches == []
+
+    asyncio.run(run())
+
+
+def test_close_during_write():
+    persister = create_persister(flush_interval=0)
+
+    async def run():
+        # the periodic flush is still writing when the persister is closed
+        persister.collection.delays.append(60)
+        await persister.enqueue("a", create_document())
+        await asyncio.sleep(0.01)
+        assert len(persister) == 0
+
+        await persister.close()
+        assert [len(ops) for ops in persister.collection.batches] == [1]
+        assert len(persister) == 0
+
+    asyncio.run(run())
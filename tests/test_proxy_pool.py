@@ -0,0 +1,31 @@
+import asyncio
+
+from grobber import request
+from grobber.proxy_pool import ProxyPool
+from grobber.request import Request
+
+
+def test_cancelled_request_keeps_proxy(monkeypatch):
+    pool = ProxyPool(["http://proxy:8080"], max_concurrency=5, eject_after=3, eject_for=60)
+    proxy = next(iter(pool._proxies.values()))
+    monkeypatch.setattr(request, "PROXY_POOL", pool)
+
+    async def send(self, method, url, options):
+        await asyncio.sleep(60)
+
+    monkeypatch.setattr(Request, "_send", send)
+
+    async def run():
+        for _ in range(pool.eject_after):
+            task = asyncio.ensure_future(Request("http://example.com")._send_via_proxy("get", "http://example.com", {}))
+            await asyncio.sleep(0)
+            task.cancel()
+            await asyncio.wait([task])
+            assert task.cancelled()
+
+    asyncio.run(run())
+
+    assert proxy.active == 0
+    assert proxy.failures == 0
+    assert proxy.success_rate == 1
+    assert not proxy.ejected
@@ -0,0 +1,53 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from grobber.languages import Language
+from grobber.search_index import IndexRefresher, TitleIndex
+
+
+class FakeCursor:
+    def __init__(self, docs) -> None:
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class FakeCollection:
+    def __init__(self) -> None:
+        self.docs = []
+        self.queries = []
+
+    def add(self, uid: str, title: str, last_update: datetime) -> None:
+        self.docs.append({"_id": uid, "title": title, "language$state": Language.ENGLISH.value, "is_dub": False,
+                          "last_update": last_update})
+
+    def find(self, query, projection) -> FakeCursor:
+        self.queries.append(query)
+        since = query.get("last_update", {}).get("$gt")
+        return FakeCursor([doc for doc in self.docs if since is None or doc["last_update"] > since])
+
+
+def test_incremental_sync():
+    index = TitleIndex()
+    collection = FakeCollection()
+    refresher = IndexRefresher(index, collection, interval=60, full_every=3, overlap=0)
+
+    async def run():
+        collection.add("old", "One Piece", datetime.now() - timedelta(days=1))
+        await refresher.sync()
+        assert "old" in index
+
+        collection.docs.clear()
+        collection.add("new", "One Punch Man", datetime.now() + timedelta(seconds=1))
+        await refresher.sync()
+        assert "last_update" in collection.queries[-1]
+        # incremental syncs don't know about deleted anime
+        assert "old" in index and "new" in index
+
+        await refresher.sync()
+        await refresher.sync()
+        assert "last_update" not in collection.queries[-1]
+        assert "old" not in index and "new" in index
+
+    asyncio.run(run())
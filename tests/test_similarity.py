@@ -0,0 +1,52 @@
+from grobber.models import get_certainty
+from grobber.similarity import DifflibEngine
+
+TITLES = ["Shingeki no Kyojin", "Shingeki no Kyojin Season 2", "One Piece", "One Punch Man", "", "Kyojin"]
+
+
+# the ratio isn't symmetric, these are the scores of SequenceMatcher(a=query, b=title)
+ASYMMETRIC = [("attack on titan", "Shingeki no Kyojin", 0.24),
+              ("Shingeki no Kyojin", "attack on titan", 0.12),
+              ("attack on titan", "death note", 0.24),
+              ("Shingeki no Kyojin", "One Punch Man", 0.13),
+              ("Boku no Hero Academia", "One Punch Man", 0.18)]
+
+
+def test_asymmetric_scores():
+    engine = DifflibEngine()
+
+    for query, title, score in ASYMMETRIC:
+        assert get_certainty(query, title) == score
+        assert engine.rank(query, [title]) == [(0, score)]
+
+
+def test_rank_matches_certainty():
+    engine = DifflibEngine()
+
+    for query in ("shingeki", "One Piece", "kyojin", "attack on titan", ""):
+        ranked = engine.rank(query, TITLES)
+        assert len(ranked) == len(TITLES)
+
+        for i, score in ranked:
+            assert score == get_certainty(query, TITLES[i])
+
+        scores = [score for _, score in ranked]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_rank_min_score():
+    engine = DifflibEngine()
+
+    for min_score in (0.3, 0.5, 0.8):
+        ranked = engine.rank("One Piece", TITLES, min_score=min_score)
+        expected = {i for i, title in enumerate(TITLES) if get_certainty("One Piece", title) >= min_score}
+        assert {i for i, _ in ranked} == expected
+
+
+def test_rank_limit():
+    engine = DifflibEngine()
+
+    for query in ("shingeki", "One Piece", "kyojin"):
+        for min_score in (0, 0.5):
+            ranked = engine.rank(query, TITLES, min_score=min_score)
+            assert engine.rank(query, TITLES, limit=2, min_score=min_score) == ranked[:2]
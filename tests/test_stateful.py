@@ -0,0 +1,396 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from grobber.decorators import cached_property
+from grobber.languages import Language
+from grobber.models import Anime, Episode, EpisodeMap, Stream
+from grobber.request import Request
+from grobber import stateful
+from grobber.stateful import Expiring, TTL
+
+
+class Counter(Expiring):
+    ATTRS = ("name", "count")
+    CHANGING_ATTRS = ("count",)
+
+    fetches = 0
+    fail = False
+
+    @cached_property
+    async def name(self) -> str:
+        return "counter"
+
+    @cached_property
+    async def count(self) -> int:
+        await asyncio.sleep(0)
+        if Counter.fail:
+            raise ValueError("couldn't fetch")
+
+        Counter.fetches += 1
+        return Counter.fetches
+
+
+def backdate(obj: Expiring, seconds: float) -> None:
+    fetched = datetime.now() - timedelta(seconds=seconds)
+    obj.apply_state({"fetched": {attr: fetched for attr in obj.CHANGING_ATTRS}})
+
+
+def create_counter() -> Counter:
+    Counter.fetches = 0
+    Counter.fail = False
+
+    counter = Counter(Request("http://example.com"))
+    asyncio.run(counter.preload_attrs())
+    return counter
+
+
+def test_expiring():
+    counter = create_counter()
+    assert counter.get_expiring(60) == []
+
+    backdate(counter, counter.EXPIRE_TIME - 30)
+    assert counter.get_expiring(60) == [counter]
+
+
+def test_refresh():
+    counter = create_counter()
+    assert counter._count == 1
+
+    async def refresh() -> int:
+        # only what's about to expire is refreshed
+        await counter.refresh()
+        assert counter._count == 1
+
+        task = asyncio.ensure_future(counter.refresh(counter.EXPIRE_TIME))
+        await asyncio.sleep(0)
+        # the old value is served until the refresh is done
+        assert await counter.count == 1
+        await task
+        return await counter.count
+
+    assert asyncio.run(refresh()) == 2
+    assert counter._name == "counter"
+    assert "count" in counter._dirty_attrs
+
+
+def test_failed_refresh():
+    counter = create_counter()
+    backdate(counter, counter.EXPIRE_TIME - 30)
+    Counter.fail = True
+
+    with pytest.raises(ValueError):
+        asyncio.run(counter.refresh(60))
+
+    assert counter._count == 1
+    assert counter.get_expiring(60) == [counter]
+
+
+class RevalidatingCounter(Counter):
+    HARD_EXPIRE_TIME = 2 * Expiring.HOUR
+
+
+def test_stale_while_revalidate():
+    Counter.fetches = 0
+    Counter.fail = False
+    counter = RevalidatingCounter(Request("http://example.com"))
+
+    async def read_stale() -> int:
+        await counter.count
+        counter.mark_expired()
+        assert counter.stale
+
+        # the stale value is served right away and only one refresh is started
+        assert await counter.count == 1
+        task = counter._refresh_task
+        assert await counter.count == 1
+        assert counter._refresh_task is task
+
+        await task
+        return await counter.count
+
+    assert asyncio.run(read_stale()) == 2
+    assert not counter.stale
+
+
+def test_stale_failed_refresh():
+    Counter.fetches = 0
+    Counter.fail = False
+    counter = RevalidatingCounter(Request("http://example.com"))
+
+    async def read_stale() -> int:
+        await counter.count
+        counter.mark_expired()
+        Counter.fail = True
+
+        await counter.count
+        await asyncio.wait([counter._refresh_task])
+
+        # not retried right away
+        await counter.count
+        assert not counter.refreshing
+        return await counter.count
+
+    assert asyncio.run(read_stale()) == 1
+    assert counter.stale
+
+
+def test_hard_expiry():
+    counter = create_counter()
+    backdate(counter, counter.EXPIRE_TIME + 1)
+
+    assert asyncio.run(counter.count) == 2
+
+
+def test_overridden_changing_attribute():
+    class Override(Counter):
+        @cached_property
+        async def count(self) -> int:
+            return 42
+
+    counter = Override(Request("http://example.com"))
+    assert asyncio.run(counter.count) == 42
+
+    backdate(counter, counter.EXPIRE_TIME + 1)
+    assert counter.stale
+    assert asyncio.run(counter.count) == 42
+    assert not counter.stale
+
+
+class Episodic(Expiring):
+    ATTRS = ("embeds", "links")
+    CHANGING_ATTRS = ("embeds", "links")
+    TTLS = {"embeds": TTL(Expiring.DAY)}
+
+    fetches = None
+
+    @cached_property
+    async def embeds(self) -> str:
+        self.fetches["embeds"] += 1
+        return f"embeds {self.fetches['embeds']}"
+
+    @cached_property
+    async def links(self) -> str:
+        self.fetches["links"] += 1
+        return f"links {self.fetches['links']}"
+
+
+def test_attribute_ttls():
+    episodic = Episodic(Request("http://example.com"))
+    Episodic.fetches = {"embeds": 0, "links": 0}
+    asyncio.run(episodic.preload_attrs())
+
+    state = episodic.state
+    assert set(state["fetched"]) == {"embeds", "links"}
+
+    restored = Episodic.from_state(state)
+    assert set(restored.freshness) == {"embeds", "links"}
+    assert restored.freshness["embeds"]["ttl"]["soft"] == Expiring.DAY
+
+    backdate(restored, 2 * Expiring.HOUR)
+    assert restored.get_stale_attrs() == ["links"]
+    assert restored.freshness["links"]["stale"]
+
+    asyncio.run(restored.refresh())
+    assert restored._embeds == "embeds 1"
+    assert restored._links == "links 2"
+    assert not restored.stale
+    assert restored.get_stale_attrs(Expiring.HOUR / 2) == []
+    assert "embeds" in restored.get_stale_attrs(Expiring.DAY)
+
+
+def test_legacy_state():
+    episodic = Episodic.from_state({"req": {"url": "http://example.com"},
+                                    "embeds": "embeds", "links": "links",
+                                    "last_update": datetime.now() - timedelta(hours=2)})
+
+    # without fetch times the attributes are as old as the last update
+    assert episodic.get_stale_attrs() == ["links"]
+    episodic._last_update = datetime.now()
+    assert episodic.get_stale_attrs() == ["links"]
+
+
+def test_copy():
+    counter = create_counter()
+    counter._name = ["counter"]
+    copy = counter.copy()
+
+    assert copy is not counter
+    assert copy._count == counter._count
+    assert copy._dirty_attrs == counter._dirty_attrs
+    assert copy._persisted == counter._persisted
+
+    copy._name.append("copy")
+    assert counter._name == ["counter"]
+
+
+class FakeStream(Stream):
+    @cached_property
+    async def external(self) -> bool:
+        return True
+
+    @cached_property
+    async def links(self) -> list:
+        return ["http://example.com/video.mp4"]
+
+
+class FakeEpisode(Episode):
+    @cached_property
+    async def raw_streams(self) -> list:
+        return []
+
+
+class FakeAnime(Anime):
+    EPISODE_CLS = FakeEpisode
+
+    @cached_property
+    async def is_dub(self) -> bool:
+        return False
+
+    @cached_property
+    async def language(self) -> Language:
+        return Language.ENGLISH
+
+    @cached_property
+    async def title(self) -> str:
+        return "title"
+
+    async def get_episodes(self) -> list:
+        return []
+
+    async def get_episode(self, index: int) -> FakeEpisode:
+        raise KeyError(index)
+
+    @classmethod
+    async def search(cls, query: str, **kwargs):
+        yield
+
+
+def create_anime() -> FakeAnime:
+    stream = {"req": {"url": "http://example.com/stream"}, "cls": f"{FakeStream.__module__}.{FakeStream.__qualname__}",
+              "external": True, "links": ["http://example.com/video.mp4"]}
+    episodes = {str(i): {"req": {"url": f"http://example.com/{i}"}, "stream$state": dict(stream)} for i in range(3)}
+
+    return FakeAnime.from_state({"req": {"url": "http://example.com"}, "cls": "FakeAnime",
+                                 "title": "title", "episode_count": 3, "episodes$state": episodes})
+
+
+def test_field_changes():
+    counter = Counter.from_state({"req": {"url": "http://example.com"}, "name": "counter", "count": 1})
+    assert counter.get_changes() == ({}, set())
+
+    counter._name = "renamed"
+    counter.mark_dirty("name")
+    counter.mark_unset("count")
+
+    assert counter.get_changes() == ({"name": "renamed"}, {"count", "count$state"})
+    assert counter.get_changes("counter") == ({"counter.name": "renamed"}, {"counter.count", "counter.count$state"})
+
+    # a dirty attribute which doesn't exist anymore is unset as well
+    del counter._name
+    assert counter.get_changes()[1] == {"name", "name$state", "count", "count$state"}
+
+
+def test_nested_changes():
+    anime = create_anime()
+    assert anime.get_changes() == ({}, set())
+
+    stream = anime._episodes[1]._stream
+    stream._links = ["http://example.com/other.mp4"]
+    stream.mark_dirty("links")
+
+    to_set, to_unset = anime.get_changes()
+    assert to_set == {"episodes$state.1.stream$state.links": ["http://example.com/other.mp4"]}
+    assert to_unset == set()
+
+    # untouched episodes are never deserialised
+    assert set(anime._episodes.loaded()) == {1}
+
+    anime.dirty = False
+    assert anime.get_changes() == ({}, set())
+
+
+def test_unset_on_expiry():
+    counter = Counter.from_state({"req": {"url": "http://example.com"}, "name": "counter", "count": 1,
+                                  "last_update": datetime.now() - timedelta(days=1)})
+    Counter.fail = True
+
+    # the expired value is thrown away even if the new one can't be fetched
+    with pytest.raises(ValueError):
+        asyncio.run(counter.count)
+    Counter.fail = False
+
+    to_set, to_unset = counter.get_changes()
+    assert to_unset == {"count", "count$state"}
+    assert "count" not in to_set
+    assert "count" not in to_set["fetched"]
+
+
+def test_unpersisted_changes():
+    anime = create_anime()
+    anime._episodes[3] = FakeEpisode(Request("http://example.com/3"))
+
+    to_set, _ = anime.get_changes()
+    assert to_set["episodes$state.3"] == anime._episodes[3].state
+
+    counter = create_counter()
+    counter._persisted = False
+    assert counter.get_changes() == (counter.state, set())
+    assert counter.get_changes("counter") == ({"counter": counter.state}, set())
+
+
+def test_episode_map_serialise():
+    anime = create_anime()
+    raw = anime.state["episodes$state"]
+
+    ep = anime._episodes[2]
+    ep._stream._links = []
+    serialised = anime._episodes.serialise()
+
+    assert set(serialised) == {"0", "1", "2"}
+    # episodes which were never loaded keep their stored state
+    assert serialised["0"] is raw["0"]
+    assert serialised["2"]["stream$state"]["links"] == []
+
+    restored = EpisodeMap(FakeEpisode, serialised)
+    assert restored[2]._stream._links == []
+
+
+def test_episode_map_failed_load():
+    episodes = EpisodeMap(FakeEpisode, {"0": {"no": "req"}})
+
+    with pytest.raises(KeyError):
+        episodes[0]
+
+    # the state is still there to be serialised
+    assert 0 in episodes
+    assert episodes.serialise() == {"0": {"no": "req"}}
+
+
+def test_refresh_listener():
+    Counter.fetches = 0
+    Counter.fail = False
+    counter = RevalidatingCounter(Request("http://example.com"))
+    refreshed = []
+
+    async def listener(obj: Expiring) -> None:
+        refreshed.append(obj)
+
+    async def run():
+        await counter.count
+        counter.mark_expired()
+        await counter.refresh()
+        # whoever refreshes explicitly saves the object
+        assert refreshed == []
+
+        counter.mark_expired()
+        await counter.count
+        await counter._refresh_task
+        assert refreshed == [counter]
+
+    stateful.add_refresh_listener(listener)
+    try:
+        asyncio.run(run())
+    finally:
+        stateful._REFRESH_LISTENERS.remove(listener)